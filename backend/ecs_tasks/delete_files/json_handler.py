@@ -1,12 +1,96 @@
-from gzip import GzipFile
+from gzip import GzipFile, compress
 from io import BytesIO
 import json
-from collections import Counter
-
-from boto_utils import json_lines_iterator
+import re
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 
 from pyarrow import BufferOutputStream, CompressedOutputStream
 
+try:
+    from orjson import loads
+except ImportError:
+    try:
+        from simdjson import loads
+    except ImportError:
+        from json import loads
+
+CHUNK_SIZE = 8 * 2**20
+GZIP_BLOCK_SIZE = 8 * 2**20
+# Same level as the PyArrow gzip codec
+GZIP_COMPRESSION_LEVEL = 9
+# Characters which can be written as a backslash followed by a single character
+JSON_ESCAPES = {
+    '"': '"',
+    "\\": "\\",
+    "/": "/",
+    "\b": "b",
+    "\f": "f",
+    "\n": "n",
+    "\r": "r",
+    "\t": "t",
+}
+
+
+class ParallelGzipOutputStream:
+    """
+    Write-only file-like object which compresses its content as a sequence of
+    gzip members, one per block, and writes them to the output stream in
+    order. Blocks are compressed concurrently by a thread pool, as zlib
+    releases the GIL. Concatenated gzip members are a valid gzip file.
+    """
+
+    def __init__(self, out_stream, threads, block_size=GZIP_BLOCK_SIZE):
+        self.out_stream = out_stream
+        self.block_size = block_size
+        self.closed = False
+        self._executor = ThreadPoolExecutor(max_workers=threads)
+        self._max_pending = threads * 2
+        self._pending = deque()
+        self._buffer = bytearray()
+        self._members = 0
+
+    def write(self, data):
+        self._buffer += data
+        while len(self._buffer) >= self.block_size:
+            self._submit(bytes(self._buffer[: self.block_size]))
+            del self._buffer[: self.block_size]
+        return len(data)
+
+    def _submit(self, block):
+        self._pending.append(
+            self._executor.submit(compress, block, GZIP_COMPRESSION_LEVEL)
+        )
+        self._members += 1
+        # Bound the memory held by blocks waiting to be written
+        while len(self._pending) > self._max_pending:
+            self.out_stream.write(self._pending.popleft().result())
+
+    def close(self):
+        if self._buffer or self._members == 0:
+            self._submit(bytes(self._buffer))
+            self._buffer = bytearray()
+        while self._pending:
+            self.out_stream.write(self._pending.popleft().result())
+        self._executor.shutdown()
+        self.closed = True
+
+    def abort(self):
+        """
+        Discards any pending block and stops the compression threads
+        """
+        self._executor.shutdown(cancel_futures=True)
+        self._pending.clear()
+        self._buffer = bytearray()
+        self.closed = True
+
+
+def get_gzip_writer(out_stream, compression_threads=1):
+    if compression_threads > 1:
+        return ParallelGzipOutputStream(out_stream, compression_threads)
+    return CompressedOutputStream(out_stream, "gzip")
+
 
 def find_key(key, obj):
     """
@@ -38,37 +122,271 @@ def get_value(key, obj):
     return obj
 
 
-def delete_matches_from_json_file(input_file, to_delete, compressed=False):
+def get_searchable_component(components):
+    """
+    Returns the component of a MatchId to search for in the raw lines, or None
+    if none of the components can be searched for as bytes. Strings are
+    preferred over integers as they are more selective.
+    """
+    strings = [c for c in components if isinstance(c, str)]
+    if strings:
+        return max(strings, key=len)
+    integers = [c for c in components if type(c) is int]
+    if integers:
+        return max(integers, key=abs)
+    return None
+
+
+def build_trie_pattern(needles):
+    """
+    Builds a regex alternation of the needles structured as a trie, so that
+    the regex engine follows a single branch at each position rather than
+    trying every needle in turn
+    """
+    trie = {}
+    for needle in needles:
+        node = trie
+        for byte in needle:
+            node = node.setdefault(byte, {})
+        node[None] = {}
+
+    def to_pattern(node):
+        alternatives = [
+            re.escape(bytes([byte])) + to_pattern(child)
+            for byte, child in sorted(
+                (byte, child) for byte, child in node.items() if byte is not None
+            )
+        ]
+        if None in node:
+            alternatives.append(b"")
+        if len(alternatives) == 1:
+            return alternatives[0]
+        return b"(?:" + b"|".join(alternatives) + b")"
+
+    return to_pattern(trie)
+
+
+def get_prefilter(to_delete):
+    """
+    Returns the prefilter for the MatchIds, reusing the compiled pattern for
+    consecutive objects which are deleting the same MatchIds.
+    """
+    return build_cached_prefilter(
+        tuple((column["Type"], frozenset(column["MatchIds"])) for column in to_delete)
+    )
+
+
+@lru_cache(maxsize=2)
+def build_cached_prefilter(columns):
+    return build_prefilter(
+        [{"Type": col_type, "MatchIds": match_ids} for col_type, match_ids in columns]
+    )
+
+
+def build_prefilter(to_delete):
+    """
+    Builds a pattern which finds every line that may contain one of the
+    MatchIds, so that only those lines need to be parsed. Strings are searched
+    for including their quotes and integers as whole number tokens. Lines using
+    escape sequences which could hide a string, or numbers in exponent
+    notation when searching for integers, are always treated as candidates.
+    Returns None when the MatchIds can't be searched for as bytes and every
+    line must be parsed.
+    """
+    strings = set()
+    integers = set()
+    chars = set()
+    for column in to_delete:
+        is_composite = column["Type"] != "Simple"
+        for match_id in column["MatchIds"]:
+            components = match_id if is_composite else (match_id,)
+            if not all(components):
+                # Falsy identifiers are never matched
+                continue
+            component = get_searchable_component(components)
+            if component is None:
+                return None
+            if isinstance(component, str):
+                strings.add(
+                    json.dumps(component, ensure_ascii=False).encode(
+                        "utf-8", "surrogatepass"
+                    )
+                )
+                chars.update(component)
+            else:
+                integers.add(str(abs(component)).encode("utf-8"))
+    patterns = []
+    if strings:
+        escapes = "".join(v for k, v in JSON_ESCAPES.items() if k in chars)
+        patterns.append(build_trie_pattern(strings))
+        patterns.append(rb"\\[u" + re.escape(escapes).encode("utf-8") + rb"]")
+    if integers:
+        # Numbers follow a colon, comma, bracket or whitespace. A number in
+        # exponent notation can be equal to an integer without containing
+        # its digits, e.g. 1.2345e4
+        patterns.append(
+            rb"[\s:,\[]-?(?:"
+            + build_trie_pattern(integers)
+            + rb"(?![0-9])|[0-9]+(?:\.[0-9]*)?[eE])"
+        )
+        if b"1" in integers:
+            # true == 1 in Python
+            patterns.append(rb"true")
+    if not patterns:
+        return re.compile(rb"(?!)")
+    try:
+        return re.compile(b"|".join(patterns))
+    except (RecursionError, re.error):
+        return None
+
+
+def iter_candidate_lines(content, prefilter):
+    """
+    Yields the start and end offsets of each line which could contain a match
+    """
+    length = len(content)
+    if prefilter is None:
+        start = 0
+        while start < length:
+            end = content.find(b"\n", start)
+            end = length if end == -1 else end
+            yield start, end
+            start = end + 1
+        return
+    match = prefilter.search(content)
+    while match:
+        start = content.rfind(b"\n", 0, match.start()) + 1
+        end = content.find(b"\n", match.start())
+        end = length if end == -1 else end
+        yield start, end
+        match = prefilter.search(content, end + 1)
+
+
+def parse_json_line(line):
+    try:
+        return loads(line)
+    except ValueError:
+        # The standard library accepts some documents rejected by the fast
+        # parsers (e.g. NaN or integers exceeding 64 bits) and is used for
+        # consistent error messages
+        return json.loads(line)
+
+
+def should_delete(parsed, to_delete):
+    for column in to_delete:
+        if column["Type"] == "Simple":
+            record = get_value(column["Column"], parsed)
+            if record and record in column["MatchIds"]:
+                return True
+        else:
+            matched = []
+            for col in column["Columns"]:
+                record = get_value(col, parsed)
+                if record:
+                    matched.append(record)
+            if tuple(matched) in column["MatchIds"]:
+                return True
+    return False
+
+
+def write_json_lines_without_matches(content, writer, to_delete, prefilter, offset=0):
+    """
+    Writes the JSON lines content to the writer, skipping the lines matching
+    any of the MatchIds. Lines which can't match are copied without being
+    parsed, in runs spanning all the lines between two deleted lines. The
+    offset is the number of lines preceding the content, used in errors.
+    """
+    length = len(content)
+    total_rows = content.count(b"\n")
+    if length and not content.endswith(b"\n"):
+        total_rows += 1
     deleted_rows = 0
+    view = memoryview(content)
+    written = 0
+    for start, end in iter_candidate_lines(content, prefilter):
+        try:
+            parsed = parse_json_line(content[start:end])
+        except json.JSONDecodeError as e:
+            raise ValueError(
+                "Serialization error when parsing JSON lines: {}".format(
+                    str(e).replace(
+                        "line 1",
+                        "line {}".format(offset + content.count(b"\n", 0, start) + 1),
+                    ),
+                )
+            )
+        if should_delete(parsed, to_delete):
+            deleted_rows += 1
+            writer.write(view[written:start])
+            written = min(end + 1, length)
+    if written < length:
+        writer.write(view[written:])
+        if not content.endswith(b"\n"):
+            writer.write(b"\n")
+    return Counter({"ProcessedRows": total_rows, "DeletedRows": deleted_rows})
+
+
+def stream_matches_from_json_file(
+    input_file,
+    out_stream,
+    to_delete,
+    compressed=False,
+    compression_threads=1,
+    chunk_size=CHUNK_SIZE,
+):
+    """
+    Streams the JSON lines from the uncompressed input file to the output
+    stream without the matching lines, compressing the output with gzip when
+    compressed is set. The input is processed in chunks ending on a line
+    boundary, so that only a chunk is held in memory at any time. When more
+    than one compression thread is used, the output is compressed in parallel
+    as multiple gzip members.
+    """
+    writer = (
+        get_gzip_writer(out_stream, compression_threads) if compressed else out_stream
+    )
+    try:
+        prefilter = get_prefilter(to_delete)
+        stats = Counter({"ProcessedRows": 0, "DeletedRows": 0})
+        remainder = b""
+        while True:
+            chunk = input_file.read(chunk_size)
+            content = remainder + chunk
+            if not chunk:
+                break
+            boundary = content.rfind(b"\n") + 1
+            remainder = content[boundary:]
+            if boundary > 0:
+                stats.update(
+                    write_json_lines_without_matches(
+                        content[:boundary],
+                        writer,
+                        to_delete,
+                        prefilter,
+                        stats["ProcessedRows"],
+                    )
+                )
+        if content:
+            stats.update(
+                write_json_lines_without_matches(
+                    content, writer, to_delete, prefilter, stats["ProcessedRows"]
+                )
+            )
+    except BaseException:
+        # Workers are long lived, so the compression threads mustn't outlive the object
+        if isinstance(writer, ParallelGzipOutputStream):
+            writer.abort()
+        raise
+    if compressed:
+        writer.close()
+    return stats
+
+
+def delete_matches_from_json_file(
+    input_file, to_delete, compressed=False, compression_threads=1
+):
     with BufferOutputStream() as out_stream:
-        writer = (
-            CompressedOutputStream(out_stream, "gzip") if compressed else out_stream
+        stats = stream_matches_from_json_file(
+            input_file, out_stream, to_delete, compressed, compression_threads
         )
-        content = input_file.read().decode("utf-8")
-        total_rows = 0
-        for parsed, line in json_lines_iterator(content, include_unparsed=True):
-            total_rows += 1
-            should_delete = False
-            for column in to_delete:
-                if column["Type"] == "Simple":
-                    record = get_value(column["Column"], parsed)
-                    if record and record in column["MatchIds"]:
-                        should_delete = True
-                        break
-                else:
-                    matched = []
-                    for col in column["Columns"]:
-                        record = get_value(col, parsed)
-                        if record:
-                            matched.append(record)
-                    if tuple(matched) in column["MatchIds"]:
-                        should_delete = True
-                        break
-            if should_delete:
-                deleted_rows += 1
-            else:
-                writer.write(bytes(line + "\n", "utf-8"))
-        if compressed:
-            writer.close()
-        stats = Counter({"ProcessedRows": total_rows, "DeletedRows": deleted_rows})
         return out_stream, stats
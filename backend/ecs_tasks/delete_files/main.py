@@ -1,11 +1,16 @@
 import argparse
+import hashlib
 import json
 import os
+import pickle
 import sys
 import signal
 import time
 import logging
-from multiprocessing import cpu_count, get_context
+import tempfile
+from functools import lru_cache, partial
+from multiprocessing import cpu_count
+from collections import deque
 from operator import itemgetter
 
 import boto3
@@ -21,22 +26,57 @@ from events import (
     emit_deletion_event,
     emit_skipped_event,
 )
-from json_handler import delete_matches_from_json_file
-from parquet_handler import delete_matches_from_parquet_file
+from json_handler import delete_matches_from_json_file, stream_matches_from_json_file
+from parquet_handler import (
+    delete_matches_from_parquet_file,
+    stream_matches_from_parquet_file,
+)
 from s3 import (
+    clear_object_caches,
     delete_old_versions,
     DeleteOldVersionsError,
     fetch_manifest,
     get_object_info,
     IntegrityCheckFailedError,
+    MultipartUpload,
+    RangedObjectReader,
     rollback_object_version,
     save,
     validate_bucket_versioning,
     verify_object_versions_integrity,
 )
+from utils import run_concurrently
+from workers import WorkerPool
 
 FIVE_MB = 5 * 2**20
+DEFAULT_WORKER_MEMORY_LIMIT = 4096
+SQS_BATCH_SIZE = 10
+CGROUP_MEMORY_LIMIT_PATHS = [
+    "/sys/fs/cgroup/memory.max",
+    "/sys/fs/cgroup/memory/memory.limit_in_bytes",
+]
+# Share of the task memory which can be reserved for the workers
+MEMORY_BUDGET_RATIO = 0.8
+# Memory used by an idle worker, with PyArrow and boto3 loaded
+WORKER_BASELINE_MEMORY = 256 * 2**20
+# Peak memory of an in-memory rewrite relative to the object size. Parquet
+# objects are decoded and re-encoded whilst the source object is held
+MEMORY_ESTIMATE_FACTORS = {"json": 2, "parquet": 4}
+# Streamed objects are read in chunks or row groups rather than as a whole
+STREAMED_OBJECT_MEMORY = 512 * 2**20
+# Objects estimated to need at most this much memory above the worker
+# baseline spend most of their time waiting on S3 rather than rewriting
+IO_BOUND_OBJECT_MEMORY = 64 * 2**20
+# Workers per CPU, so that small objects wait on S3 whilst other workers use
+# the CPUs to rewrite larger objects
+WORKERS_PER_CPU = 2
 ROLE_SESSION_NAME = "s3f2"
+# Seconds the workers have to abort their uploads on shutdown, well within
+# the time ECS waits before killing the task
+SHUTDOWN_GRACE_PERIOD = 10
+# Parsed manifests are shared by the workers of a task through local storage
+MANIFEST_CACHE_DIR = os.path.join(tempfile.gettempdir(), "s3f2-manifests")
+MANIFEST_CACHE_SIZE = 8
 
 logger = logging.getLogger(__name__)
 logger.setLevel(os.getenv("LOG_LEVEL", logging.INFO))
@@ -87,11 +127,124 @@ def validate_message(message):
             raise ValueError("Malformed message. Missing key: %s", k)
 
 
-def delete_matches_from_file(input_file, to_delete, file_format, compressed=False):
+def delete_matches_from_file(
+    input_file,
+    to_delete,
+    file_format,
+    compressed=False,
+    parquet_writer_options=None,
+    compression_threads=1,
+):
+    logger.info("Generating new file without matches")
+    if file_format == "json":
+        return delete_matches_from_json_file(
+            input_file, to_delete, compressed, compression_threads
+        )
+    return delete_matches_from_parquet_file(
+        input_file, to_delete, parquet_writer_options
+    )
+
+
+def stream_matches_from_file(
+    input_file,
+    out_stream,
+    to_delete,
+    file_format,
+    compressed=False,
+    parquet_writer_options=None,
+    compression_threads=1,
+):
     logger.info("Generating new file without matches")
     if file_format == "json":
-        return delete_matches_from_json_file(input_file, to_delete, compressed)
-    return delete_matches_from_parquet_file(input_file, to_delete)
+        return stream_matches_from_json_file(
+            input_file, out_stream, to_delete, compressed, compression_threads
+        )
+    return stream_matches_from_parquet_file(
+        input_file, out_stream, to_delete, parquet_writer_options
+    )
+
+
+def get_manifest_cache_path(manifest_object):
+    """
+    Returns the local path of the parsed manifest, keyed by the manifest
+    location and ETag, or None when the manifest can't be identified.
+    """
+    client, _ = get_clients()
+    bucket, key = parse_s3_url(manifest_object)
+    try:
+        etag = client.head_object(Bucket=bucket, Key=key)["ETag"]
+    except ClientError as e:
+        logger.warning("Unable to identify manifest %s: %s", manifest_object, str(e))
+        return None
+    digest = hashlib.sha256(
+        "{}#{}".format(manifest_object, etag).encode("utf-8")
+    ).hexdigest()
+    return os.path.join(MANIFEST_CACHE_DIR, "{}.pickle".format(digest))
+
+
+def load_match_index(path):
+    try:
+        with open(path, "rb") as f:
+            return pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, EOFError, pickle.UnpicklingError) as e:
+        logger.warning("Unable to read cached manifest %s: %s", path, str(e))
+        return None
+
+
+def save_match_index(path, index):
+    """
+    Writes the parsed manifest for the other workers, replacing the file
+    atomically so that a partially written file is never read. Only the most
+    recently written manifests are kept.
+    """
+    try:
+        os.makedirs(MANIFEST_CACHE_DIR, exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+            dir=MANIFEST_CACHE_DIR, suffix=".tmp", delete=False
+        ) as f:
+            pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(f.name, path)
+        cached = sorted(
+            (e for e in os.scandir(MANIFEST_CACHE_DIR) if e.name.endswith(".pickle")),
+            key=lambda e: e.stat().st_mtime,
+            reverse=True,
+        )
+        for entry in cached[MANIFEST_CACHE_SIZE:]:
+            os.remove(entry.path)
+    except OSError as e:
+        logger.warning("Unable to cache manifest %s: %s", path, str(e))
+
+
+def parse_match_index(manifest):
+    matches = {}
+    for line in json_lines_iterator(manifest):
+        if not line["QueryableColumns"] in matches:
+            matches[line["QueryableColumns"]] = set()
+        is_simple = len(line["Columns"]) == 1
+        match = line["MatchId"][0] if is_simple else tuple(line["MatchId"])
+        matches[line["QueryableColumns"]].add(match)
+    return {k: frozenset(v) for k, v in matches.items()}
+
+
+# Workers process many objects for the same manifest, so the index is built
+# once rather than for every object
+@lru_cache(maxsize=2)
+def build_match_index(manifest_object):
+    """
+    Returns the match_ids grouped by the queryable columns they apply to,
+    parsing the manifest only when no other worker has already done so.
+    Output example:
+    {"customer_id": frozenset({123, 234})}
+    """
+    path = get_manifest_cache_path(manifest_object)
+    index = load_match_index(path) if path else None
+    if index is None:
+        index = parse_match_index(fetch_manifest(manifest_object))
+        if path:
+            save_match_index(path, index)
+    return index
 
 
 def build_matches(cols, manifest_object):
@@ -104,14 +257,7 @@ def build_matches(cols, manifest_object):
     [{"Column":"customer_id", "Type":"Simple", "MatchIds": {123, 234}}]
     """
     COMPOSITE_MATCH_TOKEN = "_S3F2COMP_"
-    manifest = fetch_manifest(manifest_object)
-    matches = {}
-    for line in json_lines_iterator(manifest):
-        if not line["QueryableColumns"] in matches:
-            matches[line["QueryableColumns"]] = set()
-        is_simple = len(line["Columns"]) == 1
-        match = line["MatchId"][0] if is_simple else tuple(line["MatchId"])
-        matches[line["QueryableColumns"]].add(match)
+    matches = build_match_index(manifest_object)
     return list(
         map(
             lambda c: {
@@ -129,7 +275,181 @@ def build_matches(cols, manifest_object):
     )
 
 
-def execute(queue_url, message_body, receipt_handle):
+@lru_cache()
+def get_clients(role_arn=None):
+    """
+    Returns the S3 and KMS clients for the given role. Clients are kept for
+    the lifetime of the worker, as assumed role credentials are refreshed
+    automatically
+    """
+    session = get_session(role_arn, ROLE_SESSION_NAME)
+    return session.client("s3"), session.client("kms")
+
+
+@lru_cache()
+def get_filesystem(role_arn=None):
+    """
+    Returns the PyArrow S3FileSystem for the given role, kept for the
+    lifetime of the worker
+    """
+    return pa.fs.S3FileSystem(
+        region=os.getenv("AWS_DEFAULT_REGION"),
+        session_name=ROLE_SESSION_NAME,
+        external_id=ROLE_SESSION_NAME,
+        role_arn=role_arn,
+        load_frequency=60 * 60,
+    )
+
+
+def rewrite_object_in_memory(
+    client, kms_client, body, to_delete, compression_threads=1
+):
+    """
+    Downloads the whole object in-memory, generates the new object version
+    in-memory and uploads it back to S3
+    """
+    object_path = body["Object"]
+    input_bucket, input_key = parse_s3_url(object_path)
+    s3 = get_filesystem(body.get("RoleArn"))
+    # Download the object in-memory and convert to PyArrow NativeFile
+    logger.info("Downloading and opening %s object in-memory", object_path)
+    with s3.open_input_stream(
+        "{}/{}".format(input_bucket, input_key),
+        buffer_size=FIVE_MB,
+    ) as f:
+        source_metadata = f.metadata()
+        source_version = source_metadata["VersionId"].decode("utf-8")
+        source_size = source_metadata["Content-Length"].decode("utf-8")
+        logger.info(
+            "Download Complete. Using object version %s as source (object size: %s)",
+            source_version,
+            source_size,
+        )
+        # Write new file in-memory
+        compressed = object_path.endswith(".gz")
+        object_info, _ = get_object_info(
+            client, input_bucket, input_key, source_version
+        )
+        metadata = object_info["Metadata"]
+        is_encrypted = is_kms_cse_encrypted(metadata)
+        input_file = decrypt(f, metadata, kms_client) if is_encrypted else f
+        out_sink, stats = delete_matches_from_file(
+            input_file,
+            to_delete,
+            body["Format"],
+            compressed,
+            body.get("ParquetWriterOptions"),
+            compression_threads,
+        )
+    if stats["DeletedRows"] == 0:
+        raise ValueError(
+            "The object {} was processed successfully but no rows required deletion".format(
+                object_path
+            )
+        )
+    with pa.BufferReader(out_sink.getvalue()) as output_buf:
+        if is_encrypted:
+            output_buf, metadata = encrypt(output_buf, metadata, kms_client)
+        logger.info("Uploading new object version to S3")
+        new_version = save(
+            client,
+            output_buf,
+            input_bucket,
+            input_key,
+            metadata,
+            source_version,
+        )
+    return source_version, new_version, stats
+
+
+def rewrite_object_streaming(
+    client, body, object_info, to_delete, compression_threads=1
+):
+    """
+    Reads the object with ranged GETs pinned to its current version and
+    streams the new object version to S3 as a multipart upload, so that
+    neither the source nor the new object version is ever fully held in
+    memory
+    """
+    object_path = body["Object"]
+    input_bucket, input_key = parse_s3_url(object_path)
+    source_version = object_info["VersionId"]
+    logger.info(
+        "Streaming %s using object version %s as source (object size: %s)",
+        object_path,
+        source_version,
+        object_info["ContentLength"],
+    )
+    object_info_args, _ = get_object_info(
+        client, input_bucket, input_key, source_version
+    )
+    reader = RangedObjectReader(
+        client, input_bucket, input_key, source_version, object_info["ContentLength"]
+    )
+    upload = MultipartUpload(
+        client,
+        input_bucket,
+        input_key,
+        object_info_args["Metadata"],
+        source_version,
+        expected_size=object_info["ContentLength"],
+    )
+    compressed = object_path.endswith(".gz")
+    try:
+        if body["Format"] == "json":
+            # Buffer the ranged GETs and decompress the object on the fly
+            input_file = pa.input_stream(
+                pa.PythonFile(reader, mode="r"),
+                compression="gzip" if compressed else None,
+                buffer_size=FIVE_MB,
+            )
+        else:
+            input_file = pa.PythonFile(reader, mode="r")
+        stats = stream_matches_from_file(
+            input_file,
+            pa.PythonFile(upload, mode="w"),
+            to_delete,
+            body["Format"],
+            compressed,
+            body.get("ParquetWriterOptions"),
+            compression_threads,
+        )
+        if stats["DeletedRows"] == 0:
+            raise ValueError(
+                "The object {} was processed successfully but no rows required deletion".format(
+                    object_path
+                )
+            )
+        logger.info("Completing upload of new object version to S3")
+        new_version = upload.complete()
+    except BaseException:
+        # Including the SystemExit raised when the worker is shut down, so
+        # that no incomplete multipart upload is left behind
+        upload.abort()
+        raise
+    return source_version, new_version, stats
+
+
+def get_streamable_object_info(client, object_path):
+    """
+    Returns the HeadObject response for the current object version if the
+    object can be streamed, None otherwise. Only unencrypted objects can be
+    streamed, as client-side encryption requires the whole object
+    """
+    input_bucket, input_key = parse_s3_url(object_path)
+    _, object_info = get_object_info(client, input_bucket, input_key)
+    if is_kms_cse_encrypted(object_info["Metadata"]):
+        return None
+    return object_info
+
+
+def execute(
+    queue_url,
+    message_body,
+    receipt_handle,
+    stream_objects=False,
+    compression_threads=1,
+):
     logger.info("Message received")
     queue = get_queue(queue_url)
     msg = queue.Message(receipt_handle)
@@ -137,65 +457,29 @@ def execute(queue_url, message_body, receipt_handle):
         # Parse and validate incoming message
         validate_message(message_body)
         body = json.loads(message_body)
-        session = get_session(body.get("RoleArn"), ROLE_SESSION_NAME)
         ignore_not_found_exceptions = body.get("IgnoreObjectNotFoundExceptions", False)
-        client = session.client("s3")
-        kms_client = session.client("kms")
+        client, kms_client = get_clients(body.get("RoleArn"))
         cols, object_path, job_id, file_format, manifest_object = itemgetter(
             "Columns", "Object", "JobId", "Format", "Manifest"
         )(body)
         input_bucket, input_key = parse_s3_url(object_path)
-        validate_bucket_versioning(client, input_bucket)
-        match_ids = build_matches(cols, manifest_object)
-        s3 = pa.fs.S3FileSystem(
-            region=os.getenv("AWS_DEFAULT_REGION"),
-            session_name=ROLE_SESSION_NAME,
-            external_id=ROLE_SESSION_NAME,
-            role_arn=body.get("RoleArn"),
-            load_frequency=60 * 60,
+        # The versioning check, manifest download and object HEAD are independent
+        _, match_ids, object_info = run_concurrently(
+            partial(validate_bucket_versioning, client, input_bucket),
+            partial(build_matches, cols, manifest_object),
+            (
+                partial(get_streamable_object_info, client, object_path)
+                if stream_objects
+                else lambda: None
+            ),
         )
-        # Download the object in-memory and convert to PyArrow NativeFile
-        logger.info("Downloading and opening %s object in-memory", object_path)
-        with s3.open_input_stream(
-            "{}/{}".format(input_bucket, input_key),
-            buffer_size=FIVE_MB,
-        ) as f:
-            source_metadata = f.metadata()
-            source_version = source_metadata["VersionId"].decode("utf-8")
-            source_size = source_metadata["Content-Length"].decode("utf-8")
-            logger.info(
-                "Download Complete. Using object version %s as source (object size: %s)",
-                source_version,
-                source_size,
-            )
-            # Write new file in-memory
-            compressed = object_path.endswith(".gz")
-            object_info, _ = get_object_info(
-                client, input_bucket, input_key, source_version
+        if object_info:
+            source_version, new_version, stats = rewrite_object_streaming(
+                client, body, object_info, match_ids, compression_threads
             )
-            metadata = object_info["Metadata"]
-            is_encrypted = is_kms_cse_encrypted(metadata)
-            input_file = decrypt(f, metadata, kms_client) if is_encrypted else f
-            out_sink, stats = delete_matches_from_file(
-                input_file, match_ids, file_format, compressed
-            )
-        if stats["DeletedRows"] == 0:
-            raise ValueError(
-                "The object {} was processed successfully but no rows required deletion".format(
-                    object_path
-                )
-            )
-        with pa.BufferReader(out_sink.getvalue()) as output_buf:
-            if is_encrypted:
-                output_buf, metadata = encrypt(output_buf, metadata, kms_client)
-            logger.info("Uploading new object version to S3")
-            new_version = save(
-                client,
-                output_buf,
-                input_bucket,
-                input_key,
-                metadata,
-                source_version,
+        else:
+            source_version, new_version, stats = rewrite_object_in_memory(
+                client, kms_client, body, match_ids, compression_threads
             )
         logger.info("New object version: %s", new_version)
         verify_object_versions_integrity(
@@ -265,14 +549,84 @@ def execute(queue_url, message_body, receipt_handle):
         handle_error(msg, message_body, err_message)
 
 
+def init_worker():
+    """
+    Exits the worker gracefully when the pool is terminated, so that any
+    in-flight multipart upload is aborted
+    """
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(1))
+
+
+def execute_in_worker(task, **kwargs):
+    """
+    Entrypoint for the pool workers, which are reused across messages
+    """
+    queue_url, message_body, receipt_handle = task
+    try:
+        execute(queue_url, message_body, receipt_handle, **kwargs)
+    finally:
+        # Lookups for an object mustn't outlive its message, as it has been rewritten
+        clear_object_caches()
+        # Return the memory freed by PyArrow, so that the worker memory
+        # reflects what it still holds
+        pa.default_memory_pool().release_unused()
+
+
+def get_memory_limit():
+    """
+    Returns the memory available to the task in bytes, which is the cgroup
+    limit of the container when one is set
+    """
+    physical = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    for path in CGROUP_MEMORY_LIMIT_PATHS:
+        try:
+            with open(path) as f:
+                limit = f.read().strip()
+        except OSError:
+            continue
+        if limit.isdigit():
+            return min(int(limit), physical)
+    return physical
+
+
+def estimate_memory(message_body, stream_objects=False):
+    """
+    Estimates the peak memory in bytes a worker needs to process a message,
+    from the size of the object to rewrite. Messages which can't be
+    estimated, for instance because the object can't be found, count as the
+    worker baseline, as the worker will handle the error
+    """
+    try:
+        body = json.loads(message_body)
+        client, _ = get_clients(body.get("RoleArn"))
+        input_bucket, input_key = parse_s3_url(body["Object"])
+        # Bypass the cache, as the current object version changes on rewrite
+        _, object_info = get_object_info.__wrapped__(client, input_bucket, input_key)
+        factor = MEMORY_ESTIMATE_FACTORS.get(body.get("Format"), 1)
+        estimate = object_info["ContentLength"] * factor
+        if stream_objects and not is_kms_cse_encrypted(object_info["Metadata"]):
+            estimate = min(estimate, STREAMED_OBJECT_MEMORY)
+    except Exception as e:
+        logger.debug("Unable to estimate memory for message: %s", str(e))
+        return WORKER_BASELINE_MEMORY
+    return WORKER_BASELINE_MEMORY + estimate
+
+
+def release_message(msg, err_message):
+    """
+    Makes a message which can't be processed by this task visible again
+    """
+    try:
+        handle_error(msg, msg.body, err_message)
+    except (ClientError, ValueError) as e:
+        logger.error("Unable to gracefully cleanup message: %s", str(e))
+
+
 def kill_handler(msgs, process_pool):
     logger.info("Received shutdown signal. Cleaning up %s messages", str(len(msgs)))
-    process_pool.terminate()
+    process_pool.terminate(SHUTDOWN_GRACE_PERIOD)
     for msg in msgs:
-        try:
-            handle_error(msg, msg.body, "SIGINT/SIGTERM received during processing")
-        except (ClientError, ValueError) as e:
-            logger.error("Unable to gracefully cleanup message: %s", str(e))
+        release_message(msg, "SIGINT/SIGTERM received during processing")
     sys.exit(1 if len(msgs) > 0 else 0)
 
 
@@ -285,25 +639,135 @@ def get_queue(queue_url, **resource_kwargs):
     return sqs.Queue(queue_url)
 
 
-def main(queue_url, max_messages, wait_time, sleep_time):
+def extend_visibility(queue, messages, visibility_timeout):
+    """
+    Extends the visibility timeout of the in-flight messages, so that long
+    running objects aren't redelivered to another task whilst being processed
+    """
+    messages = list(messages)
+    for i in range(0, len(messages), SQS_BATCH_SIZE):
+        entries = [
+            {
+                "Id": str(j),
+                "ReceiptHandle": m.receipt_handle,
+                "VisibilityTimeout": visibility_timeout,
+            }
+            for j, m in enumerate(messages[i : i + SQS_BATCH_SIZE])
+        ]
+        try:
+            resp = queue.change_message_visibility_batch(Entries=entries)
+            for failed in resp.get("Failed", []):
+                logger.warning(
+                    "Unable to extend message visibility: %s", failed.get("Message")
+                )
+        except ClientError as e:
+            logger.warning("Unable to extend message visibility: %s", str(e))
+
+
+def main(
+    queue_url,
+    max_messages,
+    wait_time,
+    sleep_time,
+    stream_objects=False,
+    compression_threads=1,
+    worker_memory_limit=DEFAULT_WORKER_MEMORY_LIMIT,
+    visibility_timeout=None,
+):
     logger.info("CPU count for system: %s", cpu_count())
-    messages = []
+    cpus = cpu_count()
+    workers = cpus * WORKERS_PER_CPU
+    memory_budget = int(get_memory_limit() * MEMORY_BUDGET_RATIO)
+    logger.info("Memory available to workers: %s MB", memory_budget // 2**20)
+    # Messages received and not yet processed, including the ones prefetched
+    # whilst all the workers are busy or the memory budget is exhausted
+    in_flight = {}
+    # Received messages waiting to be admitted, with their estimated memory
+    pending = deque()
+    # Estimated memory of the messages being processed by the workers
+    reserved = {}
     queue = get_queue(queue_url)
-    with get_context("spawn").Pool(maxtasksperchild=1) as pool:
-        signal.signal(signal.SIGINT, lambda *_: kill_handler(messages, pool))
-        signal.signal(signal.SIGTERM, lambda *_: kill_handler(messages, pool))
+    if visibility_timeout is None:
+        visibility_timeout = int(queue.attributes["VisibilityTimeout"])
+    worker_fn = partial(
+        execute_in_worker,
+        stream_objects=stream_objects,
+        compression_threads=compression_threads,
+    )
+    pool = WorkerPool(workers, worker_fn, worker_memory_limit, init_worker)
+    signal.signal(
+        signal.SIGINT, lambda *_: kill_handler(list(in_flight.values()), pool)
+    )
+    signal.signal(
+        signal.SIGTERM, lambda *_: kill_handler(list(in_flight.values()), pool)
+    )
+
+    def is_cpu_bound(estimate):
+        return estimate > WORKER_BASELINE_MEMORY + IO_BOUND_OBJECT_MEMORY
+
+    def dispatch():
+        # Admit messages in order whilst a worker is idle and their estimated
+        # memory fits within the budget. A message is always admitted when
+        # nothing else is running, even if it exceeds the budget. Only one
+        # large object per CPU is processed at a time, and small objects
+        # may overtake a large one waiting for a CPU
+        for m, estimate in list(pending):
+            if not pool.idle:
+                break
+            if is_cpu_bound(estimate) and (
+                sum(map(is_cpu_bound, reserved.values())) >= cpus
+            ):
+                continue
+            if reserved and sum(reserved.values()) + estimate > memory_budget:
+                break
+            pending.remove((m, estimate))
+            reserved[m.receipt_handle] = estimate
+            pool.submit((queue_url, m.body, m.receipt_handle))
+
+    last_heartbeat = time.monotonic()
+    try:
         while 1:
+            # Wait for a worker to complete if there's no room for more
+            # messages, or if received messages are waiting to be admitted
+            capacity = workers + max_messages - len(in_flight)
+            completed, lost = pool.wait(wait_time if capacity <= 0 or pending else 0)
+            for _, _, receipt_handle in completed:
+                in_flight.pop(receipt_handle, None)
+                reserved.pop(receipt_handle, None)
+            for _, _, receipt_handle in lost:
+                # Stop extending the message and make it visible again
+                reserved.pop(receipt_handle, None)
+                msg = in_flight.pop(receipt_handle, None)
+                if msg:
+                    release_message(msg, "Worker exited during processing")
+            if time.monotonic() - last_heartbeat >= visibility_timeout / 3:
+                extend_visibility(queue, in_flight.values(), visibility_timeout)
+                last_heartbeat = time.monotonic()
+            dispatch()
+            # Keep up to a batch of messages ready for the next idle worker
+            capacity = workers + max_messages - len(in_flight)
+            if capacity <= 0:
+                continue
             logger.info("Fetching messages...")
+            # Don't long poll whilst messages are waiting, as a worker may
+            # complete in the meantime
             messages = queue.receive_messages(
-                WaitTimeSeconds=wait_time, MaxNumberOfMessages=max_messages
+                WaitTimeSeconds=0 if pending else wait_time,
+                MaxNumberOfMessages=min(max_messages, capacity, SQS_BATCH_SIZE),
+                VisibilityTimeout=visibility_timeout,
             )
-            if len(messages) == 0:
+            if len(messages) == 0 and not in_flight:
                 logger.info("No messages. Sleeping")
                 time.sleep(sleep_time)
-            else:
-                processes = [(queue_url, m.body, m.receipt_handle) for m in messages]
-                pool.starmap(execute, processes)
-                messages = []
+            estimates = run_concurrently(
+                *[partial(estimate_memory, m.body, stream_objects) for m in messages]
+            )
+            for m, estimate in zip(messages, estimates):
+                in_flight[m.receipt_handle] = m
+                pending.append((m, estimate))
+            dispatch()
+    finally:
+        pool.terminate(SHUTDOWN_GRACE_PERIOD)
 
 
 def parse_args(args):
@@ -316,9 +780,34 @@ def parse_args(args):
     parser.add_argument(
         "--queue_url", type=str, default=os.getenv("DELETE_OBJECTS_QUEUE")
     )
+    parser.add_argument(
+        "--stream_objects",
+        action="store_true",
+        default=os.getenv("STREAM_OBJECTS", "false").lower() == "true",
+    )
+    parser.add_argument(
+        "--compression_threads",
+        type=int,
+        default=int(os.getenv("COMPRESSION_THREADS", 1)),
+    )
+    parser.add_argument(
+        "--worker_memory_limit",
+        type=int,
+        default=int(os.getenv("WORKER_MEMORY_LIMIT", DEFAULT_WORKER_MEMORY_LIMIT)),
+    )
+    parser.add_argument("--visibility_timeout", type=int, default=None)
     return parser.parse_args(args)
 
 
 if __name__ == "__main__":
     opts = parse_args(sys.argv[1:])
-    main(opts.queue_url, opts.max_messages, opts.wait_time, opts.sleep_time)
+    main(
+        opts.queue_url,
+        opts.max_messages,
+        opts.wait_time,
+        opts.sleep_time,
+        opts.stream_objects,
+        opts.compression_threads,
+        opts.worker_memory_limit,
+        opts.visibility_timeout,
+    )
@@ -7,6 +7,7 @@ from io import BytesIO
 
 import numpy as np
 import pyarrow as pa
+import pyarrow.compute as pc
 import pyarrow.parquet as pq
 
 logger = logging.getLogger(__name__)
@@ -16,6 +17,18 @@ handler = logging.StreamHandler(stream=sys.stdout)
 handler.setFormatter(formatter)
 logger.addHandler(handler)
 
+# Parquet codecs which can be written by pyarrow
+PARQUET_CODECS = {
+    "BROTLI": "BROTLI",
+    "GZIP": "GZIP",
+    "LZ4": "LZ4",
+    "LZ4_RAW": "LZ4",
+    "SNAPPY": "SNAPPY",
+    "UNCOMPRESSED": "NONE",
+    "ZSTD": "ZSTD",
+}
+PARQUET_VERSIONS = ["1.0", "2.4", "2.6"]
+
 
 def load_parquet(f):
     return pq.ParquetFile(BytesIO(f.read()), memory_map=False)
@@ -60,7 +73,7 @@ def get_row_indexes_to_delete_for_composite(table, identifiers, to_delete):
                 current = current[next_segment]
             values_array.append(current)
         indexes.append(tuple(values_array) in to_delete)
-    return np.array(indexes)
+    return np.array(indexes, dtype=bool)
 
 
 def get_row_indexes_to_delete(table, identifier, to_delete):
@@ -78,7 +91,105 @@ def get_row_indexes_to_delete(table, identifier, to_delete):
             next_segment = case_insensitive_getter(list(current.keys()), segments[i])
             current = current[next_segment]
         indexes.append(current in to_delete)
-    return np.array(indexes)
+    return np.array(indexes, dtype=bool)
+
+
+def get_column(table, identifier):
+    """
+    Resolves a simple or complex column identifier to an Arrow array
+    without converting any value to Python objects. Nested segments are
+    extracted from struct columns using the same case insensitive
+    matching as case_insensitive_getter.
+    """
+    segments = identifier.split(".")
+    column_identifier = case_insensitive_getter(table.column_names, segments[0])
+    column = table.column(column_identifier)
+    for segment in segments[1:]:
+        if not pa.types.is_struct(column.type):
+            raise pa.ArrowNotImplementedError(
+                "Unable to extract {} from type {}".format(segment, column.type)
+            )
+        field_names = [column.type.field(i).name for i in range(column.type.num_fields)]
+        field_name = case_insensitive_getter(field_names, segment)
+        column = pc.struct_field(column, [field_names.index(field_name)])
+    if pa.types.is_dictionary(column.type):
+        column = column.cast(column.type.value_type)
+    return column
+
+
+def build_value_set(to_delete, value_type):
+    """
+    Converts the MatchIds to an Arrow array of the given type. Conversions
+    which would alter a value (for instance truncating 1.5 to an integer or
+    encoding a string to binary) are rejected so that vectorized matching
+    is equivalent to the Python equality check.
+    """
+    match_ids = list(to_delete)
+    try:
+        value_set = pa.array(match_ids, type=value_type)
+    except OverflowError as e:
+        # Raised for integers outside the range of the column type
+        raise pa.ArrowInvalid(
+            "MatchIds cannot be represented as {}: {}".format(value_type, e)
+        )
+    if value_set.to_pylist() != match_ids:
+        raise pa.ArrowInvalid("MatchIds cannot be represented as {}".format(value_type))
+    return value_set
+
+
+def get_row_mask_to_delete(table, identifier, to_delete):
+    """
+    Returns an Arrow boolean mask identifying the rows to delete, computed
+    with pyarrow.compute.is_in over the resolved column. Column types or
+    MatchIds which cannot be handled natively by Arrow fall back to
+    get_row_indexes_to_delete.
+    """
+    try:
+        column = get_column(table, identifier)
+        value_set = build_value_set(to_delete, column.type)
+        return pc.fill_null(pc.is_in(column, value_set=value_set), False)
+    except (pa.ArrowInvalid, pa.ArrowNotImplementedError, pa.ArrowTypeError) as e:
+        logger.debug("Falling back to row by row matching for %s: %s", identifier, e)
+        return pa.array(
+            get_row_indexes_to_delete(table, identifier, to_delete), type=pa.bool_()
+        )
+
+
+def get_composite_row_mask_to_delete(table, identifiers, to_delete):
+    """
+    Returns an Arrow boolean mask identifying the rows to delete for a
+    group of columns. The MatchIds are loaded into an Arrow table with a
+    column per identifier and matched against the resolved columns with
+    a left semi hash join. Column types or MatchIds which cannot be
+    handled natively by Arrow fall back to
+    get_row_indexes_to_delete_for_composite.
+    """
+    try:
+        columns = [get_column(table, identifier) for identifier in identifiers]
+        match_ids = list(to_delete)
+        keys = ["key_{}".format(i) for i in range(len(identifiers))]
+        matches = pa.table(
+            {
+                key: build_value_set([m[i] for m in match_ids], columns[i].type)
+                for i, key in enumerate(keys)
+            }
+        )
+        rows = pa.table(
+            {
+                **dict(zip(keys, columns)),
+                "row_index": pa.array(np.arange(table.num_rows, dtype=np.int64)),
+            }
+        )
+        matched = rows.join(matches, keys=keys, join_type="left semi")
+        indexes = np.zeros(table.num_rows, dtype=bool)
+        indexes[matched.column("row_index").to_numpy()] = True
+        return pa.array(indexes, type=pa.bool_())
+    except (pa.ArrowInvalid, pa.ArrowNotImplementedError, pa.ArrowTypeError) as e:
+        logger.debug("Falling back to row by row matching for %s: %s", identifiers, e)
+        return pa.array(
+            get_row_indexes_to_delete_for_composite(table, identifiers, to_delete),
+            type=pa.bool_(),
+        )
 
 
 def find_column(tree, column_name):
@@ -130,48 +241,238 @@ def cast_column_values(column, schema):
     return column
 
 
-def delete_from_table(table, to_delete):
+def get_rows_to_delete(table, to_delete):
     """
-    Deletes rows from a Arrow Table where any of the MatchIds is found as
-    value in any of the columns
+    Returns an Arrow boolean mask identifying the rows of an Arrow Table
+    where any of the MatchIds is found as value in any of the columns. The
+    table only needs to contain the columns referenced by to_delete.
     """
-    initial_rows = table.num_rows
+    mask = pa.array(np.zeros(table.num_rows, dtype=bool))
     for column in to_delete:
         column = cast_column_values(column, table.schema)
         indexes = (
-            get_row_indexes_to_delete(table, column["Column"], column["MatchIds"])
+            get_row_mask_to_delete(table, column["Column"], column["MatchIds"])
             if column["Type"] == "Simple"
-            else get_row_indexes_to_delete_for_composite(
+            else get_composite_row_mask_to_delete(
                 table, column["Columns"], column["MatchIds"]
             )
         )
-        table = table.filter(~indexes)
-        if not table.num_rows:
-            break
+        mask = pc.or_(mask, indexes)
+    return mask
+
+
+def delete_from_table(table, to_delete):
+    """
+    Deletes rows from a Arrow Table where any of the MatchIds is found as
+    value in any of the columns
+    """
+    initial_rows = table.num_rows
+    table = table.filter(pc.invert(get_rows_to_delete(table, to_delete)))
     deleted_rows = initial_rows - table.num_rows
     return table, deleted_rows
 
 
-def delete_matches_from_parquet_file(input_file, to_delete):
+def get_row_group_statistics(row_group_metadata):
+    """
+    Returns the min/max statistics of each column chunk of a row group,
+    keyed by lower cased column path. Nested columns are keyed by their
+    dotted path, for instance "user.info.id". Column chunks without min/max
+    statistics are omitted.
+    """
+    statistics = {}
+    for i in range(row_group_metadata.num_columns):
+        column_chunk = row_group_metadata.column(i)
+        if column_chunk.is_stats_set and column_chunk.statistics.has_min_max:
+            statistics[column_chunk.path_in_schema.lower()] = (
+                column_chunk.statistics.min,
+                column_chunk.statistics.max,
+            )
+    return statistics
+
+
+def is_in_range(statistics, identifier, value):
+    """
+    Checks whether a value falls within the min/max statistics of the column.
+    Returns True whenever the statistics cannot rule the value out, such as
+    when they are missing or not comparable with the value.
+    """
+    column_range = statistics.get(identifier.lower())
+    if not column_range:
+        return True
+    try:
+        return column_range[0] <= value <= column_range[1]
+    except TypeError:
+        return True
+
+
+def may_contain_matches(statistics, column):
+    """
+    Uses row group statistics to check whether any MatchId of the column
+    can be found in the row group
+    """
+    if column["Type"] == "Simple":
+        return any(
+            is_in_range(statistics, column["Column"], match_id)
+            for match_id in column["MatchIds"]
+        )
+    return any(
+        all(
+            is_in_range(statistics, identifier, match_id[i])
+            for i, identifier in enumerate(column["Columns"])
+        )
+        for match_id in column["MatchIds"]
+    )
+
+
+def get_columns_to_evaluate(row_group_metadata, to_delete):
+    """
+    Returns the subset of to_delete for which the row group statistics
+    don't exclude every MatchId
+    """
+    statistics = get_row_group_statistics(row_group_metadata)
+    return [column for column in to_delete if may_contain_matches(statistics, column)]
+
+
+def get_writer_properties(parquet_file, writer_options=None):
+    """
+    Infers the ParquetWriter properties from the source file metadata, so
+    that the rewritten file keeps the codecs, dictionary usage, statistics,
+    format version and row group sizes of the original. Properties set in
+    the data mapper ParquetWriterOptions take precedence over the inferred
+    ones. Returns a tuple containing the ParquetWriter kwargs and the row
+    group size to use, where None means the source row group size.
+    """
+    writer_options = writer_options or {}
+    metadata = parquet_file.metadata
+    properties = {}
+    if metadata.format_version in PARQUET_VERSIONS:
+        properties["version"] = metadata.format_version
+    if metadata.num_row_groups > 0:
+        compression = {}
+        use_dictionary = []
+        write_statistics = []
+        row_group_metadata = metadata.row_group(0)
+        for i in range(row_group_metadata.num_columns):
+            column_chunk = row_group_metadata.column(i)
+            path = column_chunk.path_in_schema
+            if column_chunk.compression in PARQUET_CODECS:
+                compression[path] = PARQUET_CODECS[column_chunk.compression]
+            if column_chunk.has_dictionary_page:
+                use_dictionary.append(path)
+            if column_chunk.is_stats_set:
+                write_statistics.append(path)
+        properties["compression"] = compression
+        properties["use_dictionary"] = use_dictionary
+        properties["write_statistics"] = write_statistics
+    if "Compression" in writer_options:
+        properties["compression"] = writer_options["Compression"]
+    if "UseDictionary" in writer_options:
+        properties["use_dictionary"] = writer_options["UseDictionary"]
+    if "WriteStatistics" in writer_options:
+        properties["write_statistics"] = writer_options["WriteStatistics"]
+    if "DataPageVersion" in writer_options:
+        properties["data_page_version"] = writer_options["DataPageVersion"]
+    return properties, writer_options.get("RowGroupSize")
+
+
+def delete_matches_from_parquet_file(input_file, to_delete, writer_options=None):
     """
     Deletes matches from Parquet file where to_delete is a list of dicts where
     each dict contains a column to search and the MatchIds to search for in
     that particular column
     """
     parquet_file = load_parquet(input_file)
+    with pa.BufferOutputStream() as out_stream:
+        stats = write_parquet_file_without_matches(
+            parquet_file, out_stream, to_delete, writer_options
+        )
+        return out_stream, stats
+
+
+def stream_matches_from_parquet_file(
+    input_file, out_stream, to_delete, writer_options=None
+):
+    """
+    Streaming variant of delete_matches_from_parquet_file. The input file
+    must be seekable: the footer is read first and then row groups are
+    read one at a time, each being written to out_stream as soon as it has
+    been processed, so that memory usage is bounded by the row group size
+    rather than the object size.
+    """
+    parquet_file = pq.ParquetFile(input_file, memory_map=False, pre_buffer=True)
+    return write_parquet_file_without_matches(
+        parquet_file, out_stream, to_delete, writer_options
+    )
+
+
+def get_identifier_columns(schema, to_delete):
+    """
+    Returns the top level columns required to evaluate to_delete
+    """
+    identifiers = set()
+    for column in to_delete:
+        for identifier in (
+            [column["Column"]] if column["Type"] == "Simple" else column["Columns"]
+        ):
+            identifiers.add(
+                case_insensitive_getter(schema.names, identifier.split(".")[0])
+            )
+    return sorted(identifiers)
+
+
+def get_row_group_masks(parquet_file, to_delete):
+    """
+    Match detection pass which only reads the identifier columns of each row
+    group. Returns a list containing, for each row group, either the mask of
+    the rows to delete or None if the row group contains no matches.
+    """
+    identifier_columns = get_identifier_columns(parquet_file.schema_arrow, to_delete)
+    masks = []
+    for row_group in range(parquet_file.num_row_groups):
+        columns = get_columns_to_evaluate(
+            parquet_file.metadata.row_group(row_group), to_delete
+        )
+        if not columns:
+            logger.info(
+                "Row group %s/%s statistics exclude all matches",
+                str(row_group + 1),
+                str(parquet_file.num_row_groups),
+            )
+            masks.append(None)
+            continue
+        table = parquet_file.read_row_group(row_group, columns=identifier_columns)
+        mask = get_rows_to_delete(table, columns)
+        masks.append(mask if pc.any(mask).as_py() else None)
+    return masks
+
+
+def write_parquet_file_without_matches(
+    parquet_file, out_stream, to_delete, writer_options=None
+):
     schema = parquet_file.metadata.schema.to_arrow_schema().remove_metadata()
     total_rows = parquet_file.metadata.num_rows
     stats = Counter({"ProcessedRows": total_rows, "DeletedRows": 0})
-    with pa.BufferOutputStream() as out_stream:
-        with pq.ParquetWriter(out_stream, schema) as writer:
-            for row_group in range(parquet_file.num_row_groups):
-                logger.info(
-                    "Row group %s/%s",
-                    str(row_group + 1),
-                    str(parquet_file.num_row_groups),
-                )
-                table = parquet_file.read_row_group(row_group)
-                table, deleted_rows = delete_from_table(table, to_delete)
-                writer.write_table(table)
-                stats.update({"DeletedRows": deleted_rows})
-        return out_stream, stats
+    # MatchIds are cast upfront so that they can be compared with statistics
+    to_delete = [cast_column_values(column, schema) for column in to_delete]
+    masks = get_row_group_masks(parquet_file, to_delete)
+    if not any(mask is not None for mask in masks):
+        logger.info("No matches found in any row group")
+        return stats
+    properties, row_group_size = get_writer_properties(parquet_file, writer_options)
+    logger.info("Writer properties: %s", properties)
+    with pq.ParquetWriter(out_stream, schema, **properties) as writer:
+        for row_group, mask in enumerate(masks):
+            logger.info(
+                "Row group %s/%s",
+                str(row_group + 1),
+                str(parquet_file.num_row_groups),
+            )
+            table = parquet_file.read_row_group(row_group)
+            source_rows = table.num_rows
+            if mask is not None:
+                table = table.filter(pc.invert(mask))
+                stats.update({"DeletedRows": source_rows - table.num_rows})
+            writer.write_table(
+                table, row_group_size=row_group_size or max(source_rows, 1)
+            )
+    return stats
@@ -1,7 +1,8 @@
 import logging
 import os
 import sys
-from functools import lru_cache
+from functools import lru_cache, partial
+from io import SEEK_CUR, SEEK_END, SEEK_SET
 from urllib.parse import urlencode, quote_plus
 from tenacity import (
     retry,
@@ -14,14 +15,14 @@ from tenacity import (
 from boto_utils import fetch_job_manifest, paginate
 from botocore.exceptions import ClientError
 
-from utils import remove_none, retry_wrapper
-
+from utils import remove_none, retry_wrapper, run_concurrently
 
 # BEGINNING OF s3transfer MONKEY PATCH
 # https://github.com/boto/s3transfer/issues/82#issuecomment-837971614
 
 import s3transfer.upload
 import s3transfer.tasks
+from s3transfer.utils import ChunksizeAdjuster, S3_RETRYABLE_DOWNLOAD_ERRORS
 
 
 class PutObjectTask(s3transfer.tasks.Task):
@@ -57,16 +58,49 @@ handler = logging.StreamHandler(stream=sys.stdout)
 handler.setFormatter(formatter)
 logger.addHandler(handler)
 
+# Same as the boto3 TransferConfig default multipart_chunksize
+MULTIPART_CHUNK_SIZE = 8 * 2**20
+# Error codes returned by S3 for requests which may succeed when retried
+S3_TRANSIENT_ERROR_CODES = {
+    "InternalError",
+    "RequestTimeout",
+    "ServiceUnavailable",
+    "SlowDown",
+    "Throttling",
+    "ThrottlingException",
+}
 
-def save(client, buf, bucket, key, metadata, source_version=None):
+
+def is_transient_error(e):
     """
-    Save a buffer to S3, preserving any existing properties on the object
+    Returns True for dropped connections, throttling and server side errors,
+    False for errors which won't change on retry, e.g. AccessDenied or
+    NoSuchKey
+    """
+    if not isinstance(e, ClientError):
+        return True
+    status = e.response.get("ResponseMetadata", {}).get("HTTPStatusCode", 0)
+    return status >= 500 or e.response["Error"]["Code"] in S3_TRANSIENT_ERROR_CODES
+
+
+def get_object_settings(client, bucket, key, metadata, source_version=None):
+    """
+    Generates the args required to write an object back to S3, preserving
+    any existing properties on the object
+    :returns tuple containing the ExtraArgs, the request payer args, the ACL
+    args and the raw ACL response
     """
-    # Get Object Settings
     request_payer_args, _ = get_requester_payment(client, bucket)
-    object_info_args, _ = get_object_info(client, bucket, key, source_version)
-    tagging_args, _ = get_object_tags(client, bucket, key, source_version)
-    acl_args, acl_resp = get_object_acl(client, bucket, key, source_version)
+    # The remaining lookups are independent from each other
+    (
+        (object_info_args, _),
+        (tagging_args, _),
+        (acl_args, acl_resp),
+    ) = run_concurrently(
+        partial(get_object_info, client, bucket, key, source_version),
+        partial(get_object_tags, client, bucket, key, source_version),
+        partial(get_object_acl, client, bucket, key, source_version),
+    )
     extra_args = {
         **request_payer_args,
         **object_info_args,
@@ -75,29 +109,241 @@ def save(client, buf, bucket, key, metadata, source_version=None):
         **{"Metadata": metadata},
     }
     logger.info("Object settings: %s", extra_args)
-    # Write Object Back to S3
-    logger.info("Saving updated object to s3://%s/%s", bucket, key)
-    resp = client.upload_fileobj(buf, bucket, key, ExtraArgs=extra_args)
-    new_version_id = resp["VersionId"]
-    logger.info("Object uploaded to S3")
-    # GrantWrite cannot be set whilst uploading therefore ACLs need to be restored separately
+    return extra_args, request_payer_args, acl_args, acl_resp
+
+
+def restore_write_grants(
+    client, bucket, key, version_id, request_payer_args, acl_args, acl_resp
+):
+    """
+    GrantWrite cannot be set whilst uploading therefore ACLs need to be restored separately
+    """
     write_grantees = ",".join(get_grantees(acl_resp, "WRITE"))
     if write_grantees:
         logger.info("WRITE grant found. Restoring additional grantees for object")
         client.put_object_acl(
             Bucket=bucket,
             Key=key,
-            VersionId=new_version_id,
+            VersionId=version_id,
             **{
                 **request_payer_args,
                 **acl_args,
                 "GrantWrite": write_grantees,
             },
         )
+
+
+def save(client, buf, bucket, key, metadata, source_version=None):
+    """
+    Save a buffer to S3, preserving any existing properties on the object
+    """
+    extra_args, request_payer_args, acl_args, acl_resp = get_object_settings(
+        client, bucket, key, metadata, source_version
+    )
+    # Write Object Back to S3
+    logger.info("Saving updated object to s3://%s/%s", bucket, key)
+    resp = client.upload_fileobj(buf, bucket, key, ExtraArgs=extra_args)
+    new_version_id = resp["VersionId"]
+    logger.info("Object uploaded to S3")
+    restore_write_grants(
+        client, bucket, key, new_version_id, request_payer_args, acl_args, acl_resp
+    )
     logger.info("Processing of file s3://%s/%s complete", bucket, key)
     return new_version_id
 
 
+class RangedObjectReader:
+    """
+    Read-only, seekable file-like object for a given S3 object version.
+    Each read is served by a ranged GetObject call, so that only the
+    requested bytes are ever held in memory.
+    """
+
+    def __init__(self, client, bucket, key, version_id, size):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.version_id = version_id
+        self.size = size
+        self.closed = False
+        self._position = 0
+        self._request_payer_args, _ = get_requester_payment(client, bucket)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def writable(self):
+        return False
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=SEEK_SET):
+        if whence == SEEK_CUR:
+            offset += self._position
+        elif whence == SEEK_END:
+            offset += self.size
+        self._position = max(0, offset)
+        return self._position
+
+    def read(self, size=-1):
+        end = self.size if size is None or size < 0 else self._position + size
+        end = min(end, self.size)
+        if end <= self._position:
+            return b""
+        # Connections dropped whilst reading the body are retried as well
+        data = retry_wrapper(
+            self._get_range,
+            exceptions=(ClientError,) + S3_RETRYABLE_DOWNLOAD_ERRORS,
+            retry_if=is_transient_error,
+        )(self._position, end)
+        self._position += len(data)
+        return data
+
+    def _get_range(self, start, end):
+        resp = self.client.get_object(
+            Bucket=self.bucket,
+            Key=self.key,
+            VersionId=self.version_id,
+            Range="bytes={}-{}".format(start, end - 1),
+            **self._request_payer_args,
+        )
+        return resp["Body"].read()
+
+    def close(self):
+        self.closed = True
+
+
+class MultipartUpload:
+    """
+    Write-only file-like object which uploads its content to S3 as the
+    parts of a multipart upload, preserving any existing properties on the
+    object. At most one part is held in memory at any time. The upload is
+    only visible once complete() has been called, and can be discarded with
+    abort(). When the expected size is known, the part size is increased as
+    needed to stay within the S3 limit of 10,000 parts.
+    """
+
+    def __init__(
+        self,
+        client,
+        bucket,
+        key,
+        metadata,
+        source_version=None,
+        part_size=MULTIPART_CHUNK_SIZE,
+        expected_size=None,
+    ):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = (
+            ChunksizeAdjuster().adjust_chunksize(part_size, expected_size)
+            if expected_size
+            else part_size
+        )
+        self.closed = False
+        (
+            extra_args,
+            self._request_payer_args,
+            self._acl_args,
+            self._acl_resp,
+        ) = get_object_settings(client, bucket, key, metadata, source_version)
+        logger.info("Starting multipart upload to s3://%s/%s", bucket, key)
+        self.upload_id = client.create_multipart_upload(
+            Bucket=bucket, Key=key, **extra_args
+        )["UploadId"]
+        self._parts = []
+        self._buffer = bytearray()
+        self._position = 0
+
+    def readable(self):
+        return False
+
+    def seekable(self):
+        return False
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def write(self, data):
+        self._buffer += data
+        self._position += len(data)
+        while len(self._buffer) >= self.part_size:
+            self._upload_part(bytes(self._buffer[: self.part_size]))
+            del self._buffer[: self.part_size]
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def _upload_part(self, body):
+        part_number = len(self._parts) + 1
+        resp = retry_wrapper(self.client.upload_part)(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.upload_id,
+            PartNumber=part_number,
+            Body=body,
+            **self._request_payer_args,
+        )
+        self._parts.append({"ETag": resp["ETag"], "PartNumber": part_number})
+
+    def complete(self):
+        """
+        Uploads any remaining data and completes the multipart upload
+        :returns the VersionId of the new object version
+        """
+        if self._buffer or not self._parts:
+            self._upload_part(bytes(self._buffer))
+            self._buffer = bytearray()
+        resp = self.client.complete_multipart_upload(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.upload_id,
+            MultipartUpload={"Parts": self._parts},
+            **self._request_payer_args,
+        )
+        new_version_id = resp["VersionId"]
+        logger.info("Object uploaded to S3")
+        restore_write_grants(
+            self.client,
+            self.bucket,
+            self.key,
+            new_version_id,
+            self._request_payer_args,
+            self._acl_args,
+            self._acl_resp,
+        )
+        self.closed = True
+        logger.info("Processing of file s3://%s/%s complete", self.bucket, self.key)
+        return new_version_id
+
+    def abort(self):
+        """
+        Discards the multipart upload and any part uploaded so far
+        """
+        self.closed = True
+        try:
+            self.client.abort_multipart_upload(
+                Bucket=self.bucket,
+                Key=self.key,
+                UploadId=self.upload_id,
+                **self._request_payer_args,
+            )
+        except ClientError as e:
+            logger.error("Unable to abort multipart upload: %s", str(e))
+
+
 @lru_cache()
 def get_requester_payment(client, bucket):
     """
@@ -221,6 +467,22 @@ def get_grantees(acl, grant_type):
     return grantees
 
 
+def clear_object_caches():
+    """
+    Clears the cached lookups for individual objects, which are only valid
+    until the object is rewritten, along with the bucket settings which are
+    checked again for each object
+    """
+    for fn in [
+        get_object_info,
+        get_object_tags,
+        get_object_acl,
+        get_requester_payment,
+        validate_bucket_versioning,
+    ]:
+        fn.cache_clear()
+
+
 @lru_cache()
 def validate_bucket_versioning(client, bucket):
     resp = client.get_bucket_versioning(Bucket=bucket)
@@ -236,7 +498,6 @@ def validate_bucket_versioning(client, bucket):
     return True
 
 
-@lru_cache()
 def fetch_manifest(manifest_object):
     return fetch_job_manifest(manifest_object)
 
@@ -1,13 +1,38 @@
 import time
+from concurrent.futures import ThreadPoolExecutor
 from botocore.exceptions import ClientError
 
+# Shared by the independent network calls made whilst processing an object
+IO_THREADS = 8
+io_executor = ThreadPoolExecutor(max_workers=IO_THREADS)
+
 
 def remove_none(d: dict):
     return {k: v for k, v in d.items() if v is not None and v != ""}
 
 
-def retry_wrapper(fn, retry_wait_seconds=2, retry_factor=2, max_retries=5):
-    """Exponential back-off retry wrapper for ClientError exceptions"""
+def run_concurrently(*fns):
+    """
+    Runs the given callables concurrently and returns their results in order.
+    If any of the callables fails, the first failure in order is raised.
+    """
+    futures = [io_executor.submit(fn) for fn in fns]
+    return [future.result() for future in futures]
+
+
+def retry_wrapper(
+    fn,
+    retry_wait_seconds=2,
+    retry_factor=2,
+    max_retries=5,
+    exceptions=(ClientError,),
+    retry_if=None,
+):
+    """
+    Exponential back-off retry wrapper for ClientError or the given exceptions.
+    When retry_if is given, only the exceptions for which it returns True are
+    retried and the others are raised immediately
+    """
 
     def wrapper(*args, **kwargs):
         retry_current = 0
@@ -16,8 +41,10 @@ def retry_wrapper(fn, retry_wait_seconds=2, retry_factor=2, max_retries=5):
         while retry_current <= max_retries:
             try:
                 return fn(*args, **kwargs)
-            except ClientError as e:
+            except exceptions as e:
                 nonlocal retry_wait_seconds
+                if retry_if and not retry_if(e):
+                    raise
                 if retry_current == max_retries:
                     break
                 last_error = e
@@ -0,0 +1,164 @@
+import logging
+import os
+import resource
+import sys
+import time
+from multiprocessing import get_context
+from multiprocessing.connection import wait
+
+logger = logging.getLogger(__name__)
+logger.setLevel(os.getenv("LOG_LEVEL", logging.INFO))
+formatter = logging.Formatter("[%(levelname)s] PID:%(process)d> %(message)s")
+handler = logging.StreamHandler(stream=sys.stdout)
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+
+
+def get_current_memory():
+    """
+    Returns the resident memory of the current process in MB, falling back
+    to its peak memory where the resident memory isn't available
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            resident_pages = int(f.read().split()[1])
+        return resident_pages * os.sysconf("SC_PAGE_SIZE") // 2**20
+    except (OSError, ValueError, IndexError):
+        # ru_maxrss is reported in KB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024
+
+
+def worker_loop(conn, fn, initializer, memory_limit):
+    """
+    Runs the tasks received on the connection until the connection is
+    closed, notifying the pool as each one completes. The worker exits once
+    its memory stays above the limit after a task, so that it can be replaced
+    """
+    if initializer:
+        initializer()
+    while 1:
+        try:
+            task = conn.recv()
+        except EOFError:
+            return
+        try:
+            fn(task)
+        except Exception as e:
+            logger.error("Worker failed to process task: %s", str(e))
+        retire = get_current_memory() > memory_limit
+        conn.send(retire)
+        if retire:
+            return
+
+
+class WorkerPool:
+    """
+    Pool of worker processes running one task at a time. Unlike
+    multiprocessing.Pool, a worker whose memory grows above the limit is
+    replaced on its own, whilst the other workers keep running their tasks,
+    and a worker exiting without completing its task, e.g. when killed for
+    running out of memory, is reported rather than waited on forever
+    """
+
+    def __init__(self, size, fn, memory_limit, initializer=None, context=None):
+        self.fn = fn
+        self.memory_limit = memory_limit
+        self.initializer = initializer
+        self.context = context or get_context("spawn")
+        self._idle = [self._start_worker() for _ in range(size)]
+        # Connection of each busy worker to its process and task
+        self._busy = {}
+        self._retired = []
+
+    def _start_worker(self):
+        conn, child_conn = self.context.Pipe()
+        process = self.context.Process(
+            target=worker_loop,
+            args=(child_conn, self.fn, self.initializer, self.memory_limit),
+            daemon=True,
+        )
+        process.start()
+        child_conn.close()
+        return conn, process
+
+    @property
+    def idle(self):
+        return len(self._idle)
+
+    @property
+    def busy(self):
+        return len(self._busy)
+
+    def _replace_lost_worker(self, conn, process):
+        conn.close()
+        process.join()
+        logger.error(
+            "Worker %s exited unexpectedly with code %s",
+            process.pid,
+            process.exitcode,
+        )
+        self._idle.append(self._start_worker())
+
+    def submit(self, task):
+        while 1:
+            conn, process = self._idle.pop()
+            try:
+                conn.send(task)
+                break
+            except OSError:
+                # The idle worker has exited
+                self._replace_lost_worker(conn, process)
+        self._busy[conn] = (process, task)
+
+    def wait(self, timeout=None):
+        """
+        Waits up to timeout seconds for any busy worker to complete its task
+        :returns tuple containing the list of completed tasks and the list of
+        tasks whose worker exited before completing them
+        """
+        completed = []
+        lost = []
+        for conn in wait(list(self._busy), timeout):
+            process, task = self._busy.pop(conn)
+            try:
+                retire = conn.recv()
+            except (EOFError, OSError):
+                lost.append(task)
+                self._replace_lost_worker(conn, process)
+                continue
+            completed.append(task)
+            if retire:
+                logger.info(
+                    "Worker memory above %s MB. Replacing worker %s",
+                    self.memory_limit,
+                    process.pid,
+                )
+                conn.close()
+                self._retired.append(process)
+                self._idle.append(self._start_worker())
+            else:
+                self._idle.append((conn, process))
+        # Reap the retired workers which have exited
+        self._retired = [p for p in self._retired if p.is_alive()]
+        return completed, lost
+
+    def terminate(self, grace_period=None):
+        """
+        Stops the workers, killing the ones which haven't exited within the
+        grace period, e.g. whilst in a long running call to a C extension
+        """
+        processes = [p for _, p in self._idle]
+        processes += [p for p, _ in self._busy.values()]
+        processes += self._retired
+        for process in processes:
+            process.terminate()
+        deadline = None if grace_period is None else time.monotonic() + grace_period
+        for process in processes:
+            if deadline is None:
+                process.join()
+                continue
+            process.join(max(0, deadline - time.monotonic()))
+            if process.is_alive():
+                logger.warning("Killing worker %s", process.pid)
+                process.kill()
+                process.join()
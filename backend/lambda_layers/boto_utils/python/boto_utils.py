@@ -1,9 +1,12 @@
 from datetime import datetime, timezone, timedelta
 import decimal
+import gzip
 import logging
 import json
 import os
+import time
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 from functools import lru_cache, reduce
 
 import boto3
@@ -16,6 +19,11 @@ deserializer = TypeDeserializer()
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 batch_size = 10  # SQS Max Batch Size
+batch_bytes = 256 * 1024  # SQS Max Batch Payload
+# Bounded by the default connection pool size of boto3 clients
+sqs_send_threads = 8
+sqs_send_attempts = 3
+sqs_executor = ThreadPoolExecutor(max_workers=sqs_send_threads)
 
 s3 = boto3.resource("s3")
 ssm = boto3.client("ssm")
@@ -85,22 +93,68 @@ def read_queue(queue, number_to_read=10):
 
 
 def batch_sqs_msgs(queue, messages, **kwargs):
-    chunks = [messages[x : x + batch_size] for x in range(0, len(messages), batch_size)]
-    for chunk in chunks:
-        entries = [
+    """
+    Sends the messages in batches of up to 10 messages and 256 KB, with the
+    batches sent concurrently. Messages which fail to be sent for reasons
+    other than the message itself are retried, and an error is raised if any
+    message couldn't be sent.
+    """
+    is_fifo = queue.attributes.get("FifoQueue", False)
+    batches = []
+    batch = []
+    size = 0
+    for m in messages:
+        body = json.dumps(m)
+        body_size = len(body.encode("utf-8"))
+        if len(batch) == batch_size or (batch and size + body_size > batch_bytes):
+            batches.append(batch)
+            batch = []
+            size = 0
+        batch.append(
             {
                 "Id": str(uuid.uuid4()),
-                "MessageBody": json.dumps(m),
-                **(
-                    {"MessageGroupId": str(uuid.uuid4())}
-                    if queue.attributes.get("FifoQueue", False)
-                    else {}
-                ),
+                "MessageBody": body,
+                **({"MessageGroupId": str(uuid.uuid4())} if is_fifo else {}),
                 **kwargs,
             }
-            for m in chunk
-        ]
-        queue.send_messages(Entries=entries)
+        )
+        size += body_size
+    if batch:
+        batches.append(batch)
+    failed = []
+    for result in sqs_executor.map(lambda b: send_sqs_batch(queue, b), batches):
+        failed.extend(result)
+    if failed:
+        raise ValueError(
+            "Unable to send {} messages to the queue: {}".format(
+                len(failed),
+                ", ".join(sorted({f.get("Code", "Unknown") for f in failed})),
+            )
+        )
+
+
+def send_sqs_batch(queue, entries):
+    """
+    Sends the entries, retrying those which failed due to the service, and
+    returns the failures for the entries which couldn't be sent.
+    """
+    failed = []
+    for attempt in range(sqs_send_attempts):
+        if attempt > 0:
+            time.sleep(0.1 * 2**attempt)
+        # boto3 resources aren't thread safe, unlike their clients
+        resp = queue.meta.client.send_message_batch(QueueUrl=queue.url, Entries=entries)
+        retryable = []
+        for failure in resp.get("Failed", []):
+            if failure.get("SenderFault", False):
+                failed.append(failure)
+            else:
+                retryable.append(failure)
+        retry_ids = {f["Id"] for f in retryable}
+        entries = [e for e in entries if e["Id"] in retry_ids]
+        if not entries:
+            return failed
+    return failed + retryable
 
 
 def emit_event(job_id, event_name, event_data, emitter_id=None, created_at=None):
@@ -245,7 +299,10 @@ def get_session(assume_role_arn=None, role_session_name="s3f2"):
 
 def fetch_job_manifest(path):
     bucket, obj = parse_s3_url(path)
-    return s3.Object(bucket, obj).get().get("Body").read().decode("utf-8")
+    body = s3.Object(bucket, obj).get().get("Body").read()
+    if obj.endswith(".gz"):
+        body = gzip.decompress(body)
+    return body.decode("utf-8")
 
 
 def json_lines_iterator(content, include_unparsed=False):
@@ -88,6 +88,8 @@ def put_data_mapper_handler(event, context):
             "IgnoreObjectNotFoundExceptions", False
         ),
     }
+    if body.get("ParquetWriterOptions"):
+        item["ParquetWriterOptions"] = body["ParquetWriterOptions"]
     table.put_item(Item=item)
 
     return {"statusCode": 201, "body": json.dumps(item)}
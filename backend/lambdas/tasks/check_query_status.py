@@ -1,3 +1,5 @@
+import math
+
 import boto3
 
 from decorators import with_logging
@@ -23,5 +25,23 @@ def handler(event, context):
         "Statistics": execution_details["Statistics"],
         "ExecutionRetriesLeft": execution_retries_left,
     }
+    if "MaxWaitDuration" in event:
+        result["WaitDuration"] = get_wait_duration(
+            execution_details["Statistics"], event["MaxWaitDuration"]
+        )
 
     return result
+
+
+def get_wait_duration(statistics, max_wait_duration):
+    """
+    Waits for half of the time the query has been running, so that short
+    queries are checked again quickly whilst long running queries are checked
+    progressively less often, up to the configured wait. Queries without an
+    execution time, e.g. whilst queued, wait for the configured wait.
+    """
+    elapsed_millis = statistics.get("TotalExecutionTimeInMillis", 0)
+    if not elapsed_millis:
+        return int(max_wait_duration)
+    elapsed_seconds = elapsed_millis / 1000
+    return max(1, min(math.ceil(elapsed_seconds / 2), int(max_wait_duration)))
@@ -74,6 +74,8 @@ def make_query(query_data):
       ],
       "PartitionKeys": [{"Key":"k", "Value":"val"}]
     }
+    A query can instead cover several partitions, where the query data
+    contains "Partitions": [[{"Key":"k", "Value":"val1"}], ...]
     """
     distinct_template = """SELECT DISTINCT "$path" FROM ({column_unions})"""
     single_column_template = """
@@ -101,6 +103,10 @@ def make_query(query_data):
             key=escape_column(partition["Key"]),
             value=escape_item(partition["Value"]),
         )
+    if query_data.get("Partitions"):
+        partition_filters += " AND ({}) ".format(
+            make_partitions_filter(query_data["Partitions"])
+        )
 
     column_unions = ""
     for i, col in enumerate(columns):
@@ -137,6 +143,29 @@ def make_query(query_data):
     return distinct_template.format(column_unions=column_unions)
 
 
+def make_partitions_filter(partitions):
+    """
+    Returns a filter matching any of the partitions, e.g.
+    "k" IN ('val1', 'val2') for a single partition key or
+    ("a" = 1 AND "b" = 'x') OR ("a" = 2 AND "b" = 'y') for multiple keys
+    """
+    keys = [p["Key"] for p in partitions[0]]
+    if len(keys) == 1:
+        return "{key} IN ({values})".format(
+            key=escape_column(keys[0]),
+            values=", ".join(str(escape_item(p[0]["Value"])) for p in partitions),
+        )
+    return " OR ".join(
+        "({})".format(
+            " AND ".join(
+                "{} = {}".format(escape_column(k["Key"]), escape_item(k["Value"]))
+                for k in partition
+            )
+        )
+        for partition in partitions
+    )
+
+
 def escape_column(item):
     return '"{}"'.format(item.replace('"', '""').replace(".", '"."'))
 
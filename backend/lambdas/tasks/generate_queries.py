@@ -6,6 +6,10 @@ import json
 import os
 import boto3
 
+from concurrent.futures import ThreadPoolExecutor
+from gzip import GzipFile
+from io import BytesIO
+
 from operator import itemgetter
 from boto_utils import paginate, batch_sqs_msgs, deserialize_item, DecimalEncoder
 from decorators import with_logging
@@ -13,7 +17,7 @@ from decorators import with_logging
 ddb = boto3.resource("dynamodb")
 ddb_client = boto3.client("dynamodb")
 glue_client = boto3.client("glue")
-s3 = boto3.resource("s3")
+s3_client = boto3.client("s3")
 sqs = boto3.resource("sqs")
 
 queue = sqs.Queue(os.getenv("QueryQueue"))
@@ -25,7 +29,20 @@ glue_db = os.getenv("GlueDatabase", "s3f2_manifests_database")
 glue_table = os.getenv("JobManifestsGlueTable", "s3f2_manifests_table")
 
 COMPOSITE_JOIN_TOKEN = "_S3F2COMP_"
-MANIFEST_KEY = "manifests/{job_id}/{data_mapper_id}/manifest.json"
+MANIFEST_KEY = "manifests/{job_id}/{data_mapper_id}/manifest.json.gz"
+# Data mappers planned concurrently, each making its own Glue, S3 and SQS calls
+PLANNING_THREADS = 8
+# Partitions are grouped into fewer queries for tables with many partitions,
+# by default so that a data mapper has no more queries than Athena can run
+# concurrently. A query has at most this many partitions, keeping the query
+# string small
+MAX_QUERIES_PER_DATA_MAPPER = 100
+MAX_PARTITIONS_PER_QUERY = 100
+# Compressed bytes buffered before being uploaded as a multipart upload part
+MANIFEST_PART_SIZE = 8 * 2**20
+# Compresses about twice as fast as the default level 9, for output less than
+# 1% larger
+MANIFEST_COMPRESSION_LEVEL = 6
 
 COMPOSITE_JOIN_TOKEN = "_S3F2COMP_"
 
@@ -54,21 +71,31 @@ ALLOWED_TYPES = [
 def handler(event, context):
     job_id = event["ExecutionName"]
     deletion_items = get_deletion_queue()
-    manifests_partitions = []
-    data_mappers = get_data_mappers()
-    total_queries = 0
+    max_queries = int(event.get("AthenaConcurrencyLimit", MAX_QUERIES_PER_DATA_MAPPER))
+    data_mappers = list(get_data_mappers())
     for data_mapper in data_mappers:
         query_executor = data_mapper["QueryExecutor"]
-        if query_executor == "athena":
-            queries = generate_athena_queries(data_mapper, deletion_items, job_id)
-            if len(queries) > 0:
-                manifests_partitions.append([job_id, data_mapper["DataMapperId"]])
-        else:
+        if query_executor != "athena":
             raise NotImplementedError(
                 "Unsupported data mapper query executor: '{}'".format(query_executor)
             )
-
-        batch_sqs_msgs(queue, queries)
+    # Only the boto3 clients are shared by the planning threads, as boto3
+    # resources aren't thread safe
+    with ThreadPoolExecutor(max_workers=PLANNING_THREADS) as executor:
+        planned = list(
+            executor.map(
+                lambda data_mapper: generate_athena_queries(
+                    data_mapper, deletion_items, job_id, max_queries
+                ),
+                data_mappers,
+            )
+        )
+    batch_sqs_msgs(queue, [query for queries in planned for query in queries])
+    manifests_partitions = []
+    total_queries = 0
+    for data_mapper, queries in zip(data_mappers, planned):
+        if len(queries) > 0:
+            manifests_partitions.append([job_id, data_mapper["DataMapperId"]])
         total_queries += len(queries)
     write_partitions(manifests_partitions)
     return {
@@ -127,7 +154,72 @@ def build_manifest_row(columns, match_id, item_id, item_createdat, is_composite)
     )
 
 
-def generate_athena_queries(data_mapper, deletion_items, job_id):
+class ManifestWriter:
+    """
+    Streams the manifest rows to S3 gzip compressed, uploading them as the
+    parts of a multipart upload so that at most a part is held in memory.
+    Manifests smaller than a part are uploaded with a single request.
+    """
+
+    def __init__(self, client, bucket, key, part_size=MANIFEST_PART_SIZE):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.buffer = BytesIO()
+        self.compressor = GzipFile(
+            fileobj=self.buffer, mode="wb", compresslevel=MANIFEST_COMPRESSION_LEVEL
+        )
+        self.upload_id = None
+        self.parts = []
+
+    def write(self, row):
+        self.compressor.write(row.encode("utf-8"))
+        if self.buffer.tell() >= self.part_size:
+            self._upload_part()
+
+    def close(self):
+        self.compressor.close()
+        if self.upload_id is None:
+            self.client.put_object(
+                Bucket=self.bucket, Key=self.key, Body=self.buffer.getvalue()
+            )
+            return
+        self._upload_part()
+        self.client.complete_multipart_upload(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.upload_id,
+            MultipartUpload={"Parts": self.parts},
+        )
+
+    def abort(self):
+        if self.upload_id is not None:
+            self.client.abort_multipart_upload(
+                Bucket=self.bucket, Key=self.key, UploadId=self.upload_id
+            )
+
+    def _upload_part(self):
+        if self.upload_id is None:
+            self.upload_id = self.client.create_multipart_upload(
+                Bucket=self.bucket, Key=self.key
+            )["UploadId"]
+        part_number = len(self.parts) + 1
+        resp = self.client.upload_part(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.upload_id,
+            PartNumber=part_number,
+            Body=self.buffer.getvalue(),
+        )
+        self.parts.append({"ETag": resp["ETag"], "PartNumber": part_number})
+        self.buffer.seek(0)
+        self.buffer.truncate()
+
+
+def generate_athena_queries(
+    data_mapper, deletion_items, job_id, max_queries=MAX_QUERIES_PER_DATA_MAPPER
+):
     """
     For each Data Mapper, it generates a list of parameters needed for each
     query execution. The matches for the given column are saved in an external
@@ -141,7 +233,16 @@ def generate_athena_queries(data_mapper, deletion_items, job_id):
     db = data_mapper["QueryExecutorParameters"]["Database"]
     table_name = data_mapper["QueryExecutorParameters"]["Table"]
     table = get_table(db, table_name)
-    columns_tree = get_columns_tree(table)
+    injected_partition_keys = get_injected_partition_keys(table)
+    if injected_partition_keys:
+        # Athena only queries tables with injected partition keys when every
+        # query filters them to known values, which isn't the case for the
+        # queries finding the objects to delete from
+        raise ValueError(
+            "Table {} uses injected partition projection for {}, which is "
+            "not supported".format(table_name, ", ".join(injected_partition_keys))
+        )
+    cast = get_caster(table_name, index_columns(get_columns_tree(table)))
     all_partition_keys = [p["Name"] for p in table.get("PartitionKeys", [])]
     partition_keys = data_mapper["QueryExecutorParameters"].get(
         "PartitionKeys", all_partition_keys
@@ -162,6 +263,11 @@ def generate_athena_queries(data_mapper, deletion_items, job_id):
     }
     if data_mapper.get("RoleArn", None):
         msg["RoleArn"] = data_mapper["RoleArn"]
+    if data_mapper.get("ParquetWriterOptions", None):
+        writer_options = dict(data_mapper["ParquetWriterOptions"])
+        if "RowGroupSize" in writer_options:
+            writer_options["RowGroupSize"] = int(writer_options["RowGroupSize"])
+        msg["ParquetWriterOptions"] = writer_options
 
     # Workout which deletion items should be included in this query
     applicable_match_ids = [
@@ -175,56 +281,70 @@ def generate_athena_queries(data_mapper, deletion_items, job_id):
 
     # Compile a list of MatchIds grouped by Column
     columns_with_matches = {}
-    manifest = ""
-    for item in applicable_match_ids:
-        mid, item_id, item_createdat = itemgetter(
-            "MatchId", "DeletionQueueItemId", "CreatedAt"
-        )(item)
-        is_simple = not isinstance(mid, list)
-        try:
-            if is_simple:
-                for column in msg["Columns"]:
-                    casted = cast_to_type(mid, column, table_name, columns_tree)
-                    if column not in columns_with_matches:
-                        columns_with_matches[column] = {
-                            "Column": column,
-                            "Type": "Simple",
-                        }
-                    manifest += build_manifest_row(
-                        [column], casted, item_id, item_createdat, False
+    # Manifests are gzip compressed to reduce the data scanned by Athena
+    manifest = ManifestWriter(s3_client, manifests_bucket_name, manifest_key)
+    try:
+        for item in applicable_match_ids:
+            mid, item_id, item_createdat = itemgetter(
+                "MatchId", "DeletionQueueItemId", "CreatedAt"
+            )(item)
+            is_simple = not isinstance(mid, list)
+            try:
+                if is_simple:
+                    for column in msg["Columns"]:
+                        casted = cast(mid, column)
+                        if column not in columns_with_matches:
+                            columns_with_matches[column] = {
+                                "Column": column,
+                                "Type": "Simple",
+                            }
+                        manifest.write(
+                            build_manifest_row(
+                                [column], casted, item_id, item_createdat, False
+                            )
+                        )
+                else:
+                    sorted_mid = sorted(mid, key=lambda x: x["Column"])
+                    query_columns = list(map(lambda x: x["Column"], sorted_mid))
+                    column_key = COMPOSITE_JOIN_TOKEN.join(query_columns)
+                    composite_match = list(
+                        map(
+                            lambda x: cast(x["Value"], x["Column"]),
+                            sorted_mid,
+                        )
                     )
-            else:
-                sorted_mid = sorted(mid, key=lambda x: x["Column"])
-                query_columns = list(map(lambda x: x["Column"], sorted_mid))
-                column_key = COMPOSITE_JOIN_TOKEN.join(query_columns)
-                composite_match = list(
-                    map(
-                        lambda x: cast_to_type(
-                            x["Value"], x["Column"], table_name, columns_tree
-                        ),
-                        sorted_mid,
+                    if column_key not in columns_with_matches:
+                        columns_with_matches[column_key] = {
+                            "Columns": query_columns,
+                            "Type": "Composite",
+                        }
+                    manifest.write(
+                        build_manifest_row(
+                            query_columns,
+                            composite_match,
+                            item_id,
+                            item_createdat,
+                            True,
+                        )
                     )
+            except MatchIdCastingError as e:
+                col, col_type = e.args
+                err_message = "Invalid match ID (DeletionQueueItemId:'{}') on Data Mapper '{}'. Casting failed: expected type for column '{}': '{}'".format(
+                    item_id, data_mapper["DataMapperId"], col, col_type
                 )
-                if column_key not in columns_with_matches:
-                    columns_with_matches[column_key] = {
-                        "Columns": query_columns,
-                        "Type": "Composite",
-                    }
-                manifest += build_manifest_row(
-                    query_columns, composite_match, item_id, item_createdat, True
-                )
-        except MatchIdCastingError as e:
-            col, col_type = e.args
-            err_message = "Invalid match ID (DeletionQueueItemId:'{}') on Data Mapper '{}'. Casting failed: expected type for column '{}': '{}'".format(
-                item_id, data_mapper["DataMapperId"], col, col_type
-            )
-            raise ValueError(err_message)
-
-    s3.Bucket(manifests_bucket_name).put_object(Body=manifest, Key=manifest_key)
+                raise ValueError(err_message)
+        manifest.close()
+    except BaseException:
+        # No incomplete multipart upload is left behind, including when the
+        # last part or the completion of the upload fails
+        manifest.abort()
+        raise
     msg["Columns"] = list(columns_with_matches.values())
     msg["Manifest"] = "s3://{}/{}".format(manifests_bucket_name, manifest_key)
 
-    if len(partition_keys) == 0:
+    if len(partition_keys) == 0 or is_partition_projection_enabled(table):
+        # Athena computes the partitions of tables using partition projection,
+        # so they aren't stored in the Glue catalog to be enumerated
         return [msg]
 
     # For every partition combo of every table, create a query
@@ -233,19 +353,53 @@ def generate_athena_queries(data_mapper, deletion_items, job_id):
         current = tuple(
             (
                 all_partition_keys[i],
-                cast_to_type(v, all_partition_keys[i], table_name, columns_tree),
+                cast(v, all_partition_keys[i]),
             )
             for i, v in enumerate(partition["Values"])
             if all_partition_keys[i] in partition_keys
         )
         partitions.add(current)
     ret = []
-    for current in partitions:
-        current_dict = [{"Key": k, "Value": v} for k, v in current]
-        ret.append({**msg, "PartitionKeys": current_dict})
+    for batch in batch_partitions(sorted(partitions), max_queries):
+        batch_dicts = [[{"Key": k, "Value": v} for k, v in p] for p in batch]
+        if len(batch_dicts) == 1:
+            ret.append({**msg, "PartitionKeys": batch_dicts[0]})
+        else:
+            ret.append({**msg, "Partitions": batch_dicts})
     return ret
 
 
+def batch_partitions(partitions, max_queries):
+    """
+    Splits the partitions into batches, each queried by a single query.
+    Partitions get a query each unless the data mapper would exceed
+    max_queries queries, in which case sorted partitions (e.g. consecutive
+    dates) are grouped, up to MAX_PARTITIONS_PER_QUERY each.
+    """
+    batch_size = min(
+        max(-(-len(partitions) // max(max_queries, 1)), 1),
+        MAX_PARTITIONS_PER_QUERY,
+    )
+    return [
+        partitions[i : i + batch_size] for i in range(0, len(partitions), batch_size)
+    ]
+
+
+def is_partition_projection_enabled(table):
+    return table.get("Parameters", {}).get("projection.enabled", "").lower() == "true"
+
+
+def get_injected_partition_keys(table):
+    if not is_partition_projection_enabled(table):
+        return []
+    params = table.get("Parameters", {})
+    return [
+        p["Name"]
+        for p in table.get("PartitionKeys", [])
+        if params.get("projection.{}.type".format(p["Name"]), "").lower() == "injected"
+    ]
+
+
 def get_deletion_queue():
     results = paginate(
         ddb_client, ddb_client.scan, "Items", TableName=deletion_queue_table_name
@@ -314,7 +468,7 @@ def write_partitions(partitions):
                         ),
                         "InputFormat": "org.apache.hadoop.mapred.TextInputFormat",
                         "OutputFormat": "org.apache.hadoop.hive.ql.io.HiveIgnoreKeyTextOutputFormat",
-                        "Compressed": False,
+                        "Compressed": True,
                         "SerdeInfo": {
                             "SerializationLibrary": "org.openx.data.jsonserde.JsonSerDe",
                         },
@@ -492,8 +646,53 @@ def get_column_info(col, columns_tree):
     return found["Type"], found["CanBeIdentifier"]
 
 
+def index_columns(columns_tree, prefix=""):
+    """
+    Function to map the path of every column, including the nested ones,
+    to its type and whether it can be used as an identifier
+    Example:
+    [{ name: "user", type: "struct", children: [
+        { name: "id", type: "int", canBeIdentifier: true }
+    ], canBeIdentifier: false}] =>
+    {"user": ("struct", False), "user.id": ("int", True)}
+    """
+    index = {}
+    for node in columns_tree:
+        path = prefix + node["Name"]
+        if path in index:
+            # Consistent with get_column_info, the first column found is used
+            continue
+        index[path] = (node["Type"], node["CanBeIdentifier"])
+        for k, v in index_columns(node.get("Children", []), path + ".").items():
+            index.setdefault(k, v)
+    return index
+
+
+def get_caster(table_name, columns_index):
+    """
+    Returns a function casting values to the type of a column of the table.
+    Queues commonly contain the same values many times, and partition values
+    repeat across partitions, so each distinct value is only cast once.
+    """
+    casted = {}
+
+    def cast(val, col):
+        key = (col, type(val), val)
+        if key not in casted:
+            casted[key] = cast_to_column_type(
+                val, col, table_name, columns_index.get(col, (None, False))
+            )
+        return casted[key]
+
+    return cast
+
+
 def cast_to_type(val, col, table_name, columns_tree):
-    col_type, can_be_identifier = get_column_info(col, columns_tree)
+    return cast_to_column_type(val, col, table_name, get_column_info(col, columns_tree))
+
+
+def cast_to_column_type(val, col, table_name, column_info):
+    col_type, can_be_identifier = column_info
     if not col_type:
         raise ValueError("Column {} not found at table {}".format(col, table_name))
     elif not can_be_identifier:
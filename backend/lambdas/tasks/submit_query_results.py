@@ -2,14 +2,20 @@
 Submits results from Athena queries to the Fargate deletion queue
 """
 
+import codecs
+import csv
+import logging
 import os
 
 import boto3
+from botocore.exceptions import ClientError
 
 from decorators import with_logging
-from boto_utils import paginate, batch_sqs_msgs
+from boto_utils import paginate, batch_sqs_msgs, parse_s3_url
 
+logger = logging.getLogger()
 athena = boto3.client("athena")
+s3 = boto3.resource("s3")
 sqs = boto3.resource("sqs")
 queue = sqs.Queue(os.getenv("QueueUrl"))
 
@@ -19,11 +25,73 @@ MSG_BATCH_SIZE = 500
 @with_logging
 def handler(event, context):
     query_id = event["QueryId"]
+    results = get_results_object(query_id)
+    paths = get_paths_from_object(*results) if results else get_paths_from_api(query_id)
+    messages = []
+    msg_count = 0
+    for path in paths:
+        msg_count += 1
+        msg = {
+            "JobId": event["JobId"],
+            "Object": path,
+            "Columns": event["Columns"],
+            "RoleArn": event.get("RoleArn", None),
+            "DeleteOldVersions": event.get("DeleteOldVersions", True),
+            "IgnoreObjectNotFoundExceptions": event.get(
+                "IgnoreObjectNotFoundExceptions", False
+            ),
+            "Format": event.get("Format"),
+            "Manifest": event.get("Manifest"),
+            "ParquetWriterOptions": event.get("ParquetWriterOptions"),
+        }
+        messages.append({k: v for k, v in msg.items() if v is not None})
+
+        if len(messages) >= MSG_BATCH_SIZE:
+            batch_sqs_msgs(queue, messages)
+            messages = []
+
+    if len(messages) > 0:
+        batch_sqs_msgs(queue, messages)
+
+    return msg_count
+
+
+def get_results_object(query_id):
+    """
+    Opens the CSV file Athena wrote the query results to and reads its header
+    row, which quotes every value so paths containing commas or line breaks
+    are read correctly. Returns a tuple containing the CSV reader of the
+    remaining rows and the index of the $path column, or None where the
+    results can't be read, e.g. when the workgroup writes the results to a
+    bucket other than the solution's results bucket.
+    """
+    try:
+        location = athena.get_query_execution(QueryExecutionId=query_id)[
+            "QueryExecution"
+        ]["ResultConfiguration"]["OutputLocation"]
+        bucket, key = parse_s3_url(location)
+        body = s3.Object(bucket, key).get()["Body"]
+        reader = csv.reader(codecs.getreader("utf-8")(body))
+        header = next(reader, [])
+        return reader, header.index("$path")
+    except (ClientError, KeyError, ValueError, csv.Error) as e:
+        logger.warning(
+            "Unable to read results of query %s from S3, using the Athena API: %s",
+            query_id,
+            str(e),
+        )
+        return None
+
+
+def get_paths_from_object(reader, path_field_index):
+    for row in reader:
+        yield row[path_field_index]
+
+
+def get_paths_from_api(query_id):
     results = paginate(
         athena, athena.get_query_results, ["ResultSet.Rows"], QueryExecutionId=query_id
     )
-    messages = []
-    msg_count = 0
     path_field_index = None
     for result in results:
         is_header_row = path_field_index is None
@@ -37,27 +105,4 @@ def handler(event, context):
                 None,
             )
         else:
-            msg_count += 1
-            path = result["Data"][path_field_index]["VarCharValue"]
-            msg = {
-                "JobId": event["JobId"],
-                "Object": path,
-                "Columns": event["Columns"],
-                "RoleArn": event.get("RoleArn", None),
-                "DeleteOldVersions": event.get("DeleteOldVersions", True),
-                "IgnoreObjectNotFoundExceptions": event.get(
-                    "IgnoreObjectNotFoundExceptions", False
-                ),
-                "Format": event.get("Format"),
-                "Manifest": event.get("Manifest"),
-            }
-            messages.append({k: v for k, v in msg.items() if v is not None})
-
-        if len(messages) >= MSG_BATCH_SIZE:
-            batch_sqs_msgs(queue, messages)
-            messages = []
-
-    if len(messages) > 0:
-        batch_sqs_msgs(queue, messages)
-
-    return msg_count
+            yield result["Data"][path_field_index]["VarCharValue"]
@@ -3,7 +3,7 @@ import os
 import boto3
 
 from decorators import with_logging, s3_state_store
-from boto_utils import read_queue
+from boto_utils import batch_size, paginate, read_queue
 
 queue_url = os.getenv("QueueUrl")
 state_machine_arn = os.getenv("StateMachineArn")
@@ -21,7 +21,19 @@ def handler(event, context):
     execution_id = event["ExecutionId"]
     job_id = event["ExecutionName"]
     previously_started = event.get("RunningExecutions", {"Data": [], "Total": 0})
-    executions = [load_execution(execution) for execution in previously_started["Data"]]
+    running_arns = get_running_execution_arns() if previously_started["Data"] else set()
+    executions = [
+        (
+            {
+                "executionArn": execution["ExecutionArn"],
+                "status": "RUNNING",
+                "ReceiptHandle": execution["ReceiptHandle"],
+            }
+            if running_arns and execution["ExecutionArn"] in running_arns
+            else load_execution(execution)
+        )
+        for execution in previously_started["Data"]
+    ]
     succeeded = [
         execution for execution in executions if execution["status"] == "SUCCEEDED"
     ]
@@ -51,6 +63,7 @@ def handler(event, context):
             body["AWS_STEP_FUNCTIONS_STARTED_BY_EXECUTION_ID"] = execution_id
             body["JobId"] = job_id
             body["WaitDuration"] = wait_duration
+            body["MaxWaitDuration"] = wait_duration
             body["ExecutionRetriesLeft"] = execution_retries_left
             query_executor = body["QueryExecutor"]
             if query_executor == "athena":
@@ -74,6 +87,22 @@ def handler(event, context):
     }
 
 
+def get_running_execution_arns():
+    """
+    Lists the running query executions with a single paginated call, so that
+    only the executions which have stopped since the last check need to be
+    described individually.
+    """
+    executions = paginate(
+        sf_client,
+        sf_client.list_executions,
+        ["executions"],
+        stateMachineArn=state_machine_arn,
+        statusFilter="RUNNING",
+    )
+    return {execution["executionArn"] for execution in executions}
+
+
 def load_execution(execution):
     resp = sf_client.describe_execution(executionArn=execution["ExecutionArn"])
     resp["ReceiptHandle"] = execution["ReceiptHandle"]
@@ -81,9 +110,22 @@ def load_execution(execution):
 
 
 def clear_completed(executions):
-    for e in executions:
-        message = sqs.Message(queue.url, e["ReceiptHandle"])
-        message.delete()
+    failed = []
+    for i in range(0, len(executions), batch_size):
+        resp = queue.delete_messages(
+            Entries=[
+                {"Id": str(j), "ReceiptHandle": e["ReceiptHandle"]}
+                for j, e in enumerate(executions[i : i + batch_size])
+            ]
+        )
+        failed.extend(resp.get("Failed", []))
+    if failed:
+        raise ValueError(
+            "Unable to delete {} completed query messages: {}".format(
+                len(failed),
+                ", ".join(sorted({f.get("Code", "Unknown") for f in failed})),
+            )
+        )
 
 
 def abandon_execution(failed):
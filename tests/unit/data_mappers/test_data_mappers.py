@@ -212,6 +212,7 @@ def test_it_supports_optionals(validate_mapper, table):
                         "PartitionKeys": ["year"],
                     },
                     "RoleArn": "arn:aws:iam::accountid:role/S3F2DataAccessRole",
+                    "ParquetWriterOptions": {"Compression": "zstd"},
                 }
             ),
             "requestContext": autorization_mock,
@@ -234,6 +235,7 @@ def test_it_supports_optionals(validate_mapper, table):
         "DeleteOldVersions": True,
         "IgnoreObjectNotFoundExceptions": False,
         "RoleArn": "arn:aws:iam::accountid:role/S3F2DataAccessRole",
+        "ParquetWriterOptions": {"Compression": "zstd"},
         "CreatedBy": {"Username": "cognitoUsername", "Sub": "cognitoSub"},
     } == json.loads(response["body"])
 
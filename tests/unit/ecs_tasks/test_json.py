@@ -1,3 +1,4 @@
+from io import BytesIO
 from mock import patch
 
 import gzip
@@ -6,7 +7,13 @@ import pyarrow.parquet as pq
 import pytest
 import pandas as pd
 import tempfile
-from backend.ecs_tasks.delete_files.json_handler import delete_matches_from_json_file
+from backend.ecs_tasks.delete_files.json_handler import (
+    ParallelGzipOutputStream,
+    build_cached_prefilter,
+    delete_matches_from_json_file,
+    get_prefilter,
+    stream_matches_from_json_file,
+)
 
 pytestmark = [pytest.mark.unit, pytest.mark.ecs_tasks]
 
@@ -327,6 +334,232 @@ def test_it_throws_meaningful_error_for_serialization_issues():
     )
 
 
+def test_it_copies_malformed_lines_without_candidate_match_ids():
+    # Arrange
+    to_delete = [
+        {"Column": "customer_id", "MatchIds": set(["23456"]), "Type": "Simple"}
+    ]
+    data = (
+        b'{"customer_id": "12345", "d":"invalid\n'
+        b'{"customer_id": "23456", "d":"2001-01-01"}\n'
+        b'{"customer_id": "\xff\xfe"}\n'
+    )
+    out_stream = BytesIO(data)
+    # Act
+    out, stats = delete_matches_from_json_file(out_stream, to_delete)
+    # Assert
+    assert isinstance(out, pa.BufferOutputStream)
+    assert {"ProcessedRows": 3, "DeletedRows": 1} == stats
+    assert out.getvalue().to_pybytes() == (
+        b'{"customer_id": "12345", "d":"invalid\n{"customer_id": "\xff\xfe"}\n'
+    )
+
+
+@patch("backend.ecs_tasks.delete_files.json_handler.parse_json_line")
+def test_it_only_parses_lines_containing_candidate_match_ids(mock_parse):
+    # Arrange
+    to_delete = [
+        {"Column": "customer_id", "MatchIds": set(["23456"]), "Type": "Simple"}
+    ]
+    data = (
+        '{"customer_id": "12345", "x": 1.2, "d":"2001-01-01"}\n'
+        '{"customer_id": "23456", "x": 2.3, "d":"2001-01-03"}\n'
+        '{"customer_id": "34567", "x": 3.4, "d":"2001-01-05"}\n'
+    )
+    mock_parse.return_value = {"customer_id": "23456"}
+    out_stream = to_json_file(data)
+    # Act
+    out, stats = delete_matches_from_json_file(out_stream, to_delete)
+    assert {"ProcessedRows": 3, "DeletedRows": 1} == stats
+    mock_parse.assert_called_once_with(
+        b'{"customer_id": "23456", "x": 2.3, "d":"2001-01-03"}'
+    )
+    assert to_json_string(out) == (
+        '{"customer_id": "12345", "x": 1.2, "d":"2001-01-01"}\n'
+        '{"customer_id": "34567", "x": 3.4, "d":"2001-01-05"}\n'
+    )
+
+
+def test_delete_correct_rows_with_escaped_match_ids():
+    # Arrange
+    to_delete = [
+        {
+            "Column": "customer_id",
+            "MatchIds": set(["A/1", 'say "hi"', "café"]),
+            "Type": "Simple",
+        }
+    ]
+    data = (
+        '{"customer_id": "\\u0041/1"}\n'
+        '{"customer_id": "A\\/1"}\n'
+        '{"customer_id": "say \\"hi\\""}\n'
+        '{"customer_id": "caf\\u00e9"}\n'
+        '{"customer_id": "café"}\n'
+        '{"customer_id": "A\\\\1", "other": "\\n"}\n'
+    )
+    out_stream = to_json_file(data)
+    # Act
+    out, stats = delete_matches_from_json_file(out_stream, to_delete)
+    assert {"ProcessedRows": 6, "DeletedRows": 5} == stats
+    assert to_json_string(out) == '{"customer_id": "A\\\\1", "other": "\\n"}\n'
+
+
+def test_delete_correct_rows_with_numeric_match_ids():
+    # Arrange
+    to_delete = [
+        {"Column": "customer_id", "MatchIds": set([12345, 1]), "Type": "Simple"},
+        {"Column": "score", "MatchIds": set([2.5]), "Type": "Simple"},
+    ]
+    data = (
+        '{"customer_id": 12345}\n'
+        '{"customer_id": 1.2345e4}\n'
+        '{"customer_id": 12345.0}\n'
+        '{"customer_id": true}\n'
+        '{"customer_id": 23456, "score": 25E-1}\n'
+        '{"customer_id": 23456, "id": "1e4"}\n'
+    )
+    out_stream = to_json_file(data)
+    # Act
+    out, stats = delete_matches_from_json_file(out_stream, to_delete)
+    assert {"ProcessedRows": 6, "DeletedRows": 5} == stats
+    assert to_json_string(out) == '{"customer_id": 23456, "id": "1e4"}\n'
+
+
+def test_it_falls_back_to_the_standard_parser():
+    # Arrange
+    to_delete = [
+        {"Column": "customer_id", "MatchIds": set(["23456"]), "Type": "Simple"}
+    ]
+    data = (
+        '{"customer_id": "23456", "x": NaN}\n'
+        '{"customer_id": "23456", "x": 123456789012345678901234567890}\n'
+        '{"customer_id": "34567", "x": NaN}\n'
+    )
+    out_stream = to_json_file(data)
+    # Act
+    out, stats = delete_matches_from_json_file(out_stream, to_delete)
+    assert {"ProcessedRows": 3, "DeletedRows": 2} == stats
+    assert to_json_string(out) == '{"customer_id": "34567", "x": NaN}\n'
+
+
+def test_it_streams_json_lines_in_chunks():
+    # Arrange
+    to_delete = [
+        {"Column": "customer_id", "MatchIds": set(["23456"]), "Type": "Simple"}
+    ]
+    data = (
+        '{"customer_id": "12345", "x": 1.2, "d":"2001-01-01"}\n'
+        '{"customer_id": "23456", "x": 2.3, "d":"2001-01-03"}\n'
+        '{"customer_id": "34567", "x": 3.4, "d":"2001-01-05"}'
+    )
+    with pa.BufferOutputStream() as out_stream:
+        # Act
+        stats = stream_matches_from_json_file(
+            pa.BufferReader(data.encode("utf-8")),
+            out_stream,
+            to_delete,
+            True,
+            chunk_size=16,
+        )
+        assert {"ProcessedRows": 3, "DeletedRows": 1} == stats
+        assert to_decompressed_json_string(out_stream) == (
+            '{"customer_id": "12345", "x": 1.2, "d":"2001-01-01"}\n'
+            '{"customer_id": "34567", "x": 3.4, "d":"2001-01-05"}\n'
+        )
+
+
+def test_it_reports_line_numbers_across_chunks():
+    # Arrange
+    to_delete = [
+        {"Column": "customer_id", "MatchIds": set(["23456"]), "Type": "Simple"}
+    ]
+    data = (
+        '{"customer_id": "12345"}\n'
+        '{"customer_id": "34567"}\n'
+        '{"customer_id": "23456", "x": invalid}\n'
+    )
+    # Act
+    with pytest.raises(ValueError) as e:
+        stream_matches_from_json_file(
+            pa.BufferReader(data.encode("utf-8")),
+            pa.BufferOutputStream(),
+            to_delete,
+            chunk_size=30,
+        )
+    assert e.value.args[0] == (
+        "Serialization error when parsing JSON lines: "
+        "Expecting value: line 3 column 31 (char 30)"
+    )
+
+
+def test_it_compresses_json_in_parallel_as_gzip_members():
+    # Arrange
+    to_delete = [
+        {"Column": "customer_id", "MatchIds": set(["23456"]), "Type": "Simple"}
+    ]
+    data = "".join(
+        '{"customer_id": "%s", "x": %d}\n' % (["12345", "23456"][i % 2], i)
+        for i in range(1000)
+    )
+    with pa.BufferOutputStream() as out_stream:
+        # Act
+        stats = stream_matches_from_json_file(
+            pa.BufferReader(data.encode("utf-8")), out_stream, to_delete, True, 4
+        )
+        compressed = out_stream.getvalue().to_pybytes()
+    assert {"ProcessedRows": 1000, "DeletedRows": 500} == stats
+    assert gzip.decompress(compressed).decode("utf-8") == "".join(
+        '{"customer_id": "12345", "x": %d}\n' % i for i in range(0, 1000, 2)
+    )
+
+
+def test_it_writes_gzip_members_in_order():
+    out = BytesIO()
+    writer = ParallelGzipOutputStream(out, 4, block_size=10)
+    for i in range(100):
+        writer.write(b"line %d\n" % i)
+    writer.close()
+    compressed = out.getvalue()
+    assert compressed.count(b"\x1f\x8b\x08") > 1
+    assert gzip.decompress(compressed) == b"".join(b"line %d\n" % i for i in range(100))
+
+
+def test_it_writes_an_empty_gzip_member_for_empty_output():
+    to_delete = [
+        {"Column": "customer_id", "MatchIds": set(["23456"]), "Type": "Simple"}
+    ]
+    data = '{"customer_id": "23456"}\n'
+    with pa.BufferOutputStream() as out_stream:
+        stats = stream_matches_from_json_file(
+            pa.BufferReader(data.encode("utf-8")), out_stream, to_delete, True, 4
+        )
+        compressed = out_stream.getvalue().to_pybytes()
+    assert {"ProcessedRows": 1, "DeletedRows": 1} == stats
+    assert b"" == gzip.decompress(compressed)
+
+
+@patch("backend.ecs_tasks.delete_files.json_handler.ParallelGzipOutputStream.abort")
+def test_it_stops_compression_threads_on_errors(mock_abort):
+    to_delete = [
+        {"Column": "customer_id", "MatchIds": set(["23456"]), "Type": "Simple"}
+    ]
+    data = '{"customer_id": "23456", "d":"invalid\n'
+    with pytest.raises(ValueError):
+        stream_matches_from_json_file(
+            pa.BufferReader(data.encode("utf-8")), BytesIO(), to_delete, True, 4
+        )
+    mock_abort.assert_called_once()
+
+
+def test_it_discards_pending_gzip_members_on_abort():
+    out = BytesIO()
+    writer = ParallelGzipOutputStream(out, 2, block_size=10)
+    writer.write(b"x" * 25)
+    writer.abort()
+    assert writer.closed
+    assert writer._executor._shutdown
+
+
 def to_json_file(data, compressed=False):
     mode = "wb" if compressed else "w+t"
     tmp = tempfile.NamedTemporaryFile(mode=mode)
@@ -350,3 +583,22 @@ def to_json_string(buf, compressed=False):
 
 def to_decompressed_json_string(buf):
     return gzip.decompress(to_json_string(buf, True)).decode("utf-8")
+
+
+@patch("backend.ecs_tasks.delete_files.json_handler.build_prefilter")
+def test_it_reuses_the_prefilter_for_the_same_match_ids(mock_build):
+    build_cached_prefilter.cache_clear()
+    mock_build.return_value = "pattern"
+
+    first = get_prefilter(
+        [{"Column": "customer_id", "MatchIds": set(["12345"]), "Type": "Simple"}]
+    )
+    second = get_prefilter(
+        [{"Column": "user_id", "MatchIds": frozenset(["12345"]), "Type": "Simple"}]
+    )
+    get_prefilter(
+        [{"Column": "customer_id", "MatchIds": set(["23456"]), "Type": "Simple"}]
+    )
+
+    assert first == second == "pattern"
+    assert mock_build.call_count == 2
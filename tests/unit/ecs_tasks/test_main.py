@@ -6,7 +6,7 @@ from os import strerror
 
 import boto3
 from botocore.exceptions import ClientError
-from mock import patch, MagicMock, ANY, call
+from mock import patch, MagicMock, PropertyMock, ANY, call
 
 import pyarrow as pa
 import pytest
@@ -23,19 +23,42 @@ with patch.dict(
 ):
     from backend.ecs_tasks.delete_files.main import (
         build_matches,
+        build_match_index,
         kill_handler,
         execute,
+        estimate_memory,
+        execute_in_worker,
+        extend_visibility,
+        init_worker,
+        get_clients,
+        get_filesystem,
+        get_manifest_cache_path,
+        get_memory_limit,
         handle_error,
         handle_skip,
+        load_match_index,
         get_queue,
         main,
         parse_args,
         delete_matches_from_file,
+        save_match_index,
     )
 
 pytestmark = [pytest.mark.unit, pytest.mark.ecs_tasks]
 
 
+@pytest.fixture(autouse=True)
+def clear_worker_caches():
+    get_clients.cache_clear()
+    get_filesystem.cache_clear()
+    build_match_index.cache_clear()
+    with patch(
+        "backend.ecs_tasks.delete_files.main.get_manifest_cache_path",
+        return_value=None,
+    ):
+        yield
+
+
 def get_list_object_versions_error():
     return ClientError(
         {
@@ -94,7 +117,7 @@ def test_happy_path_when_queue_not_empty(
     mock_fs.open_input_stream.assert_called_with(
         "bucket/path/basic.parquet", buffer_size=5 * 2**20
     )
-    mock_delete.assert_called_with(ANY, [column], "parquet", False)
+    mock_delete.assert_called_with(ANY, [column], "parquet", False, None, 1)
     mock_save.assert_called_with(ANY, ANY, "bucket", "path/basic.parquet", {}, "abc123")
     mock_emit.assert_called()
     mock_session.assert_called_with(None, "s3f2")
@@ -106,6 +129,50 @@ def test_happy_path_when_queue_not_empty(
     assert isinstance(buf, pa.BufferReader)  # must be BufferReader for zero-copy
 
 
+@patch.dict(os.environ, {"JobTable": "test"})
+@patch(
+    "backend.ecs_tasks.delete_files.main.validate_bucket_versioning",
+    MagicMock(return_value=True),
+)
+@patch("backend.ecs_tasks.delete_files.main.validate_message", MagicMock())
+@patch("backend.ecs_tasks.delete_files.main.get_queue", MagicMock())
+@patch(
+    "backend.ecs_tasks.delete_files.main.verify_object_versions_integrity", MagicMock()
+)
+@patch("backend.ecs_tasks.delete_files.main.get_session", MagicMock())
+@patch("backend.ecs_tasks.delete_files.main.pa.fs")
+@patch("backend.ecs_tasks.delete_files.main.delete_matches_from_file")
+@patch("backend.ecs_tasks.delete_files.main.emit_deletion_event", MagicMock())
+@patch("backend.ecs_tasks.delete_files.main.save", MagicMock())
+@patch("backend.ecs_tasks.delete_files.main.build_matches")
+@patch("backend.ecs_tasks.delete_files.main.get_object_info")
+def test_it_passes_parquet_writer_options(
+    mock_get_object_info,
+    mock_build_matches,
+    mock_delete,
+    mock_fs,
+    message_stub,
+):
+    column = {"Column": "customer_id", "MatchIds": set(["12345", "23456"])}
+    mock_build_matches.return_value = [column]
+    mock_fs.S3FileSystem.return_value = mock_fs
+    mock_file = MagicMock()
+    mock_file.metadata.return_value = {
+        "VersionId": b"abc123",
+        "Content-Length": b"5558",
+    }
+    mock_fs.open_input_stream.return_value.__enter__.return_value = mock_file
+    mock_get_object_info.return_value = {"Metadata": {}}, None
+    mock_delete.return_value = pa.BufferOutputStream(), {"DeletedRows": 1}
+    writer_options = {"Compression": "zstd", "RowGroupSize": 1000}
+    execute(
+        "https://queue/url",
+        message_stub(ParquetWriterOptions=writer_options),
+        "receipt_handle",
+    )
+    mock_delete.assert_called_with(ANY, [column], "parquet", False, writer_options, 1)
+
+
 @patch.dict(os.environ, {"JobTable": "test"})
 @patch(
     "backend.ecs_tasks.delete_files.main.validate_bucket_versioning",
@@ -152,7 +219,7 @@ def test_happy_path_when_queue_not_empty_for_compressed_json(
     mock_fs.open_input_stream.assert_called_with(
         "bucket/path/basic.json.gz", buffer_size=5 * 2**20
     )
-    mock_delete.assert_called_with(ANY, [column], "json", True)
+    mock_delete.assert_called_with(ANY, [column], "json", True, None, 1)
     mock_save.assert_called_with(ANY, ANY, "bucket", "path/basic.json.gz", {}, "abc123")
     mock_emit.assert_called()
     mock_session.assert_called_with(None, "s3f2")
@@ -225,7 +292,9 @@ def test_cse_kms_encrypted(
     mock_fs.open_input_stream.assert_called_with(
         "bucket/path/basic.parquet", buffer_size=5 * 2**20
     )
-    mock_delete.assert_called_with(mock_file_decrypted, [column], "parquet", False)
+    mock_delete.assert_called_with(
+        mock_file_decrypted, [column], "parquet", False, None, 1
+    )
     mock_encrypt.assert_called_with(ANY, metadata, ANY)
     mock_save.assert_called_with(
         ANY,
@@ -437,6 +506,260 @@ def test_it_handles_no_deletions(
     )
 
 
+@patch.dict(os.environ, {"JobTable": "test"})
+@patch(
+    "backend.ecs_tasks.delete_files.main.validate_bucket_versioning",
+    MagicMock(return_value=True),
+)
+@patch("backend.ecs_tasks.delete_files.main.validate_message", MagicMock())
+@patch("backend.ecs_tasks.delete_files.main.get_queue", MagicMock())
+@patch("backend.ecs_tasks.delete_files.main.verify_object_versions_integrity")
+@patch("backend.ecs_tasks.delete_files.main.get_session")
+@patch("backend.ecs_tasks.delete_files.main.pa.fs")
+@patch("backend.ecs_tasks.delete_files.main.stream_matches_from_parquet_file")
+@patch("backend.ecs_tasks.delete_files.main.emit_deletion_event")
+@patch("backend.ecs_tasks.delete_files.main.MultipartUpload")
+@patch("backend.ecs_tasks.delete_files.main.RangedObjectReader")
+@patch("backend.ecs_tasks.delete_files.main.build_matches")
+@patch("backend.ecs_tasks.delete_files.main.get_object_info")
+def test_it_streams_parquet_objects(
+    mock_get_object_info,
+    mock_build_matches,
+    mock_reader,
+    mock_upload,
+    mock_emit,
+    mock_stream,
+    mock_fs,
+    mock_session,
+    mock_verify_integrity,
+    message_stub,
+):
+    column = {"Column": "customer_id", "MatchIds": set(["12345", "23456"])}
+    mock_build_matches.return_value = [column]
+    mock_get_object_info.return_value = (
+        {"Metadata": {}},
+        {"Metadata": {}, "VersionId": "abc123", "ContentLength": 5558},
+    )
+    mock_stream.return_value = {"DeletedRows": 1}
+    mock_upload.return_value.complete.return_value = "new_version123"
+    mock_client = mock_session.return_value.client.return_value
+    execute(
+        "https://queue/url",
+        message_stub(Object="s3://bucket/path/basic.parquet"),
+        "receipt_handle",
+        stream_objects=True,
+    )
+    mock_fs.S3FileSystem.assert_not_called()
+    mock_get_object_info.assert_has_calls(
+        [
+            call(mock_client, "bucket", "path/basic.parquet"),
+            call(mock_client, "bucket", "path/basic.parquet", "abc123"),
+        ]
+    )
+    mock_reader.assert_called_with(
+        mock_client, "bucket", "path/basic.parquet", "abc123", 5558
+    )
+    mock_upload.assert_called_with(
+        mock_client, "bucket", "path/basic.parquet", {}, "abc123", expected_size=5558
+    )
+    mock_stream.assert_called_with(ANY, ANY, [column], None)
+    mock_upload.return_value.abort.assert_not_called()
+    mock_verify_integrity.assert_called_with(
+        ANY, "bucket", "path/basic.parquet", "abc123", "new_version123"
+    )
+    mock_emit.assert_called()
+
+
+@patch.dict(os.environ, {"JobTable": "test"})
+@patch(
+    "backend.ecs_tasks.delete_files.main.validate_bucket_versioning",
+    MagicMock(return_value=True),
+)
+@patch("backend.ecs_tasks.delete_files.main.validate_message", MagicMock())
+@patch("backend.ecs_tasks.delete_files.main.get_queue", MagicMock())
+@patch(
+    "backend.ecs_tasks.delete_files.main.verify_object_versions_integrity", MagicMock()
+)
+@patch("backend.ecs_tasks.delete_files.main.get_session", MagicMock())
+@patch("backend.ecs_tasks.delete_files.main.pa.input_stream")
+@patch("backend.ecs_tasks.delete_files.main.stream_matches_from_json_file")
+@patch("backend.ecs_tasks.delete_files.main.emit_deletion_event", MagicMock())
+@patch("backend.ecs_tasks.delete_files.main.MultipartUpload")
+@patch("backend.ecs_tasks.delete_files.main.RangedObjectReader", MagicMock())
+@patch("backend.ecs_tasks.delete_files.main.build_matches")
+@patch("backend.ecs_tasks.delete_files.main.get_object_info")
+def test_it_streams_compressed_json_objects(
+    mock_get_object_info,
+    mock_build_matches,
+    mock_upload,
+    mock_stream,
+    mock_input_stream,
+    message_stub,
+):
+    column = {"Column": "customer_id", "MatchIds": set(["12345", "23456"])}
+    mock_build_matches.return_value = [column]
+    mock_get_object_info.return_value = (
+        {"Metadata": {}},
+        {"Metadata": {}, "VersionId": "abc123", "ContentLength": 5558},
+    )
+    mock_stream.return_value = {"DeletedRows": 1}
+    mock_upload.return_value.complete.return_value = "new_version123"
+    execute(
+        "https://queue/url",
+        message_stub(Object="s3://bucket/path/basic.json.gz", Format="json"),
+        "receipt_handle",
+        stream_objects=True,
+    )
+    mock_input_stream.assert_called_with(ANY, compression="gzip", buffer_size=5 * 2**20)
+    mock_stream.assert_called_with(
+        mock_input_stream.return_value, ANY, [column], True, 1
+    )
+    mock_upload.return_value.complete.assert_called()
+
+
+@patch.dict(os.environ, {"JobTable": "test"})
+@patch(
+    "backend.ecs_tasks.delete_files.main.validate_bucket_versioning",
+    MagicMock(return_value=True),
+)
+@patch("backend.ecs_tasks.delete_files.main.validate_message", MagicMock())
+@patch("backend.ecs_tasks.delete_files.main.get_queue", MagicMock())
+@patch("backend.ecs_tasks.delete_files.main.get_session", MagicMock())
+@patch("backend.ecs_tasks.delete_files.main.stream_matches_from_parquet_file")
+@patch("backend.ecs_tasks.delete_files.main.MultipartUpload")
+@patch("backend.ecs_tasks.delete_files.main.RangedObjectReader", MagicMock())
+@patch("backend.ecs_tasks.delete_files.main.build_matches", MagicMock())
+@patch("backend.ecs_tasks.delete_files.main.get_object_info")
+def test_it_aborts_streamed_uploads_on_shutdown(
+    mock_get_object_info,
+    mock_upload,
+    mock_stream,
+    message_stub,
+):
+    mock_get_object_info.return_value = (
+        {"Metadata": {}},
+        {"Metadata": {}, "VersionId": "abc123", "ContentLength": 5558},
+    )
+    mock_stream.side_effect = SystemExit(1)
+    with pytest.raises(SystemExit):
+        execute(
+            "https://queue/url",
+            message_stub(Object="s3://bucket/path/basic.parquet"),
+            "receipt_handle",
+            stream_objects=True,
+        )
+    mock_upload.return_value.abort.assert_called()
+    mock_upload.return_value.complete.assert_not_called()
+
+
+@patch("backend.ecs_tasks.delete_files.main.signal")
+def test_it_exits_workers_on_sigterm(mock_signal):
+    init_worker()
+    sig, handler = mock_signal.signal.call_args[0]
+    assert sig == mock_signal.SIGTERM
+    with pytest.raises(SystemExit):
+        handler(15, None)
+
+
+@patch.dict(os.environ, {"JobTable": "test"})
+@patch(
+    "backend.ecs_tasks.delete_files.main.validate_bucket_versioning",
+    MagicMock(return_value=True),
+)
+@patch("backend.ecs_tasks.delete_files.main.validate_message", MagicMock())
+@patch("backend.ecs_tasks.delete_files.main.get_queue", MagicMock())
+@patch("backend.ecs_tasks.delete_files.main.get_session", MagicMock())
+@patch("backend.ecs_tasks.delete_files.main.stream_matches_from_parquet_file")
+@patch("backend.ecs_tasks.delete_files.main.emit_deletion_event")
+@patch("backend.ecs_tasks.delete_files.main.MultipartUpload")
+@patch("backend.ecs_tasks.delete_files.main.RangedObjectReader", MagicMock())
+@patch("backend.ecs_tasks.delete_files.main.handle_error")
+@patch("backend.ecs_tasks.delete_files.main.build_matches", MagicMock())
+@patch("backend.ecs_tasks.delete_files.main.get_object_info")
+def test_it_aborts_streamed_uploads_with_no_deletions(
+    mock_get_object_info,
+    mock_handle,
+    mock_upload,
+    mock_emit,
+    mock_stream,
+    message_stub,
+):
+    mock_get_object_info.return_value = (
+        {"Metadata": {}},
+        {"Metadata": {}, "VersionId": "abc123", "ContentLength": 5558},
+    )
+    mock_stream.return_value = {"DeletedRows": 0}
+    execute(
+        "https://queue/url",
+        message_stub(Object="s3://bucket/path/basic.parquet"),
+        "receipt_handle",
+        stream_objects=True,
+    )
+    mock_upload.return_value.abort.assert_called()
+    mock_upload.return_value.complete.assert_not_called()
+    mock_emit.assert_not_called()
+    mock_handle.assert_called_with(
+        ANY,
+        ANY,
+        "Unprocessable message: The object s3://bucket/path/basic.parquet "
+        "was processed successfully but no rows required deletion",
+    )
+
+
+@patch.dict(os.environ, {"JobTable": "test"})
+@patch(
+    "backend.ecs_tasks.delete_files.main.validate_bucket_versioning",
+    MagicMock(return_value=True),
+)
+@patch("backend.ecs_tasks.delete_files.main.validate_message", MagicMock())
+@patch("backend.ecs_tasks.delete_files.main.get_queue", MagicMock())
+@patch("backend.ecs_tasks.delete_files.main.verify_object_versions_integrity")
+@patch("backend.ecs_tasks.delete_files.main.get_session", MagicMock())
+@patch("backend.ecs_tasks.delete_files.main.pa.fs")
+@patch("backend.ecs_tasks.delete_files.main.delete_matches_from_file")
+@patch("backend.ecs_tasks.delete_files.main.emit_deletion_event", MagicMock())
+@patch("backend.ecs_tasks.delete_files.main.save")
+@patch("backend.ecs_tasks.delete_files.main.MultipartUpload")
+@patch("backend.ecs_tasks.delete_files.main.decrypt", MagicMock())
+@patch("backend.ecs_tasks.delete_files.main.encrypt")
+@patch("backend.ecs_tasks.delete_files.main.build_matches", MagicMock())
+@patch("backend.ecs_tasks.delete_files.main.get_object_info")
+def test_it_does_not_stream_cse_encrypted_objects(
+    mock_get_object_info,
+    mock_encrypt,
+    mock_upload,
+    mock_save,
+    mock_delete,
+    mock_fs,
+    mock_verify_integrity,
+    message_stub,
+):
+    metadata = {
+        "x-amz-key-v2": "key123",
+        "x-amz-cek-alg": "AES/GCM/NoPadding",
+        "x-amz-wrap-alg": "kms",
+    }
+    mock_fs.S3FileSystem.return_value = mock_fs
+    mock_file = MagicMock()
+    mock_file.metadata.return_value = {
+        "VersionId": b"abc123",
+        "Content-Length": b"5558",
+    }
+    mock_fs.open_input_stream.return_value.__enter__.return_value = mock_file
+    mock_get_object_info.return_value = {"Metadata": metadata}, {"Metadata": metadata}
+    mock_encrypt.return_value = BytesIO(b"test"), metadata
+    mock_delete.return_value = pa.BufferOutputStream(), {"DeletedRows": 1}
+    mock_save.return_value = "new_version123"
+    execute(
+        "https://queue/url",
+        message_stub(Object="s3://bucket/path/basic.parquet"),
+        "receipt_handle",
+        stream_objects=True,
+    )
+    mock_upload.assert_not_called()
+    mock_save.assert_called()
+
+
 @patch.dict(os.environ, {"JobTable": "test"})
 @patch("backend.ecs_tasks.delete_files.main.get_queue", MagicMock())
 @patch(
@@ -1002,9 +1325,9 @@ def test_kill_handler_cleans_up(mock_error_handler):
         mock_pool = MagicMock()
         mock_msg = MagicMock()
         kill_handler([mock_msg], mock_pool)
-        mock_pool.terminate.assert_called()
-        mock_error_handler.assert_called()
-        assert 1 == e.value.code
+    mock_pool.terminate.assert_called_with(10)
+    mock_error_handler.assert_called()
+    assert 1 == e.value.code
 
 
 @patch("backend.ecs_tasks.delete_files.main.handle_error")
@@ -1042,6 +1365,24 @@ def test_it_inits_arg_parser_with_defaults():
     assert isinstance(res.max_messages, int)
     assert isinstance(res.sleep_time, int)
     assert isinstance(res.queue_url, str)
+    assert res.stream_objects is False
+    assert res.compression_threads == 1
+    assert res.worker_memory_limit == 4096
+
+
+@patch.dict(os.environ, {"STREAM_OBJECTS": "true"})
+def test_it_reads_streaming_mode_from_env():
+    assert parse_args([]).stream_objects is True
+
+
+@patch.dict(os.environ, {"COMPRESSION_THREADS": "4"})
+def test_it_reads_compression_threads_from_env():
+    assert parse_args([]).compression_threads == 4
+
+
+@patch.dict(os.environ, {"WORKER_MEMORY_LIMIT": "1024"})
+def test_it_reads_worker_memory_limit_from_env():
+    assert parse_args([]).worker_memory_limit == 1024
 
 
 @patch("backend.ecs_tasks.delete_files.main.boto3")
@@ -1067,40 +1408,382 @@ def test_it_does_not_override_user_supplied_endpoint_url(mock_boto):
     mock_boto.resource.assert_called_with("sqs", endpoint_url="https://my/url")
 
 
+def worker_pool_stub(mock_pool, size=1, complete=True):
+    """
+    Configures the mocked WorkerPool to complete every running task on the
+    next wait when complete is set, or to keep them running otherwise
+    """
+    pool = mock_pool.return_value
+    running = []
+
+    def wait(timeout):
+        done = list(running) if complete else []
+        del running[: len(done)]
+        return done, []
+
+    pool.submit.side_effect = running.append
+    pool.wait.side_effect = wait
+    type(pool).idle = PropertyMock(side_effect=lambda: size - len(running))
+    return pool
+
+
 @patch("backend.ecs_tasks.delete_files.main.signal", MagicMock())
-@patch("backend.ecs_tasks.delete_files.main.get_context")
+@patch("backend.ecs_tasks.delete_files.main.cpu_count", MagicMock(return_value=1))
+@patch("backend.ecs_tasks.delete_files.main.WorkerPool")
 @patch("backend.ecs_tasks.delete_files.main.get_queue")
-def test_it_starts_subprocesses(mock_queue, mock_context):
+def test_it_starts_subprocesses(mock_queue, mock_pool):
     mock_queue.return_value = mock_queue
     mock_message = MagicMock()
-    mock_queue.receive_messages.return_value = [mock_message]
     # Break out of while loop
-    mock_pool = MagicMock()
-    mock_context.return_value = mock_context
-    mock_context.__enter__.return_value = mock_context
-    mock_context.Pool = mock_pool
-    mock_pool.return_value = mock_pool
-    mock_pool.__enter__.return_value = mock_pool
-    mock_pool.starmap.side_effect = RuntimeError("Break loop")
+    mock_queue.receive_messages.side_effect = [
+        [mock_message],
+        RuntimeError("Break loop"),
+    ]
+    pool = worker_pool_stub(mock_pool, complete=False)
     with pytest.raises(RuntimeError):
-        main("https://queue/url", 1, 1, 1)
-    mock_pool.assert_called_with(maxtasksperchild=1)
-    mock_context.assert_called_with("spawn")
-    mock_pool.starmap.assert_called_with(
-        ANY, [("https://queue/url", mock_message.body, mock_message.receipt_handle)]
+        main(
+            "https://queue/url",
+            1,
+            1,
+            1,
+            worker_memory_limit=200,
+            visibility_timeout=600,
+        )
+    mock_pool.assert_called_with(2, ANY, 200, init_worker)
+    pool.submit.assert_called_with(
+        ("https://queue/url", mock_message.body, mock_message.receipt_handle)
     )
     mock_queue.receive_messages.assert_called_with(
-        WaitTimeSeconds=1, MaxNumberOfMessages=1
+        WaitTimeSeconds=1, MaxNumberOfMessages=1, VisibilityTimeout=600
+    )
+    pool.terminate.assert_called_with(10)
+
+
+@patch("backend.ecs_tasks.delete_files.main.signal", MagicMock())
+@patch("backend.ecs_tasks.delete_files.main.WorkerPool")
+@patch("backend.ecs_tasks.delete_files.main.get_queue")
+def test_it_uses_queue_visibility_timeout_by_default(mock_queue, mock_pool):
+    mock_queue.return_value = mock_queue
+    mock_queue.attributes = {"VisibilityTimeout": "10800"}
+    mock_queue.receive_messages.side_effect = RuntimeError("Break loop")
+    worker_pool_stub(mock_pool)
+    with pytest.raises(RuntimeError):
+        main("https://queue/url", 1, 1, 1)
+    mock_queue.receive_messages.assert_called_with(
+        WaitTimeSeconds=1, MaxNumberOfMessages=1, VisibilityTimeout=10800
     )
 
 
-@patch("backend.ecs_tasks.delete_files.main.get_context", MagicMock())
+@patch("backend.ecs_tasks.delete_files.main.signal", MagicMock())
+@patch("backend.ecs_tasks.delete_files.main.cpu_count", MagicMock(return_value=1))
+@patch("backend.ecs_tasks.delete_files.main.extend_visibility")
+@patch("backend.ecs_tasks.delete_files.main.WorkerPool")
+@patch("backend.ecs_tasks.delete_files.main.get_queue")
+def test_it_prefetches_messages_up_to_capacity(mock_queue, mock_pool, mock_extend):
+    mock_queue.return_value = mock_queue
+    msgs = [MagicMock(receipt_handle="receipt_handle_{}".format(i)) for i in range(3)]
+    mock_queue.receive_messages.side_effect = [[m] for m in msgs]
+    worker_pool_stub(mock_pool, size=2, complete=False)
+    # Heartbeat on every iteration, breaking out of the loop on the fourth one
+    mock_extend.side_effect = [None, None, None, RuntimeError("Break loop")]
+    with pytest.raises(RuntimeError):
+        main("https://queue/url", 1, 0, 1, visibility_timeout=0)
+    # Two workers plus one prefetched message fill the capacity
+    assert mock_queue.receive_messages.call_count == 3
+    assert list(mock_extend.call_args_list[3][0][1]) == msgs
+    mock_extend.assert_called_with(mock_queue, ANY, 0)
+
+
+@patch("backend.ecs_tasks.delete_files.main.signal", MagicMock())
+@patch("backend.ecs_tasks.delete_files.main.cpu_count", MagicMock(return_value=1))
+@patch("backend.ecs_tasks.delete_files.main.WorkerPool")
+@patch("backend.ecs_tasks.delete_files.main.get_queue")
+def test_it_receives_more_messages_as_workers_complete(mock_queue, mock_pool):
+    mock_queue.return_value = mock_queue
+    mock_queue.receive_messages.side_effect = [
+        [MagicMock(receipt_handle="receipt_handle_1")],
+        [MagicMock(receipt_handle="receipt_handle_2")],
+        [MagicMock(receipt_handle="receipt_handle_3")],
+        RuntimeError("Break loop"),
+    ]
+    pool = worker_pool_stub(mock_pool)
+    with pytest.raises(RuntimeError):
+        main("https://queue/url", 1, 0, 1, visibility_timeout=600)
+    assert mock_queue.receive_messages.call_count == 4
+    assert pool.submit.call_count == 3
+
+
+@patch("backend.ecs_tasks.delete_files.main.signal", MagicMock())
+@patch("backend.ecs_tasks.delete_files.main.cpu_count", MagicMock(return_value=1))
+@patch("backend.ecs_tasks.delete_files.main.handle_error")
+@patch("backend.ecs_tasks.delete_files.main.extend_visibility")
+@patch("backend.ecs_tasks.delete_files.main.WorkerPool")
+@patch("backend.ecs_tasks.delete_files.main.get_queue")
+def test_it_releases_messages_of_lost_workers(
+    mock_queue, mock_pool, mock_extend, mock_error_handler
+):
+    mock_queue.return_value = mock_queue
+    msg_1 = MagicMock(receipt_handle="receipt_handle_1")
+    msg_2 = MagicMock(receipt_handle="receipt_handle_2")
+    mock_queue.receive_messages.side_effect = [[msg_1], [msg_2], []]
+    pool = worker_pool_stub(mock_pool)
+    task = ("https://queue/url", msg_1.body, "receipt_handle_1")
+    # The worker of the first message exits, the second one is still running
+    pool.wait.side_effect = [([], []), ([], [task]), ([], [])]
+    mock_extend.side_effect = [None, None, RuntimeError("Break loop")]
+    with pytest.raises(RuntimeError):
+        main("https://queue/url", 1, 0, 1, visibility_timeout=0)
+    mock_error_handler.assert_called_once_with(
+        msg_1, msg_1.body, "Worker exited during processing"
+    )
+    assert list(mock_extend.call_args_list[2][0][1]) == [msg_2]
+
+
+@patch("backend.ecs_tasks.delete_files.main.signal", MagicMock())
+@patch("backend.ecs_tasks.delete_files.main.cpu_count", MagicMock(return_value=4))
+@patch(
+    "backend.ecs_tasks.delete_files.main.get_memory_limit",
+    MagicMock(return_value=1000),
+)
+@patch("backend.ecs_tasks.delete_files.main.estimate_memory")
+@patch("backend.ecs_tasks.delete_files.main.WorkerPool")
+@patch("backend.ecs_tasks.delete_files.main.get_queue")
+def test_it_admits_messages_within_the_memory_budget(
+    mock_queue, mock_pool, mock_estimate
+):
+    mock_queue.return_value = mock_queue
+    msg_1 = MagicMock(receipt_handle="receipt_handle_1")
+    msg_2 = MagicMock(receipt_handle="receipt_handle_2")
+    mock_queue.receive_messages.side_effect = [
+        [msg_1, msg_2],
+        RuntimeError("Break loop"),
+    ]
+    mock_estimate.return_value = 500
+    pool = worker_pool_stub(mock_pool, size=4, complete=False)
+    with pytest.raises(RuntimeError):
+        main("https://queue/url", 2, 0, 1, visibility_timeout=600)
+    # Two messages of 500 don't fit in the budget of 800
+    pool.submit.assert_called_once()
+    assert pool.submit.call_args[0][0][2] == "receipt_handle_1"
+
+
+@patch("backend.ecs_tasks.delete_files.main.signal", MagicMock())
+@patch("backend.ecs_tasks.delete_files.main.cpu_count", MagicMock(return_value=1))
+@patch("backend.ecs_tasks.delete_files.main.WorkerPool")
+@patch("backend.ecs_tasks.delete_files.main.get_queue")
+def test_it_waits_for_workers_rather_than_sqs_whilst_messages_are_pending(
+    mock_queue, mock_pool
+):
+    mock_queue.return_value = mock_queue
+    mock_queue.receive_messages.side_effect = [
+        [
+            MagicMock(receipt_handle="receipt_handle_1"),
+            MagicMock(receipt_handle="receipt_handle_2"),
+            MagicMock(receipt_handle="receipt_handle_3"),
+        ],
+        RuntimeError("Break loop"),
+    ]
+    pool = worker_pool_stub(mock_pool, size=2, complete=False)
+    with pytest.raises(RuntimeError):
+        main("https://queue/url", 3, 5, 1, visibility_timeout=600)
+    assert pool.wait.call_args_list == [call(0), call(5)]
+    assert mock_queue.receive_messages.call_args_list == [
+        call(WaitTimeSeconds=5, MaxNumberOfMessages=3, VisibilityTimeout=600),
+        call(WaitTimeSeconds=0, MaxNumberOfMessages=2, VisibilityTimeout=600),
+    ]
+
+
+@patch("backend.ecs_tasks.delete_files.main.signal", MagicMock())
+@patch("backend.ecs_tasks.delete_files.main.cpu_count", MagicMock(return_value=1))
+@patch("backend.ecs_tasks.delete_files.main.estimate_memory")
+@patch("backend.ecs_tasks.delete_files.main.WorkerPool")
+@patch("backend.ecs_tasks.delete_files.main.get_queue")
+def test_it_runs_small_objects_alongside_one_large_object_per_cpu(
+    mock_queue, mock_pool, mock_estimate
+):
+    mock_queue.return_value = mock_queue
+    msgs = [MagicMock(receipt_handle="receipt_handle_{}".format(i)) for i in range(3)]
+    mock_queue.receive_messages.side_effect = [msgs, RuntimeError("Break loop")]
+    estimates = {
+        msgs[0].body: 2**30,
+        msgs[1].body: 2**30,
+        msgs[2].body: 256 * 2**20 + 2**20,
+    }
+    mock_estimate.side_effect = lambda body, _: estimates[body]
+    pool = worker_pool_stub(mock_pool, size=2, complete=False)
+    with pytest.raises(RuntimeError):
+        main("https://queue/url", 3, 0, 1, visibility_timeout=600)
+    # The second large object waits for the CPU, the small one overtakes it
+    assert [c[0][0][2] for c in pool.submit.call_args_list] == [
+        "receipt_handle_0",
+        "receipt_handle_2",
+    ]
+
+
+@patch("backend.ecs_tasks.delete_files.main.signal", MagicMock())
+@patch("backend.ecs_tasks.delete_files.main.cpu_count", MagicMock(return_value=4))
+@patch(
+    "backend.ecs_tasks.delete_files.main.get_memory_limit",
+    MagicMock(return_value=1000),
+)
+@patch("backend.ecs_tasks.delete_files.main.estimate_memory")
+@patch("backend.ecs_tasks.delete_files.main.WorkerPool")
+@patch("backend.ecs_tasks.delete_files.main.get_queue")
+def test_it_admits_pending_messages_once_memory_is_released(
+    mock_queue, mock_pool, mock_estimate
+):
+    mock_queue.return_value = mock_queue
+    mock_queue.receive_messages.side_effect = [
+        [
+            MagicMock(receipt_handle="receipt_handle_1"),
+            MagicMock(receipt_handle="receipt_handle_2"),
+        ],
+        RuntimeError("Break loop"),
+    ]
+    # Larger than the budget, yet admitted when nothing else is running
+    mock_estimate.return_value = 5000
+    pool = worker_pool_stub(mock_pool, size=4)
+    with pytest.raises(RuntimeError):
+        main("https://queue/url", 2, 0, 1, visibility_timeout=600)
+    assert [c[0][0][2] for c in pool.submit.call_args_list] == [
+        "receipt_handle_1",
+        "receipt_handle_2",
+    ]
+
+
+@patch("backend.ecs_tasks.delete_files.main.get_clients")
+@patch("backend.ecs_tasks.delete_files.main.get_object_info")
+def test_it_estimates_memory_from_object_size(
+    mock_get_object_info, mock_clients, message_stub
+):
+    mock_clients.return_value = MagicMock(), MagicMock()
+    mock_get_object_info.__wrapped__ = MagicMock(
+        return_value=({}, {"ContentLength": 100 * 2**20, "Metadata": {}})
+    )
+    body = message_stub(Format="json")
+    assert estimate_memory(body) == (256 + 200) * 2**20
+    mock_get_object_info.__wrapped__.assert_called_with(
+        ANY, "bucket", "path/basic.parquet"
+    )
+    body = message_stub(Format="parquet")
+    assert estimate_memory(body) == (256 + 400) * 2**20
+    assert estimate_memory(body, stream_objects=True) == (256 + 400) * 2**20
+    mock_get_object_info.__wrapped__.return_value = (
+        {},
+        {"ContentLength": 2**30, "Metadata": {}},
+    )
+    assert estimate_memory(body, stream_objects=True) == (256 + 512) * 2**20
+    mock_get_object_info.__wrapped__.return_value = (
+        {},
+        {
+            "ContentLength": 2**30,
+            "Metadata": {
+                "x-amz-key-v2": "key",
+                "x-amz-wrap-alg": "kms",
+                "x-amz-cek-alg": "AES/GCM/NoPadding",
+            },
+        },
+    )
+    assert estimate_memory(body, stream_objects=True) == 256 * 2**20 + 4 * 2**30
+
+
+@patch("backend.ecs_tasks.delete_files.main.get_clients", MagicMock())
+@patch("backend.ecs_tasks.delete_files.main.get_object_info")
+def test_it_estimates_baseline_memory_when_object_is_unavailable(
+    mock_get_object_info, message_stub
+):
+    mock_get_object_info.__wrapped__ = MagicMock(
+        side_effect=ClientError({"Error": {"Code": "404"}}, "HeadObject")
+    )
+    assert estimate_memory(message_stub()) == 256 * 2**20
+    assert estimate_memory("not json") == 256 * 2**20
+
+
+@patch("os.sysconf", MagicMock(return_value=2**16))
+@patch("builtins.open")
+def test_it_reads_memory_limit_from_cgroup(mock_open):
+    mock_open.return_value.__enter__.return_value.read.return_value = "1073741824\n"
+    assert get_memory_limit() == 2**30
+    mock_open.assert_called_with("/sys/fs/cgroup/memory.max")
+
+
+@patch("os.sysconf", MagicMock(return_value=2**16))
+@patch("builtins.open")
+def test_it_falls_back_to_physical_memory_without_cgroup_limit(mock_open):
+    mock_open.return_value.__enter__.return_value.read.return_value = "max\n"
+    assert get_memory_limit() == 2**32
+    mock_open.side_effect = OSError()
+    assert get_memory_limit() == 2**32
+
+
+def test_it_extends_visibility_in_batches():
+    queue = MagicMock()
+    queue.change_message_visibility_batch.return_value = {"Successful": []}
+    messages = [MagicMock(receipt_handle=str(i)) for i in range(12)]
+    extend_visibility(queue, messages, 600)
+    assert queue.change_message_visibility_batch.call_count == 2
+    first_batch = queue.change_message_visibility_batch.call_args_list[0][1]
+    assert len(first_batch["Entries"]) == 10
+    assert first_batch["Entries"][0] == {
+        "Id": "0",
+        "ReceiptHandle": "0",
+        "VisibilityTimeout": 600,
+    }
+    last_batch = queue.change_message_visibility_batch.call_args_list[1][1]
+    assert [e["ReceiptHandle"] for e in last_batch["Entries"]] == ["10", "11"]
+
+
+@patch("backend.ecs_tasks.delete_files.main.logger")
+def test_it_logs_visibility_extension_failures(mock_logger):
+    queue = MagicMock()
+    queue.change_message_visibility_batch.side_effect = [
+        {"Failed": [{"Id": "0", "Message": "Message does not exist"}]},
+        ClientError({}, "ChangeMessageVisibilityBatch"),
+    ]
+    messages = [MagicMock(receipt_handle=str(i)) for i in range(11)]
+    extend_visibility(queue, messages, 600)
+    assert mock_logger.warning.call_count == 2
+
+
+@patch("backend.ecs_tasks.delete_files.main.pa.default_memory_pool")
+@patch("backend.ecs_tasks.delete_files.main.clear_object_caches")
+@patch("backend.ecs_tasks.delete_files.main.execute")
+def test_it_executes_in_worker(mock_execute, mock_clear, mock_memory_pool):
+    execute_in_worker(
+        ("https://queue/url", "body", "receipt_handle"), stream_objects=True
+    )
+    mock_execute.assert_called_with(
+        "https://queue/url", "body", "receipt_handle", stream_objects=True
+    )
+    mock_clear.assert_called()
+    mock_memory_pool.return_value.release_unused.assert_called()
+
+
+@patch("backend.ecs_tasks.delete_files.main.get_session")
+def test_it_caches_clients_per_role(mock_session):
+    assert get_clients("arn:aws:iam::123:role/a") is get_clients(
+        "arn:aws:iam::123:role/a"
+    )
+    get_clients("arn:aws:iam::123:role/b")
+    mock_session.assert_has_calls(
+        [
+            call("arn:aws:iam::123:role/a", "s3f2"),
+            call("arn:aws:iam::123:role/b", "s3f2"),
+        ],
+        any_order=True,
+    )
+    assert mock_session.call_count == 2
+
+
+@patch("backend.ecs_tasks.delete_files.main.WorkerPool")
 @patch("backend.ecs_tasks.delete_files.main.signal", MagicMock())
 @patch("backend.ecs_tasks.delete_files.main.get_queue")
 @patch("backend.ecs_tasks.delete_files.main.time")
-def test_it_sleeps_where_no_messages(mock_time, mock_queue):
+def test_it_sleeps_where_no_messages(mock_time, mock_queue, mock_pool):
     mock_queue.return_value = mock_queue
+    worker_pool_stub(mock_pool)
     mock_queue.receive_messages.return_value = []
+    mock_time.monotonic.return_value = 0
     # Break out of while loop
     mock_time.sleep.side_effect = RuntimeError("Break Loop")
     with pytest.raises(RuntimeError):
@@ -1108,11 +1791,12 @@ def test_it_sleeps_where_no_messages(mock_time, mock_queue):
     mock_time.sleep.assert_called_with(1)
 
 
-@patch("backend.ecs_tasks.delete_files.main.get_context", MagicMock())
+@patch("backend.ecs_tasks.delete_files.main.WorkerPool")
 @patch("backend.ecs_tasks.delete_files.main.signal")
 @patch("backend.ecs_tasks.delete_files.main.get_queue")
-def test_it_sets_kill_handlers(mock_queue, mock_signal):
+def test_it_sets_kill_handlers(mock_queue, mock_signal, mock_pool):
     mock_queue.return_value = mock_queue
+    worker_pool_stub(mock_pool)
     # Break out of while loop
     mock_queue.receive_messages.side_effect = RuntimeError("Break Loop")
     with pytest.raises(RuntimeError):
@@ -1127,7 +1811,7 @@ def test_it_deletes_from_json_file(mock_parquet, mock_json):
     f = MagicMock()
     cols = MagicMock()
     delete_matches_from_file(f, cols, "json", False)
-    mock_json.assert_called_with(f, cols, False)
+    mock_json.assert_called_with(f, cols, False, 1)
     mock_parquet.assert_not_called()
 
 
@@ -1137,7 +1821,7 @@ def test_it_deletes_from_parquet_file(mock_parquet, mock_json):
     f = MagicMock()
     cols = MagicMock()
     delete_matches_from_file(f, cols, "parquet")
-    mock_parquet.assert_called_with(f, cols)
+    mock_parquet.assert_called_with(f, cols, None)
     mock_json.assert_not_called()
 
 
@@ -1200,3 +1884,80 @@ def test_it_builds_matches_grouped_by_column_mixed(mock_fetch):
         {"Column": "first_name", "MatchIds": set(["smith"])},
         {"Column": "last_name", "MatchIds": set(["smith", "parker"])},
     ]
+
+
+@patch("backend.ecs_tasks.delete_files.main.fetch_manifest")
+def test_it_reuses_the_match_index_for_the_same_manifest(mock_fetch):
+    mock_fetch.return_value = '{"Columns":["customer_id"], "MatchId": ["12345"], "QueryableColumns": "customer_id"}\n'
+
+    first = build_matches([{"Column": "customer_id"}], "s3://path-to-manifest.json")
+    second = build_matches([{"Column": "customer_id"}], "s3://path-to-manifest.json")
+    first[0]["MatchIds"] = set()
+    build_matches([{"Column": "customer_id"}], "s3://other-manifest.json")
+
+    assert second == [{"Column": "customer_id", "MatchIds": set(["12345"])}]
+    assert mock_fetch.call_args_list == [
+        call("s3://path-to-manifest.json"),
+        call("s3://other-manifest.json"),
+    ]
+
+
+@patch("backend.ecs_tasks.delete_files.main.get_manifest_cache_path")
+@patch("backend.ecs_tasks.delete_files.main.fetch_manifest")
+def test_it_shares_parsed_manifests_between_workers(mock_fetch, mock_path, tmp_path):
+    mock_path.return_value = str(tmp_path / "manifest.pickle")
+    mock_fetch.return_value = '{"Columns":["customer_id"], "MatchId": ["12345"], "QueryableColumns": "customer_id"}\n'
+    with patch("backend.ecs_tasks.delete_files.main.MANIFEST_CACHE_DIR", str(tmp_path)):
+        first = build_matches([{"Column": "customer_id"}], "s3://manifest.json")
+        # Simulates another worker process
+        build_match_index.cache_clear()
+        second = build_matches([{"Column": "customer_id"}], "s3://manifest.json")
+
+    assert first == second == [{"Column": "customer_id", "MatchIds": set(["12345"])}]
+    mock_fetch.assert_called_once()
+
+
+@patch("backend.ecs_tasks.delete_files.main.get_clients")
+def test_it_keys_cached_manifests_by_etag(mock_get_clients):
+    mock_client = MagicMock()
+    mock_get_clients.return_value = mock_client, None
+    mock_client.head_object.side_effect = [{"ETag": '"a"'}, {"ETag": '"b"'}]
+
+    first = get_manifest_cache_path("s3://bucket/manifest.json")
+    second = get_manifest_cache_path("s3://bucket/manifest.json")
+
+    assert first != second
+    assert first.endswith(".pickle")
+    mock_client.head_object.assert_called_with(Bucket="bucket", Key="manifest.json")
+
+
+@patch("backend.ecs_tasks.delete_files.main.get_clients")
+def test_it_skips_the_manifest_cache_for_unidentified_manifests(mock_get_clients):
+    mock_client = MagicMock()
+    mock_get_clients.return_value = mock_client, None
+    mock_client.head_object.side_effect = ClientError({}, "HeadObject")
+
+    assert get_manifest_cache_path("s3://bucket/manifest.json") is None
+
+
+def test_it_ignores_unreadable_cached_manifests(tmp_path):
+    path = tmp_path / "manifest.pickle"
+    path.write_bytes(b"not a pickle")
+
+    assert load_match_index(str(path)) is None
+    assert load_match_index(str(tmp_path / "missing.pickle")) is None
+
+
+def test_it_only_keeps_the_latest_cached_manifests(tmp_path):
+    with patch(
+        "backend.ecs_tasks.delete_files.main.MANIFEST_CACHE_DIR", str(tmp_path)
+    ), patch("backend.ecs_tasks.delete_files.main.MANIFEST_CACHE_SIZE", 2):
+        for i in range(3):
+            path = str(tmp_path / "{}.pickle".format(i))
+            save_match_index(path, {"customer_id": frozenset([i])})
+            os.utime(path, (i, i))
+
+    assert sorted(os.listdir(tmp_path)) == ["1.pickle", "2.pickle"]
+    assert load_match_index(str(tmp_path / "2.pickle")) == {
+        "customer_id": frozenset([2])
+    }
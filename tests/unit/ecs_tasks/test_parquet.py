@@ -1,5 +1,5 @@
 from io import BytesIO
-from mock import patch
+from mock import call, patch
 from decimal import Decimal
 
 import pyarrow as pa
@@ -11,14 +11,16 @@ import tempfile
 from backend.ecs_tasks.delete_files.parquet_handler import (
     delete_matches_from_parquet_file,
     delete_from_table,
+    get_rows_to_delete,
     load_parquet,
+    stream_matches_from_parquet_file,
 )
 
 pytestmark = [pytest.mark.unit, pytest.mark.ecs_tasks]
 
 
 @patch("backend.ecs_tasks.delete_files.parquet_handler.load_parquet")
-@patch("backend.ecs_tasks.delete_files.parquet_handler.delete_from_table")
+@patch("backend.ecs_tasks.delete_files.parquet_handler.get_rows_to_delete")
 def test_it_generates_new_parquet_file_without_matches(mock_delete, mock_load_parquet):
     # Arrange
     column = {
@@ -32,11 +34,10 @@ def test_it_generates_new_parquet_file_without_matches(mock_delete, mock_load_pa
     df.to_parquet(buf)
     br = pa.BufferReader(buf.getvalue())
     f = pq.ParquetFile(br, memory_map=False)
-    mock_df = pd.DataFrame([{"customer_id": "12345"}])
-    mock_delete.return_value = [pa.Table.from_pandas(mock_df), 1]
+    mock_delete.return_value = pa.array([True, False])
     mock_load_parquet.return_value = f
     # Act
-    out, stats = delete_matches_from_parquet_file("input_file.parquet", column)
+    out, stats = delete_matches_from_parquet_file("input_file.parquet", [column])
     assert isinstance(out, pa.BufferOutputStream)
     assert {"ProcessedRows": 2, "DeletedRows": 1} == stats
     res = pa.BufferReader(out.getvalue())
@@ -421,3 +422,299 @@ def test_it_throws_for_invalid_schema_column_not_found():
         table = pa.Table.from_pandas(df)
         table, deleted_rows = delete_from_table(table, columns)
     assert e.value.args[0] == "Column user_info.personal_information.name not found."
+
+
+def test_it_matches_simple_columns_without_row_by_row_fallback():
+    data = {
+        "customer_id": [12345, 23456, None, 34567],
+        "user_info": [
+            {"personal_information": {"name": "matteo"}},
+            None,
+            {"personal_information": {"name": "nick"}},
+            {"personal_information": {"name": "chris"}},
+        ],
+    }
+    columns = [
+        {"Column": "customer_id", "MatchIds": set([12345]), "Type": "Simple"},
+        {
+            "Column": "USER_INFO.personal_information.NAME",
+            "MatchIds": set(["chris"]),
+            "Type": "Simple",
+        },
+    ]
+    table = pa.Table.from_pydict(data)
+    with patch(
+        "backend.ecs_tasks.delete_files.parquet_handler.get_row_indexes_to_delete"
+    ) as mock_fallback:
+        table, deleted_rows = delete_from_table(table, columns)
+        mock_fallback.assert_not_called()
+    assert deleted_rows == 2
+    assert table.column("customer_id").to_pylist() == [23456, None]
+
+
+def test_it_matches_dictionary_encoded_columns():
+    table = pa.Table.from_pydict(
+        {"customer_id": pa.array(["12345", "23456", "12345"]).dictionary_encode()}
+    )
+    columns = [{"Column": "customer_id", "MatchIds": set(["12345"]), "Type": "Simple"}]
+    table, deleted_rows = delete_from_table(table, columns)
+    assert deleted_rows == 2
+    assert table.column("customer_id").to_pylist() == ["23456"]
+
+
+def test_it_falls_back_to_row_by_row_matching_for_lossy_conversions():
+    table = pa.Table.from_pydict({"customer_id": [1, 2, 3]})
+    columns = [
+        {"Column": "customer_id", "MatchIds": set([1.5, "2", 3]), "Type": "Simple"}
+    ]
+    table, deleted_rows = delete_from_table(table, columns)
+    assert deleted_rows == 1
+    assert table.column("customer_id").to_pylist() == [1, 2]
+
+
+def test_it_falls_back_to_row_by_row_matching_for_out_of_range_match_ids():
+    table = pa.Table.from_pydict(
+        {
+            "unsigned_id": pa.array([1, 2, 3], type=pa.uint64()),
+            "signed_id": pa.array([1, 2, 3], type=pa.int64()),
+        }
+    )
+    columns = [
+        {"Column": "unsigned_id", "MatchIds": set([-1, 1]), "Type": "Simple"},
+        {"Column": "signed_id", "MatchIds": set([2**63, 2]), "Type": "Simple"},
+    ]
+    table, deleted_rows = delete_from_table(table, columns)
+    assert deleted_rows == 2
+    assert table.column("unsigned_id").to_pylist() == [3]
+
+
+def test_it_matches_composite_columns_without_row_by_row_fallback():
+    data = {
+        "customer_id": [12345, 23456, 34567, 45678, 56789],
+        "age": [11, 12, 12, None, 11],
+        "details": [
+            {"first_name": "John", "last_name": "Doe"},
+            {"first_name": "Jane", "last_name": "Doe"},
+            {"first_name": "Matteo", "last_name": "Hey"},
+            {"first_name": "Jane", "last_name": "Doe"},
+            {"first_name": "John", "last_name": "Doe"},
+        ],
+    }
+    columns = [
+        {
+            "Columns": ["Details.First_Name", "details.last_name", "age"],
+            "MatchIds": set([tuple(["John", "Doe", 11]), tuple(["Jane", "Doe", 12])]),
+            "Type": "Composite",
+        }
+    ]
+    table = pa.Table.from_pydict(data)
+    with patch(
+        "backend.ecs_tasks.delete_files.parquet_handler.get_row_indexes_to_delete_for_composite"
+    ) as mock_fallback:
+        table, deleted_rows = delete_from_table(table, columns)
+        mock_fallback.assert_not_called()
+    assert deleted_rows == 3
+    assert table.column("customer_id").to_pylist() == [34567, 45678]
+
+
+def test_it_falls_back_to_row_by_row_composite_matching_for_lossy_conversions():
+    table = pa.Table.from_pydict({"age": [1, 2, 3], "last_name": ["doe", "doe", "doe"]})
+    columns = [
+        {
+            "Columns": ["age", "last_name"],
+            "MatchIds": set([tuple([1.5, "doe"]), tuple([3, "doe"])]),
+            "Type": "Composite",
+        }
+    ]
+    table, deleted_rows = delete_from_table(table, columns)
+    assert deleted_rows == 1
+    assert table.column("age").to_pylist() == [1, 2]
+
+
+def test_it_falls_back_to_row_by_row_composite_matching_for_out_of_range_match_ids():
+    table = pa.Table.from_pydict(
+        {
+            "age": pa.array([1, 2, 3], type=pa.uint64()),
+            "last_name": ["doe", "doe", "doe"],
+        }
+    )
+    columns = [
+        {
+            "Columns": ["age", "last_name"],
+            "MatchIds": set([tuple([-1, "doe"]), tuple([2, "doe"])]),
+            "Type": "Composite",
+        }
+    ]
+    table, deleted_rows = delete_from_table(table, columns)
+    assert deleted_rows == 1
+    assert table.column("age").to_pylist() == [1, 3]
+
+
+def test_it_streams_parquet_files_row_group_by_row_group():
+    table = pa.Table.from_pydict({"customer_id": ["12345", "23456"] * 3})
+    buf = BytesIO()
+    pq.write_table(table, buf, row_group_size=2)
+    columns = [{"Column": "customer_id", "MatchIds": set(["12345"]), "Type": "Simple"}]
+    with pa.BufferOutputStream() as out_stream:
+        stats = stream_matches_from_parquet_file(
+            pa.BufferReader(buf.getvalue()), out_stream, columns
+        )
+        newf = pq.ParquetFile(pa.BufferReader(out_stream.getvalue()))
+    assert {"ProcessedRows": 6, "DeletedRows": 3} == stats
+    assert 3 == newf.num_row_groups
+    assert ["23456"] * 3 == newf.read().column("customer_id").to_pylist()
+
+
+def test_it_skips_row_groups_excluded_by_statistics():
+    table = pa.Table.from_pydict(
+        {
+            "customer_id": [1, 2, 3, 4, 5, 6],
+            "user_info": [{"name": n} for n in ["a", "b", "c", "d", "e", "f"]],
+        }
+    )
+    buf = BytesIO()
+    pq.write_table(table, buf, row_group_size=2)
+    columns = [
+        {"Column": "customer_id", "MatchIds": set([4, 100]), "Type": "Simple"},
+        {
+            "Columns": ["customer_id", "User_Info.Name"],
+            "MatchIds": set([tuple([2, "b"]), tuple([1, "z"])]),
+            "Type": "Composite",
+        },
+    ]
+    with patch(
+        "backend.ecs_tasks.delete_files.parquet_handler.get_rows_to_delete",
+        wraps=get_rows_to_delete,
+    ) as mock_delete:
+        with pa.BufferOutputStream() as out_stream:
+            stats = stream_matches_from_parquet_file(
+                pa.BufferReader(buf.getvalue()), out_stream, columns
+            )
+            newf = pq.ParquetFile(pa.BufferReader(out_stream.getvalue()))
+    assert {"ProcessedRows": 6, "DeletedRows": 2} == stats
+    assert [1, 3, 5, 6] == newf.read().column("customer_id").to_pylist()
+    assert 3 == newf.num_row_groups
+    # Third row group is skipped entirely, others only evaluate candidates
+    assert 2 == mock_delete.call_count
+    assert [columns[1]] == mock_delete.call_args_list[0][0][1]
+    assert [columns[0]] == mock_delete.call_args_list[1][0][1]
+
+
+def test_it_casts_match_ids_before_comparing_statistics():
+    table = pa.Table.from_pydict(
+        {"customer_id": pa.array([Decimal("1.20"), Decimal("2.30")])}
+    )
+    buf = BytesIO()
+    pq.write_table(table, buf)
+    columns = [
+        {"Column": "customer_id", "MatchIds": set(["2.30"]), "Type": "Simple"},
+    ]
+    with pa.BufferOutputStream() as out_stream:
+        stats = stream_matches_from_parquet_file(
+            pa.BufferReader(buf.getvalue()), out_stream, columns
+        )
+    assert {"ProcessedRows": 2, "DeletedRows": 1} == stats
+
+
+def test_it_only_reads_identifier_columns_when_nothing_matches():
+    table = pa.Table.from_pydict(
+        {"customer_id": [1, 2, 3, 4], "other": ["a", "b", "c", "d"]}
+    )
+    buf = BytesIO()
+    pq.write_table(table, buf, row_group_size=2)
+    parquet_file = pq.ParquetFile(pa.BufferReader(buf.getvalue()))
+    columns = [{"Column": "Customer_Id", "MatchIds": set([1.5, 3.5]), "Type": "Simple"}]
+    with patch.object(
+        parquet_file, "read_row_group", wraps=parquet_file.read_row_group
+    ) as mock_read:
+        with patch(
+            "backend.ecs_tasks.delete_files.parquet_handler.load_parquet",
+            return_value=parquet_file,
+        ):
+            out, stats = delete_matches_from_parquet_file("input_file", columns)
+    assert {"ProcessedRows": 4, "DeletedRows": 0} == stats
+    assert 0 == len(out.getvalue())
+    assert [call(0, columns=["customer_id"]), call(1, columns=["customer_id"])] == (
+        mock_read.call_args_list
+    )
+
+
+def test_it_reuses_match_detection_masks_when_rewriting():
+    table = pa.Table.from_pydict(
+        {"customer_id": [1, 2, 3, 4], "other": ["a", "b", "c", "d"]}
+    )
+    buf = BytesIO()
+    pq.write_table(table, buf, row_group_size=2)
+    parquet_file = pq.ParquetFile(pa.BufferReader(buf.getvalue()))
+    columns = [{"Column": "customer_id", "MatchIds": set([2, 3]), "Type": "Simple"}]
+    with patch(
+        "backend.ecs_tasks.delete_files.parquet_handler.get_rows_to_delete",
+        wraps=get_rows_to_delete,
+    ) as mock_delete:
+        with pa.BufferOutputStream() as out_stream:
+            stats = stream_matches_from_parquet_file(
+                pa.BufferReader(buf.getvalue()), out_stream, columns
+            )
+            newf = pq.ParquetFile(pa.BufferReader(out_stream.getvalue()))
+    assert {"ProcessedRows": 4, "DeletedRows": 2} == stats
+    assert 2 == mock_delete.call_count
+    assert ["customer_id"] == mock_delete.call_args_list[0][0][0].column_names
+    assert {"customer_id": [1, 4], "other": ["a", "d"]} == newf.read().to_pydict()
+
+
+def test_it_preserves_source_writer_properties():
+    table = pa.Table.from_pydict(
+        {"customer_id": [1, 2, 3, 4, 5, 6], "other": ["a", "b"] * 3}
+    )
+    buf = BytesIO()
+    pq.write_table(
+        table,
+        buf,
+        row_group_size=3,
+        compression={"customer_id": "ZSTD", "other": "GZIP"},
+        use_dictionary=["other"],
+        version="1.0",
+    )
+    columns = [{"Column": "customer_id", "MatchIds": set([2]), "Type": "Simple"}]
+    with pa.BufferOutputStream() as out_stream:
+        stream_matches_from_parquet_file(
+            pa.BufferReader(buf.getvalue()), out_stream, columns
+        )
+        newf = pq.ParquetFile(pa.BufferReader(out_stream.getvalue()))
+    metadata = newf.metadata
+    assert "1.0" == metadata.format_version
+    assert [2, 3] == [
+        metadata.row_group(i).num_rows for i in range(metadata.num_row_groups)
+    ]
+    customer_id, other = metadata.row_group(0).column(0), metadata.row_group(0).column(
+        1
+    )
+    assert "ZSTD" == customer_id.compression
+    assert "GZIP" == other.compression
+    assert not customer_id.has_dictionary_page
+    assert other.has_dictionary_page
+
+
+def test_it_applies_writer_option_overrides():
+    table = pa.Table.from_pydict({"customer_id": [1, 2, 3, 4, 5, 6]})
+    buf = BytesIO()
+    pq.write_table(table, buf, compression="SNAPPY")
+    columns = [{"Column": "customer_id", "MatchIds": set([2]), "Type": "Simple"}]
+    writer_options = {
+        "Compression": "zstd",
+        "RowGroupSize": 2,
+        "UseDictionary": False,
+        "WriteStatistics": False,
+    }
+    with pa.BufferOutputStream() as out_stream:
+        stream_matches_from_parquet_file(
+            pa.BufferReader(buf.getvalue()), out_stream, columns, writer_options
+        )
+        newf = pq.ParquetFile(pa.BufferReader(out_stream.getvalue()))
+    metadata = newf.metadata
+    assert 3 == metadata.num_row_groups
+    column = metadata.row_group(0).column(0)
+    assert "ZSTD" == column.compression
+    assert not column.has_dictionary_page
+    assert not column.is_stats_set
+    assert [1, 3, 4, 5, 6] == newf.read().column("customer_id").to_pylist()
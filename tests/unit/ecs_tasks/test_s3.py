@@ -5,9 +5,10 @@ from mock import patch, MagicMock, call, ANY
 from io import BytesIO
 
 import pytest
-from botocore.exceptions import ClientError
+from botocore.exceptions import ClientError, IncompleteReadError
 
 from backend.ecs_tasks.delete_files.s3 import (
+    clear_object_caches,
     delete_old_versions,
     DeleteOldVersionsError,
     fetch_job_manifest,
@@ -16,8 +17,11 @@ from backend.ecs_tasks.delete_files.s3 import (
     get_grantees,
     get_object_acl,
     get_object_info,
+    get_object_settings,
     get_object_tags,
     IntegrityCheckFailedError,
+    MultipartUpload,
+    RangedObjectReader,
     rollback_object_version,
     save,
     s3transfer,
@@ -238,6 +242,51 @@ def test_it_handles_versions_for_get_acl(mock_requester):
     )
 
 
+def test_it_gets_object_settings():
+    for fn in [get_requester_payment, get_object_info, get_object_tags, get_object_acl]:
+        fn.cache_clear()
+    client = MagicMock()
+    client.get_bucket_request_payment.return_value = {"Payer": "Requester"}
+    client.head_object.return_value = {"Metadata": {}, "ContentType": "text/plain"}
+    client.get_object_tagging.return_value = {"TagSet": [{"Key": "a", "Value": "b"}]}
+    client.get_object_acl.return_value = {"Owner": {"ID": "a"}, "Grants": []}
+
+    extra_args, request_payer_args, acl_args, acl_resp = get_object_settings(
+        client, "bucket", "key", {"meta": "data"}, "abc123"
+    )
+
+    assert extra_args == {
+        "RequestPayer": "requester",
+        "ContentType": "text/plain",
+        "Metadata": {"meta": "data"},
+        "Tagging": "a=b",
+        **acl_args,
+    }
+    assert request_payer_args == {"RequestPayer": "requester"}
+    assert acl_resp == {"Owner": {"ID": "a"}, "Grants": []}
+    client.get_bucket_request_payment.assert_called_once()
+    client.head_object.assert_called_once_with(
+        Bucket="bucket", Key="key", VersionId="abc123", RequestPayer="requester"
+    )
+
+
+def test_it_clears_object_caches():
+    clear_object_caches()
+    client = MagicMock()
+    client.get_bucket_request_payment.return_value = {"Payer": "BucketOwner"}
+    client.head_object.return_value = {"Metadata": {}}
+    client.get_bucket_versioning.return_value = {"Status": "Enabled"}
+    for _ in range(2):
+        get_object_info(client, "bucket", "key")
+        validate_bucket_versioning(client, "bucket")
+    clear_object_caches()
+    get_object_info(client, "bucket", "key")
+    validate_bucket_versioning(client, "bucket")
+    assert client.head_object.call_count == 2
+    assert client.get_bucket_request_payment.call_count == 2
+    assert client.get_bucket_versioning.call_count == 2
+
+
 def test_it_gets_grantees_by_type():
     acl = {
         "Owner": {"ID": "owner_id"},
@@ -721,17 +770,226 @@ def test_it_handles_error_for_generic_errors():
 
 
 @patch("backend.ecs_tasks.delete_files.s3.fetch_job_manifest")
-def test_it_caches_manifests(mock_fetch):
-    fetch_manifest.cache_clear()
-    fetch_manifest("s3://path/to/manifest1.json")
-    fetch_manifest("s3://path/to/manifest1.json")
-    fetch_manifest("s3://path/to/manifest2.json")
+def test_it_fetches_manifests(mock_fetch):
+    mock_fetch.return_value = "manifest"
+
+    assert fetch_manifest("s3://path/to/manifest1.json") == "manifest"
+    mock_fetch.assert_called_with("s3://path/to/manifest1.json")
+
+
+@patch("backend.ecs_tasks.delete_files.s3.get_requester_payment")
+def test_it_reads_object_version_ranges(mock_requester):
+    mock_client = MagicMock()
+    mock_requester.return_value = {"RequestPayer": "requester"}, {}
+    mock_client.get_object.side_effect = lambda **kwargs: {
+        "Body": BytesIO(b"x" * 4 if kwargs["Range"] == "bytes=6-9" else b"y" * 10)
+    }
+    reader = RangedObjectReader(mock_client, "bucket", "key", "v1", 10)
+    assert 10 == reader.seek(0, 2)
+    assert 6 == reader.seek(-4, 2)
+    assert b"xxxx" == reader.read(100)
+    assert 10 == reader.tell()
+    assert b"" == reader.read()
+    mock_client.get_object.assert_called_once_with(
+        Bucket="bucket",
+        Key="key",
+        VersionId="v1",
+        Range="bytes=6-9",
+        RequestPayer="requester",
+    )
+    reader.seek(0)
+    assert b"y" * 10 == reader.read()
 
-    assert mock_fetch.call_count == 2
-    mock_fetch.assert_has_calls(
-        [call("s3://path/to/manifest1.json"), call("s3://path/to/manifest2.json")],
-        any_order=True,
+
+@patch("time.sleep", MagicMock())
+@patch("backend.ecs_tasks.delete_files.s3.get_requester_payment")
+def test_it_retries_dropped_connections_when_reading_ranges(mock_requester):
+    mock_client = MagicMock()
+    mock_requester.return_value = {}, {}
+    dropped = MagicMock()
+    dropped.read.side_effect = IncompleteReadError(actual_bytes=2, expected_bytes=4)
+    mock_client.get_object.side_effect = [
+        {"Body": dropped},
+        {"Body": BytesIO(b"xxxx")},
+    ]
+    reader = RangedObjectReader(mock_client, "bucket", "key", "v1", 4)
+    assert b"xxxx" == reader.read()
+    assert 2 == mock_client.get_object.call_count
+    assert 4 == reader.tell()
+
+
+@patch("time.sleep", MagicMock())
+@patch("backend.ecs_tasks.delete_files.s3.get_requester_payment")
+def test_it_retries_throttled_range_reads(mock_requester):
+    mock_client = MagicMock()
+    mock_requester.return_value = {}, {}
+    mock_client.get_object.side_effect = [
+        ClientError({"Error": {"Code": "SlowDown"}}, "GetObject"),
+        ClientError(
+            {"Error": {"Code": "Oops"}, "ResponseMetadata": {"HTTPStatusCode": 503}},
+            "GetObject",
+        ),
+        {"Body": BytesIO(b"xxxx")},
+    ]
+    reader = RangedObjectReader(mock_client, "bucket", "key", "v1", 4)
+    assert b"xxxx" == reader.read()
+    assert 3 == mock_client.get_object.call_count
+
+
+@patch("time.sleep")
+@patch("backend.ecs_tasks.delete_files.s3.get_requester_payment")
+def test_it_doesnt_retry_permanent_range_read_errors(mock_requester, mock_sleep):
+    mock_client = MagicMock()
+    mock_requester.return_value = {}, {}
+    mock_client.get_object.side_effect = ClientError(
+        {
+            "Error": {"Code": "AccessDenied"},
+            "ResponseMetadata": {"HTTPStatusCode": 403},
+        },
+        "GetObject",
+    )
+    reader = RangedObjectReader(mock_client, "bucket", "key", "v1", 4)
+    with pytest.raises(ClientError, match="AccessDenied"):
+        reader.read()
+    assert 1 == mock_client.get_object.call_count
+    mock_sleep.assert_not_called()
+
+
+@patch("backend.ecs_tasks.delete_files.s3.get_object_settings")
+def test_it_sizes_parts_for_the_expected_size(mock_settings):
+    mock_client = MagicMock()
+    mock_settings.return_value = ({"Metadata": {}}, {}, {}, {"Grants": []})
+    mock_client.create_multipart_upload.return_value = {"UploadId": "upload1"}
+    assert 8 * 2**20 == MultipartUpload(mock_client, "bucket", "key", {}).part_size
+    assert (
+        8 * 2**20
+        == MultipartUpload(
+            mock_client, "bucket", "key", {}, expected_size=2**30
+        ).part_size
+    )
+    # 10,000 parts of 8 MB aren't enough for 200 GB
+    assert (
+        32 * 2**20
+        == MultipartUpload(
+            mock_client, "bucket", "key", {}, expected_size=200 * 2**30
+        ).part_size
+    )
+
+
+@patch("backend.ecs_tasks.delete_files.s3.get_object_settings")
+def test_it_uploads_parts_when_writing(mock_settings):
+    mock_client = MagicMock()
+    mock_settings.return_value = ({"Metadata": {}}, {}, {}, {"Grants": []})
+    mock_client.create_multipart_upload.return_value = {"UploadId": "upload1"}
+    mock_client.upload_part.side_effect = lambda **kwargs: {
+        "ETag": "etag{}".format(kwargs["PartNumber"])
+    }
+    mock_client.complete_multipart_upload.return_value = {"VersionId": "new_version"}
+    upload = MultipartUpload(mock_client, "bucket", "key", {}, "abc123", part_size=4)
+    upload.write(b"123")
+    mock_client.upload_part.assert_not_called()
+    upload.write(b"45678901")
+    assert 11 == upload.tell()
+    assert 2 == mock_client.upload_part.call_count
+    assert "new_version" == upload.complete()
+    mock_settings.assert_called_with(mock_client, "bucket", "key", {}, "abc123")
+    mock_client.create_multipart_upload.assert_called_with(
+        Bucket="bucket", Key="key", Metadata={}
+    )
+    mock_client.upload_part.assert_has_calls(
+        [
+            call(
+                Bucket="bucket",
+                Key="key",
+                UploadId="upload1",
+                PartNumber=1,
+                Body=b"1234",
+            ),
+            call(
+                Bucket="bucket",
+                Key="key",
+                UploadId="upload1",
+                PartNumber=2,
+                Body=b"5678",
+            ),
+            call(
+                Bucket="bucket",
+                Key="key",
+                UploadId="upload1",
+                PartNumber=3,
+                Body=b"901",
+            ),
+        ]
+    )
+    mock_client.complete_multipart_upload.assert_called_with(
+        Bucket="bucket",
+        Key="key",
+        UploadId="upload1",
+        MultipartUpload={
+            "Parts": [
+                {"ETag": "etag1", "PartNumber": 1},
+                {"ETag": "etag2", "PartNumber": 2},
+                {"ETag": "etag3", "PartNumber": 3},
+            ]
+        },
+    )
+    mock_client.put_object_acl.assert_not_called()
+
+
+@patch("backend.ecs_tasks.delete_files.s3.get_object_settings")
+def test_it_restores_write_permissions_for_multipart_uploads(mock_settings):
+    mock_client = MagicMock()
+    mock_settings.return_value = (
+        {"GrantFullControl": "id=abc"},
+        {"RequestPayer": "requester"},
+        {"GrantFullControl": "id=abc"},
+        {
+            "Owner": {"ID": "owner_id"},
+            "Grants": [
+                {
+                    "Grantee": {"ID": "123", "Type": "CanonicalUser"},
+                    "Permission": "WRITE",
+                },
+            ],
+        },
+    )
+    mock_client.create_multipart_upload.return_value = {"UploadId": "upload1"}
+    mock_client.upload_part.return_value = {"ETag": "etag1"}
+    mock_client.complete_multipart_upload.return_value = {"VersionId": "new_version"}
+    upload = MultipartUpload(mock_client, "bucket", "key", {})
+    upload.complete()
+    mock_client.upload_part.assert_called_with(
+        Bucket="bucket",
+        Key="key",
+        UploadId="upload1",
+        PartNumber=1,
+        Body=b"",
+        RequestPayer="requester",
+    )
+    mock_client.put_object_acl.assert_called_with(
+        Bucket="bucket",
+        Key="key",
+        VersionId="new_version",
+        RequestPayer="requester",
+        GrantFullControl="id=abc",
+        GrantWrite="id=123",
+    )
+
+
+@patch("backend.ecs_tasks.delete_files.s3.get_object_settings")
+def test_it_aborts_multipart_uploads(mock_settings):
+    mock_client = MagicMock()
+    mock_settings.return_value = ({}, {}, {}, {"Grants": []})
+    mock_client.create_multipart_upload.return_value = {"UploadId": "upload1"}
+    mock_client.abort_multipart_upload.side_effect = ClientError(
+        {"Error": {"Code": "NoSuchUpload"}}, "AbortMultipartUpload"
+    )
+    upload = MultipartUpload(mock_client, "bucket", "key", {})
+    upload.abort()
+    mock_client.abort_multipart_upload.assert_called_with(
+        Bucket="bucket", Key="key", UploadId="upload1"
     )
+    mock_client.complete_multipart_upload.assert_not_called()
 
 
 def test_s3transfer_locked_version():
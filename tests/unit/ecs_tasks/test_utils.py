@@ -3,7 +3,11 @@ from mock import patch, MagicMock, call
 
 import pytest
 
-from backend.ecs_tasks.delete_files.utils import retry_wrapper, remove_none
+from backend.ecs_tasks.delete_files.utils import (
+    retry_wrapper,
+    remove_none,
+    run_concurrently,
+)
 
 pytestmark = [pytest.mark.unit, pytest.mark.ecs_tasks]
 
@@ -74,3 +78,52 @@ def test_it_retries_and_gives_up_fn(sleep_mock):
 
 def test_it_removes_empty_keys():
     assert {"test": "value"} == remove_none({"test": "value", "none": None})
+
+
+def test_it_runs_fns_concurrently_in_order():
+    assert run_concurrently(lambda: 1, lambda: "a", lambda: None) == [1, "a", None]
+
+
+def test_it_raises_first_failure_when_running_concurrently():
+    def fail(e):
+        raise e
+
+    with pytest.raises(ValueError):
+        run_concurrently(
+            lambda: 1,
+            lambda: fail(ValueError("first")),
+            lambda: fail(KeyError("second")),
+        )
+
+
+@patch("time.sleep")
+def test_it_retries_given_exceptions(sleep_mock):
+    fn = MagicMock()
+    fn.side_effect = [ConnectionError(), 32]
+    result = retry_wrapper(fn, retry_wait_seconds=1, exceptions=(ConnectionError,))(22)
+
+    assert result == 32
+    assert fn.call_args_list == [call(22), call(22)]
+
+
+def test_it_doesnt_retry_other_exceptions():
+    fn = MagicMock()
+    fn.side_effect = ConnectionError()
+    with pytest.raises(ConnectionError):
+        retry_wrapper(fn, retry_wait_seconds=1)(22)
+    assert fn.call_count == 1
+
+
+@patch("time.sleep")
+def test_it_raises_exceptions_rejected_by_retry_if(sleep_mock):
+    fn = MagicMock()
+    fn.side_effect = [ConnectionError("transient"), ConnectionError("permanent")]
+    with pytest.raises(ConnectionError, match="permanent"):
+        retry_wrapper(
+            fn,
+            retry_wait_seconds=1,
+            exceptions=(ConnectionError,),
+            retry_if=lambda e: str(e) == "transient",
+        )(22)
+    assert fn.call_count == 2
+    sleep_mock.assert_called_once_with(1)
@@ -0,0 +1,144 @@
+import os
+import signal
+import time
+
+from mock import patch
+
+import pytest
+
+from backend.ecs_tasks.delete_files.workers import get_current_memory, WorkerPool
+
+pytestmark = [pytest.mark.unit, pytest.mark.ecs_tasks]
+
+
+def exit_on_negative(n):
+    if n < 0:
+        os._exit(-n)
+
+
+def ignore_sigterm(_):
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    time.sleep(60)
+
+
+def wait_for(pool, count):
+    completed = []
+    lost = []
+    while len(completed) + len(lost) < count:
+        done, exited = pool.wait(10)
+        completed += done
+        lost += exited
+    return completed if not lost else (completed, lost)
+
+
+def test_it_runs_tasks_in_worker_processes():
+    pool = WorkerPool(2, abs, 2**20)
+    try:
+        assert pool.idle == 2
+        pool.submit(-1)
+        pool.submit(-2)
+        assert pool.idle == 0
+        assert pool.busy == 2
+        assert sorted(wait_for(pool, 2)) == [-2, -1]
+        assert pool.idle == 2
+    finally:
+        pool.terminate()
+
+
+def test_it_completes_tasks_which_fail():
+    pool = WorkerPool(1, int, 2**20)
+    try:
+        pool.submit("not a number")
+        assert wait_for(pool, 1) == ["not a number"]
+        pool.submit("1")
+        assert wait_for(pool, 1) == ["1"]
+    finally:
+        pool.terminate()
+
+
+def test_it_reuses_workers_below_memory_limit():
+    pool = WorkerPool(1, abs, 2**20)
+    try:
+        pid = pool._idle[0][1].pid
+        pool.submit(1)
+        wait_for(pool, 1)
+        assert pool._idle[0][1].pid == pid
+    finally:
+        pool.terminate()
+
+
+def test_it_replaces_only_workers_above_memory_limit():
+    pool = WorkerPool(2, abs, -1)
+    try:
+        pids = {p.pid for _, p in pool._idle}
+        pool.submit(1)
+        wait_for(pool, 1)
+        # The busy worker is replaced, the other one is kept
+        new_pids = {p.pid for _, p in pool._idle}
+        assert len(new_pids) == 2
+        assert len(pids & new_pids) == 1
+        pool.submit(1)
+        pool.submit(2)
+        assert sorted(wait_for(pool, 2)) == [1, 2]
+    finally:
+        pool.terminate()
+
+
+def test_it_reports_tasks_of_workers_which_exit():
+    pool = WorkerPool(2, exit_on_negative, 2**20)
+    try:
+        pool.submit(-3)
+        pool.submit(1)
+        assert wait_for(pool, 2) == ([1], [-3])
+        assert pool.idle == 2
+        assert pool.busy == 0
+        pool.submit(2)
+        pool.submit(3)
+        assert sorted(wait_for(pool, 2)) == [2, 3]
+    finally:
+        pool.terminate()
+
+
+def test_it_replaces_idle_workers_which_exited():
+    pool = WorkerPool(1, abs, 2**20)
+    try:
+        process = pool._idle[0][1]
+        process.kill()
+        process.join()
+        pool.submit(-1)
+        assert wait_for(pool, 1) == [-1]
+        assert pool._idle[0][1].pid != process.pid
+    finally:
+        pool.terminate()
+
+
+def test_it_terminates_workers():
+    pool = WorkerPool(2, abs, 2**20)
+    processes = [p for _, p in pool._idle]
+    pool.terminate()
+    assert not any(p.is_alive() for p in processes)
+
+
+def test_it_kills_workers_which_dont_exit_within_the_grace_period():
+    pool = WorkerPool(1, ignore_sigterm, 2**20)
+    process = pool._idle[0][1]
+    pool.submit(1)
+    # Give the worker time to ignore SIGTERM
+    pool.wait(1)
+    start = time.monotonic()
+    pool.terminate(0.5)
+    assert time.monotonic() - start < 10
+    assert not process.is_alive()
+    assert process.exitcode == -signal.SIGKILL
+
+
+def test_it_reads_current_memory():
+    assert get_current_memory() > 0
+
+
+@patch("builtins.open")
+@patch("backend.ecs_tasks.delete_files.workers.resource")
+def test_it_falls_back_to_peak_memory(mock_resource, mock_open):
+    mock_open.side_effect = OSError()
+    mock_resource.getrusage.return_value.ru_maxrss = 2048
+    assert get_current_memory() == 2
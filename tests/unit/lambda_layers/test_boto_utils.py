@@ -1,5 +1,6 @@
 import datetime
 import decimal
+import gzip
 import json
 import types
 import mock
@@ -126,23 +127,25 @@ def test_it_batches_msgs():
     queue.attributes = {}
     msgs = list(range(0, 15))
     batch_sqs_msgs(queue, msgs)
-    queue.send_messages.assert_any_call(
+    queue.meta.client.send_message_batch.assert_any_call(
+        QueueUrl=queue.url,
         Entries=[
             {
                 "Id": ANY,
                 "MessageBody": json.dumps(x),
             }
             for x in range(0, 10)
-        ]
+        ],
     )
-    queue.send_messages.assert_any_call(
+    queue.meta.client.send_message_batch.assert_any_call(
+        QueueUrl=queue.url,
         Entries=[
             {
                 "Id": ANY,
                 "MessageBody": json.dumps(x),
             }
             for x in range(10, 15)
-        ]
+        ],
     )
 
 
@@ -151,14 +154,15 @@ def test_it_passes_through_queue_args():
     queue.attributes = {}
     msgs = [1]
     batch_sqs_msgs(queue, msgs, DelaySeconds=60)
-    queue.send_messages.assert_any_call(
+    queue.meta.client.send_message_batch.assert_any_call(
+        QueueUrl=queue.url,
         Entries=[
             {
                 "DelaySeconds": 60,
                 "Id": ANY,
                 "MessageBody": ANY,
             }
-        ]
+        ],
     )
 
 
@@ -167,12 +171,71 @@ def test_it_sets_message_group_id_where_queue_is_fifo():
     queue.attributes = {"FifoQueue": True}
     msgs = [1]
     batch_sqs_msgs(queue, msgs)
-    for call in queue.send_messages.call_args_list:
+    for call in queue.meta.client.send_message_batch.call_args_list:
         args, kwargs = call
         for msg in kwargs["Entries"]:
             assert "MessageGroupId" in msg
 
 
+def test_it_batches_msgs_by_payload_size():
+    queue = MagicMock()
+    queue.attributes = {}
+    msgs = ["x" * 100 * 1024 for _ in range(5)]
+    batch_sqs_msgs(queue, msgs)
+    assert [
+        len(c[1]["Entries"])
+        for c in queue.meta.client.send_message_batch.call_args_list
+    ] == [
+        2,
+        2,
+        1,
+    ]
+
+
+@patch("boto_utils.time", MagicMock())
+def test_it_retries_failed_msgs():
+    queue = MagicMock()
+    queue.attributes = {}
+    queue.meta.client.send_message_batch.side_effect = lambda QueueUrl, Entries: {
+        "Failed": (
+            [{"Id": Entries[0]["Id"], "SenderFault": False, "Code": "InternalError"}]
+            if queue.meta.client.send_message_batch.call_count == 1
+            else []
+        )
+    }
+    batch_sqs_msgs(queue, [1, 2])
+    assert queue.meta.client.send_message_batch.call_count == 2
+    retried = queue.meta.client.send_message_batch.call_args_list[1][1]["Entries"]
+    assert [e["MessageBody"] for e in retried] == ["1"]
+
+
+@patch("boto_utils.time", MagicMock())
+def test_it_raises_for_msgs_which_cannot_be_sent():
+    queue = MagicMock()
+    queue.attributes = {}
+    queue.meta.client.send_message_batch.side_effect = lambda QueueUrl, Entries: {
+        "Failed": [
+            {"Id": Entries[0]["Id"], "SenderFault": True, "Code": "InvalidMessage"}
+        ]
+    }
+    with pytest.raises(ValueError) as e:
+        batch_sqs_msgs(queue, [1])
+    assert e.value.args[0] == "Unable to send 1 messages to the queue: InvalidMessage"
+    assert queue.meta.client.send_message_batch.call_count == 1
+
+
+@patch("boto_utils.time", MagicMock())
+def test_it_raises_for_msgs_failing_all_attempts():
+    queue = MagicMock()
+    queue.attributes = {}
+    queue.meta.client.send_message_batch.side_effect = lambda QueueUrl, Entries: {
+        "Failed": [{"Id": e["Id"], "SenderFault": False} for e in Entries]
+    }
+    with pytest.raises(ValueError):
+        batch_sqs_msgs(queue, [1, 2])
+    assert queue.meta.client.send_message_batch.call_count == 3
+
+
 def test_it_truncates_received_messages_once_the_desired_amount_returned():
     queue = MagicMock()
     mock_list = [MagicMock() for i in range(0, 10)]
@@ -498,6 +561,19 @@ def test_it_fetches_s3_manifest(mock_s3):
     mock_read.decode.assert_called_once_with("utf-8")
 
 
+@patch("boto_utils.s3")
+def test_it_fetches_compressed_s3_manifest(mock_s3):
+    mock_s3.Object.return_value.get.return_value = {
+        "Body": MagicMock(read=MagicMock(return_value=gzip.compress(b'{"hi": true}\n')))
+    }
+    bucket = "my-bucket"
+    key = "manifests/job_id/data_mapper_id/manifest.json.gz"
+    result = fetch_job_manifest("s3://{}/{}".format(bucket, key))
+
+    assert result == '{"hi": true}\n'
+    mock_s3.Object.assert_called_once_with(bucket, key)
+
+
 def test_it_iterates_over_json_lines():
     json_content = '{"hello":123,"world":true}\n{"hello":456,"world":false}\n'
     result = json_lines_iterator(json_content)
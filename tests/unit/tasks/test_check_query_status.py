@@ -58,3 +58,68 @@ def test_it_provides_reason_where_supplied(mock_client):
         "Statistics": {"some": "stats"},
         "ExecutionRetriesLeft": 1,
     } == resp
+
+
+@patch("backend.lambdas.tasks.check_query_status.client")
+def test_it_waits_adaptively_for_queries(mock_client):
+    for elapsed, expected in [(1, 1), (900, 1), (4100, 3), (60000, 10)]:
+        mock_client.get_query_execution.return_value = {
+            "QueryExecution": {
+                "Status": {"State": "RUNNING"},
+                "Statistics": {"TotalExecutionTimeInMillis": elapsed},
+            }
+        }
+
+        resp = handler(
+            {
+                "QueryId": "1234-5678-9012-3456",
+                "ExecutionRetriesLeft": 2,
+                "WaitDuration": 10,
+                "MaxWaitDuration": 10,
+            },
+            SimpleNamespace(),
+        )
+        assert resp["WaitDuration"] == expected
+        assert resp["MaxWaitDuration"] == 10
+
+
+@patch("backend.lambdas.tasks.check_query_status.client")
+def test_it_waits_the_max_duration_for_queued_queries(mock_client):
+    for statistics in [{}, {"TotalExecutionTimeInMillis": 0}]:
+        mock_client.get_query_execution.return_value = {
+            "QueryExecution": {
+                "Status": {"State": "QUEUED"},
+                "Statistics": statistics,
+            }
+        }
+
+        resp = handler(
+            {
+                "QueryId": "1234-5678-9012-3456",
+                "ExecutionRetriesLeft": 2,
+                "WaitDuration": 10,
+                "MaxWaitDuration": 10,
+            },
+            SimpleNamespace(),
+        )
+        assert resp["WaitDuration"] == 10
+
+
+@patch("backend.lambdas.tasks.check_query_status.client")
+def test_it_keeps_the_wait_duration_without_a_max(mock_client):
+    mock_client.get_query_execution.return_value = {
+        "QueryExecution": {
+            "Status": {"State": "RUNNING"},
+            "Statistics": {"TotalExecutionTimeInMillis": 60000},
+        }
+    }
+
+    resp = handler(
+        {
+            "QueryId": "1234-5678-9012-3456",
+            "ExecutionRetriesLeft": 2,
+            "WaitDuration": 3,
+        },
+        SimpleNamespace(),
+    )
+    assert resp["WaitDuration"] == 3
@@ -1,16 +1,20 @@
+import gzip
 import json
 import os
 from types import SimpleNamespace
+from decimal import Decimal
 
 import mock
 import pytest
-from mock import patch, MagicMock
+from botocore.exceptions import ClientError
+from mock import patch, MagicMock, ANY
 
 with patch.dict(os.environ, {"QueryQueue": "test"}):
     from backend.lambdas.tasks.generate_queries import (
         cast_to_type,
         column_mapper,
         generate_athena_queries,
+        get_caster,
         get_data_mappers,
         get_deletion_queue,
         get_inner_children,
@@ -18,8 +22,10 @@ with patch.dict(os.environ, {"QueryQueue": "test"}):
         get_partitions,
         get_table,
         handler,
+        index_columns,
         write_partitions,
         MatchIdCastingError,
+        ManifestWriter,
     )
 
 pytestmark = [pytest.mark.unit, pytest.mark.task]
@@ -35,6 +41,12 @@ def lists_equal_ignoring_order(a, b):
     return not a
 
 
+def assert_manifest_written(s3_mock, Key, Body):
+    s3_mock.put_object.assert_called_with(Bucket=ANY, Key=Key, Body=ANY)
+    written = s3_mock.put_object.call_args[1]["Body"]
+    assert gzip.decompress(written).decode("utf-8") == Body
+
+
 @patch("backend.lambdas.tasks.generate_queries.write_partitions")
 @patch("backend.lambdas.tasks.generate_queries.batch_sqs_msgs")
 @patch("backend.lambdas.tasks.generate_queries.get_deletion_queue")
@@ -59,7 +71,7 @@ def test_it_generates_queries_writes_manifests_populates_queue_and_returns_resul
             "PartitionKeys": [{"Key": "product_category", "Value": "Books"}],
             "DeleteOldVersions": True,
             "IgnoreObjectNotFoundExceptions": False,
-            "Manifest": "s3://S3F2-manifests-bucket/manifests/test/a/manifest.json",
+            "Manifest": "s3://S3F2-manifests-bucket/manifests/test/a/manifest.json.gz",
         }
     ]
     data_mapper = {
@@ -79,16 +91,55 @@ def test_it_generates_queries_writes_manifests_populates_queue_and_returns_resul
     get_data_mappers.return_value = iter([data_mapper])
     result = handler({"ExecutionName": "test"}, SimpleNamespace())
 
-    gen_athena_queries.assert_called_with(data_mapper, queue, "test")
+    gen_athena_queries.assert_called_with(data_mapper, queue, "test", 100)
     write_partitions_mock.assert_called_with([["test", "a"]])
     batch_sqs_msgs_mock.assert_called_with(mock.ANY, queries)
     assert result == {
         "GeneratedQueries": 1,
         "DeletionQueueSize": 1,
-        "Manifests": ["s3://S3F2-manifests-bucket/manifests/test/a/manifest.json"],
+        "Manifests": ["s3://S3F2-manifests-bucket/manifests/test/a/manifest.json.gz"],
     }
 
 
+@patch("backend.lambdas.tasks.generate_queries.write_partitions")
+@patch("backend.lambdas.tasks.generate_queries.batch_sqs_msgs")
+@patch("backend.lambdas.tasks.generate_queries.get_deletion_queue")
+@patch("backend.lambdas.tasks.generate_queries.get_data_mappers")
+@patch("backend.lambdas.tasks.generate_queries.generate_athena_queries")
+def test_it_plans_data_mappers_concurrently(
+    gen_athena_queries,
+    get_data_mappers,
+    get_del_q,
+    batch_sqs_msgs_mock,
+    write_partitions_mock,
+):
+    data_mapper_ids = ["dm{}".format(i) for i in range(20)]
+    get_del_q.return_value = [{"MatchId": "hi", "DeletionQueueItemId": "id123"}]
+    get_data_mappers.return_value = iter(
+        [{"DataMapperId": i, "QueryExecutor": "athena"} for i in data_mapper_ids]
+    )
+    # Data mappers without matches have no queries or manifest
+    gen_athena_queries.side_effect = lambda dm, *args: (
+        [] if dm["DataMapperId"] == "dm3" else [{"DataMapperId": dm["DataMapperId"]}]
+    )
+    result = handler(
+        {"ExecutionName": "test", "AthenaConcurrencyLimit": 15}, SimpleNamespace()
+    )
+
+    planned = [i for i in data_mapper_ids if i != "dm3"]
+    assert gen_athena_queries.call_count == 20
+    gen_athena_queries.assert_called_with(ANY, ANY, "test", 15)
+    batch_sqs_msgs_mock.assert_called_once_with(
+        ANY, [{"DataMapperId": i} for i in planned]
+    )
+    write_partitions_mock.assert_called_with([["test", i] for i in planned])
+    assert result["GeneratedQueries"] == 19
+    assert result["Manifests"] == [
+        "s3://S3F2-manifests-bucket/manifests/test/{}/manifest.json.gz".format(i)
+        for i in planned
+    ]
+
+
 @patch("backend.lambdas.tasks.generate_queries.batch_sqs_msgs")
 @patch("backend.lambdas.tasks.generate_queries.get_deletion_queue")
 @patch("backend.lambdas.tasks.generate_queries.get_data_mappers")
@@ -113,18 +164,16 @@ def test_it_raises_for_unknown_query_executor(
     )
     with pytest.raises(NotImplementedError):
         handler({"ExecutionName": "test"}, SimpleNamespace())
-        batch_sqs_msgs_mock.assert_not_called()
+    batch_sqs_msgs_mock.assert_not_called()
 
 
 class TestAthenaQueries:
-    @patch("backend.lambdas.tasks.generate_queries.s3.Bucket")
+    @patch("backend.lambdas.tasks.generate_queries.s3_client")
     @patch("backend.lambdas.tasks.generate_queries.get_table")
     @patch("backend.lambdas.tasks.generate_queries.get_partitions")
     def test_it_handles_single_columns(
-        self, get_partitions_mock, get_table_mock, bucket_mock
+        self, get_partitions_mock, get_table_mock, s3_mock
     ):
-        put_object_mock = MagicMock()
-        bucket_mock.return_value = put_object_mock
         columns = [{"Name": "customer_id"}]
         partition_keys = ["product_category"]
         partitions = [["Books"]]
@@ -164,11 +213,12 @@ class TestAthenaQueries:
                 "PartitionKeys": [{"Key": "product_category", "Value": "Books"}],
                 "DeleteOldVersions": True,
                 "IgnoreObjectNotFoundExceptions": False,
-                "Manifest": "s3://S3F2-manifests-bucket/manifests/job_1234567890/a/manifest.json",
+                "Manifest": "s3://S3F2-manifests-bucket/manifests/job_1234567890/a/manifest.json.gz",
             }
         ]
-        put_object_mock.put_object.assert_called_with(
-            Key="manifests/job_1234567890/a/manifest.json",
+        assert_manifest_written(
+            s3_mock,
+            Key="manifests/job_1234567890/a/manifest.json.gz",
             Body=json.dumps(
                 {
                     "Columns": ["customer_id"],
@@ -182,14 +232,12 @@ class TestAthenaQueries:
             + "\n",
         )
 
-    @patch("backend.lambdas.tasks.generate_queries.s3.Bucket")
+    @patch("backend.lambdas.tasks.generate_queries.s3_client")
     @patch("backend.lambdas.tasks.generate_queries.get_table")
     @patch("backend.lambdas.tasks.generate_queries.get_partitions")
     def test_it_handles_invalid_match(
-        self, get_partitions_mock, get_table_mock, bucket_mock
+        self, get_partitions_mock, get_table_mock, s3_mock
     ):
-        put_object_mock = MagicMock()
-        bucket_mock.return_value = put_object_mock
         columns = [{"Name": "customer_id", "Type": "int"}]
         partition_keys = ["product_category"]
         partitions = [["Books"]]
@@ -224,16 +272,48 @@ class TestAthenaQueries:
             e.value.args[0]
             == "Invalid match ID (DeletionQueueItemId:'id-01') on Data Mapper 'a'. Casting failed: expected type for column 'customer_id': 'int'"
         )
-        put_object_mock.put_object.assert_not_called()
+        s3_mock.put_object.assert_not_called()
 
-    @patch("backend.lambdas.tasks.generate_queries.s3.Bucket")
+    @patch("backend.lambdas.tasks.generate_queries.ManifestWriter")
+    @patch("backend.lambdas.tasks.generate_queries.s3_client", MagicMock())
     @patch("backend.lambdas.tasks.generate_queries.get_table")
     @patch("backend.lambdas.tasks.generate_queries.get_partitions")
-    def test_it_handles_int_matches(
-        self, get_partitions_mock, get_table_mock, bucket_mock
+    def test_it_aborts_the_manifest_when_it_cant_be_completed(
+        self, get_partitions_mock, get_table_mock, writer_mock
     ):
-        put_object_mock = MagicMock()
-        bucket_mock.return_value = put_object_mock
+        columns = [{"Name": "customer_id", "Type": "string"}]
+        get_table_mock.return_value = table_stub(columns, [])
+        writer_mock.return_value.close.side_effect = ClientError(
+            {"Error": {"Code": "InternalError"}}, "CompleteMultipartUpload"
+        )
+        with pytest.raises(ClientError):
+            generate_athena_queries(
+                {
+                    "DataMapperId": "a",
+                    "QueryExecutor": "athena",
+                    "Columns": [col["Name"] for col in columns],
+                    "Format": "parquet",
+                    "QueryExecutorParameters": {
+                        "DataCatalogProvider": "glue",
+                        "Database": "test_db",
+                        "Table": "test_table",
+                    },
+                },
+                [
+                    {
+                        "MatchId": "hi",
+                        "CreatedAt": 1614698440,
+                        "DeletionQueueItemId": "id-01",
+                    }
+                ],
+                "job_1234567890",
+            )
+        writer_mock.return_value.abort.assert_called_once()
+
+    @patch("backend.lambdas.tasks.generate_queries.s3_client")
+    @patch("backend.lambdas.tasks.generate_queries.get_table")
+    @patch("backend.lambdas.tasks.generate_queries.get_partitions")
+    def test_it_handles_int_matches(self, get_partitions_mock, get_table_mock, s3_mock):
         columns = [{"Name": "customer_id", "Type": "int"}]
         partition_keys = ["product_category"]
         partitions = [["Books"]]
@@ -283,11 +363,12 @@ class TestAthenaQueries:
                 "PartitionKeys": [{"Key": "product_category", "Value": "Books"}],
                 "DeleteOldVersions": True,
                 "IgnoreObjectNotFoundExceptions": False,
-                "Manifest": "s3://S3F2-manifests-bucket/manifests/job_1234567890/a/manifest.json",
+                "Manifest": "s3://S3F2-manifests-bucket/manifests/job_1234567890/a/manifest.json.gz",
             }
         ]
-        put_object_mock.put_object.assert_called_with(
-            Key="manifests/job_1234567890/a/manifest.json",
+        assert_manifest_written(
+            s3_mock,
+            Key="manifests/job_1234567890/a/manifest.json.gz",
             Body=(
                 json.dumps(
                     {
@@ -314,14 +395,12 @@ class TestAthenaQueries:
             ),
         )
 
-    @patch("backend.lambdas.tasks.generate_queries.s3.Bucket")
+    @patch("backend.lambdas.tasks.generate_queries.s3_client")
     @patch("backend.lambdas.tasks.generate_queries.get_table")
     @patch("backend.lambdas.tasks.generate_queries.get_partitions")
     def test_it_handles_decimal_matches(
-        self, get_partitions_mock, get_table_mock, bucket_mock
+        self, get_partitions_mock, get_table_mock, s3_mock
     ):
-        put_object_mock = MagicMock()
-        bucket_mock.return_value = put_object_mock
         columns = [{"Name": "customer_id", "Type": "decimal"}]
         partition_keys = ["product_category"]
         partitions = [["Books"]]
@@ -371,11 +450,12 @@ class TestAthenaQueries:
                 "PartitionKeys": [{"Key": "product_category", "Value": "Books"}],
                 "DeleteOldVersions": True,
                 "IgnoreObjectNotFoundExceptions": False,
-                "Manifest": "s3://S3F2-manifests-bucket/manifests/job_1234567890/a/manifest.json",
+                "Manifest": "s3://S3F2-manifests-bucket/manifests/job_1234567890/a/manifest.json.gz",
             }
         ]
-        put_object_mock.put_object.assert_called_with(
-            Key="manifests/job_1234567890/a/manifest.json",
+        assert_manifest_written(
+            s3_mock,
+            Key="manifests/job_1234567890/a/manifest.json.gz",
             Body=(
                 json.dumps(
                     {
@@ -402,14 +482,12 @@ class TestAthenaQueries:
             ),
         )
 
-    @patch("backend.lambdas.tasks.generate_queries.s3.Bucket")
+    @patch("backend.lambdas.tasks.generate_queries.s3_client")
     @patch("backend.lambdas.tasks.generate_queries.get_table")
     @patch("backend.lambdas.tasks.generate_queries.get_partitions")
     def test_it_handles_int_partitions(
-        self, get_partitions_mock, get_table_mock, bucket_mock
+        self, get_partitions_mock, get_table_mock, s3_mock
     ):
-        put_object_mock = MagicMock()
-        bucket_mock.return_value = put_object_mock
         columns = [{"Name": "customer_id"}]
         partition_keys = ["year"]
         partitions = [["2010"]]
@@ -451,11 +529,12 @@ class TestAthenaQueries:
                 "PartitionKeys": [{"Key": "year", "Value": 2010}],
                 "DeleteOldVersions": True,
                 "IgnoreObjectNotFoundExceptions": False,
-                "Manifest": "s3://S3F2-manifests-bucket/manifests/job_1234567890/a/manifest.json",
+                "Manifest": "s3://S3F2-manifests-bucket/manifests/job_1234567890/a/manifest.json.gz",
             }
         ]
-        put_object_mock.put_object.assert_called_with(
-            Key="manifests/job_1234567890/a/manifest.json",
+        assert_manifest_written(
+            s3_mock,
+            Key="manifests/job_1234567890/a/manifest.json.gz",
             Body=json.dumps(
                 {
                     "Columns": ["customer_id"],
@@ -469,14 +548,12 @@ class TestAthenaQueries:
             + "\n",
         )
 
-    @patch("backend.lambdas.tasks.generate_queries.s3.Bucket")
+    @patch("backend.lambdas.tasks.generate_queries.s3_client")
     @patch("backend.lambdas.tasks.generate_queries.get_table")
     @patch("backend.lambdas.tasks.generate_queries.get_partitions")
     def test_it_handles_multiple_columns(
-        self, get_partitions_mock, get_table_mock, bucket_mock
+        self, get_partitions_mock, get_table_mock, s3_mock
     ):
-        put_object_mock = MagicMock()
-        bucket_mock.return_value = put_object_mock
         columns = [{"Name": "customer_id"}, {"Name": "alt_customer_id"}]
         partition_keys = ["product_category"]
         partitions = [["Books"]]
@@ -520,11 +597,12 @@ class TestAthenaQueries:
                 "PartitionKeys": [{"Key": "product_category", "Value": "Books"}],
                 "DeleteOldVersions": True,
                 "IgnoreObjectNotFoundExceptions": False,
-                "Manifest": "s3://S3F2-manifests-bucket/manifests/job_1234567890/a/manifest.json",
+                "Manifest": "s3://S3F2-manifests-bucket/manifests/job_1234567890/a/manifest.json.gz",
             }
         ]
-        put_object_mock.put_object.assert_called_with(
-            Key="manifests/job_1234567890/a/manifest.json",
+        assert_manifest_written(
+            s3_mock,
+            Key="manifests/job_1234567890/a/manifest.json.gz",
             Body=(
                 json.dumps(
                     {
@@ -551,14 +629,12 @@ class TestAthenaQueries:
             ),
         )
 
-    @patch("backend.lambdas.tasks.generate_queries.s3.Bucket")
+    @patch("backend.lambdas.tasks.generate_queries.s3_client")
     @patch("backend.lambdas.tasks.generate_queries.get_table")
     @patch("backend.lambdas.tasks.generate_queries.get_partitions")
     def test_it_handles_composite_columns(
-        self, get_partitions_mock, get_table_mock, bucket_mock
+        self, get_partitions_mock, get_table_mock, s3_mock
     ):
-        put_object_mock = MagicMock()
-        bucket_mock.return_value = put_object_mock
         columns = [
             {"Name": "first_name"},
             {"Name": "last_name"},
@@ -612,11 +688,12 @@ class TestAthenaQueries:
                 "PartitionKeys": [{"Key": "product_category", "Value": "Books"}],
                 "DeleteOldVersions": True,
                 "IgnoreObjectNotFoundExceptions": False,
-                "Manifest": "s3://S3F2-manifests-bucket/manifests/job_1234567890/a/manifest.json",
+                "Manifest": "s3://S3F2-manifests-bucket/manifests/job_1234567890/a/manifest.json.gz",
             }
         ]
-        put_object_mock.put_object.assert_called_with(
-            Key="manifests/job_1234567890/a/manifest.json",
+        assert_manifest_written(
+            s3_mock,
+            Key="manifests/job_1234567890/a/manifest.json.gz",
             Body=(
                 json.dumps(
                     {
@@ -632,14 +709,12 @@ class TestAthenaQueries:
             ),
         )
 
-    @patch("backend.lambdas.tasks.generate_queries.s3.Bucket")
+    @patch("backend.lambdas.tasks.generate_queries.s3_client")
     @patch("backend.lambdas.tasks.generate_queries.get_table")
     @patch("backend.lambdas.tasks.generate_queries.get_partitions")
     def test_it_handles_single_composite_column(
-        self, get_partitions_mock, get_table_mock, bucket_mock
+        self, get_partitions_mock, get_table_mock, s3_mock
     ):
-        put_object_mock = MagicMock()
-        bucket_mock.return_value = put_object_mock
         columns = [{"Name": "first_name"}]
         partition_keys = ["product_category"]
         partitions = [["Books"]]
@@ -687,11 +762,12 @@ class TestAthenaQueries:
                 "PartitionKeys": [{"Key": "product_category", "Value": "Books"}],
                 "DeleteOldVersions": True,
                 "IgnoreObjectNotFoundExceptions": False,
-                "Manifest": "s3://S3F2-manifests-bucket/manifests/job_1234567890/a/manifest.json",
+                "Manifest": "s3://S3F2-manifests-bucket/manifests/job_1234567890/a/manifest.json.gz",
             }
         ]
-        put_object_mock.put_object.assert_called_with(
-            Key="manifests/job_1234567890/a/manifest.json",
+        assert_manifest_written(
+            s3_mock,
+            Key="manifests/job_1234567890/a/manifest.json.gz",
             Body=(
                 json.dumps(
                     {
@@ -707,14 +783,12 @@ class TestAthenaQueries:
             ),
         )
 
-    @patch("backend.lambdas.tasks.generate_queries.s3.Bucket")
+    @patch("backend.lambdas.tasks.generate_queries.s3_client")
     @patch("backend.lambdas.tasks.generate_queries.get_table")
     @patch("backend.lambdas.tasks.generate_queries.get_partitions")
     def test_it_handles_mixed_columns(
-        self, get_partitions_mock, get_table_mock, bucket_mock
+        self, get_partitions_mock, get_table_mock, s3_mock
     ):
-        put_object_mock = MagicMock()
-        bucket_mock.return_value = put_object_mock
         columns = [
             {"Name": "customer_id"},
             {"Name": "first_name"},
@@ -835,11 +909,12 @@ class TestAthenaQueries:
                 "PartitionKeys": [{"Key": "product_category", "Value": "Books"}],
                 "DeleteOldVersions": True,
                 "IgnoreObjectNotFoundExceptions": False,
-                "Manifest": "s3://S3F2-manifests-bucket/manifests/job1234567890/a/manifest.json",
+                "Manifest": "s3://S3F2-manifests-bucket/manifests/job1234567890/a/manifest.json.gz",
             }
         ]
-        put_object_mock.put_object.assert_called_with(
-            Key="manifests/job1234567890/a/manifest.json",
+        assert_manifest_written(
+            s3_mock,
+            Key="manifests/job1234567890/a/manifest.json.gz",
             Body=(
                 # id001 simple on all columns
                 json.dumps(
@@ -1030,14 +1105,162 @@ class TestAthenaQueries:
             ),
         )
 
-    @patch("backend.lambdas.tasks.generate_queries.s3.Bucket")
+    @patch("backend.lambdas.tasks.generate_queries.MAX_PARTITIONS_PER_QUERY", 2)
+    @patch("backend.lambdas.tasks.generate_queries.s3_client", MagicMock())
+    @patch("backend.lambdas.tasks.generate_queries.get_table")
+    @patch("backend.lambdas.tasks.generate_queries.get_partitions")
+    def test_it_batches_partitions_when_exceeding_the_query_limit(
+        self, get_partitions_mock, get_table_mock
+    ):
+        columns = [{"Name": "customer_id"}]
+        get_table_mock.return_value = table_stub(
+            columns, ["year"], partition_keys_type="int"
+        )
+        get_partitions_mock.return_value = [
+            partition_stub([p], columns)
+            for p in ["2021", "2019", "2022", "2020", "2023"]
+        ]
+
+        resp = generate_athena_queries(
+            {
+                "DataMapperId": "a",
+                "QueryExecutor": "athena",
+                "Columns": ["customer_id"],
+                "Format": "parquet",
+                "QueryExecutorParameters": {
+                    "DataCatalogProvider": "glue",
+                    "Database": "test_db",
+                    "Table": "test_table",
+                },
+            },
+            [{"MatchId": "hi", "CreatedAt": 1614698440, "DeletionQueueItemId": "id1"}],
+            "job_1234567890",
+            2,
+        )
+
+        assert [q.get("Partitions") for q in resp] == [
+            [[{"Key": "year", "Value": 2019}], [{"Key": "year", "Value": 2020}]],
+            [[{"Key": "year", "Value": 2021}], [{"Key": "year", "Value": 2022}]],
+            None,
+        ]
+        assert [q["PartitionKeys"] for q in resp] == [
+            [],
+            [],
+            [{"Key": "year", "Value": 2023}],
+        ]
+
+    @patch("backend.lambdas.tasks.generate_queries.s3_client", MagicMock())
+    @patch("backend.lambdas.tasks.generate_queries.get_table")
+    @patch("backend.lambdas.tasks.generate_queries.get_partitions")
+    def test_it_keeps_a_query_per_partition_within_the_query_limit(
+        self, get_partitions_mock, get_table_mock
+    ):
+        columns = [{"Name": "customer_id"}]
+        get_table_mock.return_value = table_stub(columns, ["year"])
+        get_partitions_mock.return_value = [
+            partition_stub([p], columns) for p in ["2019", "2020"]
+        ]
+
+        resp = generate_athena_queries(
+            {
+                "DataMapperId": "a",
+                "QueryExecutor": "athena",
+                "Columns": ["customer_id"],
+                "Format": "parquet",
+                "QueryExecutorParameters": {
+                    "DataCatalogProvider": "glue",
+                    "Database": "test_db",
+                    "Table": "test_table",
+                },
+            },
+            [{"MatchId": "hi", "CreatedAt": 1614698440, "DeletionQueueItemId": "id1"}],
+            "job_1234567890",
+            2,
+        )
+
+        assert [q["PartitionKeys"] for q in resp] == [
+            [{"Key": "year", "Value": "2019"}],
+            [{"Key": "year", "Value": "2020"}],
+        ]
+        assert all("Partitions" not in q for q in resp)
+
+    @patch("backend.lambdas.tasks.generate_queries.s3_client", MagicMock())
+    @patch("backend.lambdas.tasks.generate_queries.get_table")
+    @patch("backend.lambdas.tasks.generate_queries.get_partitions")
+    def test_it_does_not_enumerate_projected_partitions(
+        self, get_partitions_mock, get_table_mock
+    ):
+        columns = [{"Name": "customer_id"}]
+        table = table_stub(columns, ["year"])
+        table["Parameters"]["projection.enabled"] = "true"
+        get_table_mock.return_value = table
+
+        resp = generate_athena_queries(
+            {
+                "DataMapperId": "a",
+                "QueryExecutor": "athena",
+                "Columns": ["customer_id"],
+                "Format": "parquet",
+                "QueryExecutorParameters": {
+                    "DataCatalogProvider": "glue",
+                    "Database": "test_db",
+                    "Table": "test_table",
+                },
+            },
+            [{"MatchId": "hi", "CreatedAt": 1614698440, "DeletionQueueItemId": "id1"}],
+            "job_1234567890",
+        )
+
+        assert len(resp) == 1
+        assert resp[0]["PartitionKeys"] == []
+        get_partitions_mock.assert_not_called()
+
+    @patch("backend.lambdas.tasks.generate_queries.s3_client")
+    @patch("backend.lambdas.tasks.generate_queries.get_table")
+    def test_it_throws_for_injected_projected_partitions(self, get_table_mock, s3_mock):
+        columns = [{"Name": "customer_id"}]
+        table = table_stub(columns, ["year", "tenant"])
+        table["Parameters"]["projection.enabled"] = "true"
+        table["Parameters"]["projection.year.type"] = "integer"
+        table["Parameters"]["projection.tenant.type"] = "injected"
+        get_table_mock.return_value = table
+
+        with pytest.raises(ValueError) as e:
+            generate_athena_queries(
+                {
+                    "DataMapperId": "a",
+                    "QueryExecutor": "athena",
+                    "Columns": ["customer_id"],
+                    "Format": "parquet",
+                    "QueryExecutorParameters": {
+                        "DataCatalogProvider": "glue",
+                        "Database": "test_db",
+                        "Table": "test_table",
+                    },
+                },
+                [
+                    {
+                        "MatchId": "hi",
+                        "CreatedAt": 1614698440,
+                        "DeletionQueueItemId": "id1",
+                    }
+                ],
+                "job_1234567890",
+            )
+
+        assert e.value.args[0] == (
+            "Table test_table uses injected partition projection for tenant, "
+            "which is not supported"
+        )
+        s3_mock.put_object.assert_not_called()
+        s3_mock.create_multipart_upload.assert_not_called()
+
+    @patch("backend.lambdas.tasks.generate_queries.s3_client")
     @patch("backend.lambdas.tasks.generate_queries.get_table")
     @patch("backend.lambdas.tasks.generate_queries.get_partitions")
     def test_it_handles_multiple_partition_keys(
-        self, get_partitions_mock, get_table_mock, bucket_mock
+        self, get_partitions_mock, get_table_mock, s3_mock
     ):
-        put_object_mock = MagicMock()
-        bucket_mock.return_value = put_object_mock
         columns = [{"Name": "customer_id"}]
         partition_keys = ["year", "month"]
         partitions = [["2019", "01"]]
@@ -1082,11 +1305,12 @@ class TestAthenaQueries:
                 ],
                 "DeleteOldVersions": True,
                 "IgnoreObjectNotFoundExceptions": False,
-                "Manifest": "s3://S3F2-manifests-bucket/manifests/job_1234567890/a/manifest.json",
+                "Manifest": "s3://S3F2-manifests-bucket/manifests/job_1234567890/a/manifest.json.gz",
             }
         ]
-        put_object_mock.put_object.assert_called_with(
-            Key="manifests/job_1234567890/a/manifest.json",
+        assert_manifest_written(
+            s3_mock,
+            Key="manifests/job_1234567890/a/manifest.json.gz",
             Body=(
                 json.dumps(
                     {
@@ -1102,14 +1326,12 @@ class TestAthenaQueries:
             ),
         )
 
-    @patch("backend.lambdas.tasks.generate_queries.s3.Bucket")
+    @patch("backend.lambdas.tasks.generate_queries.s3_client")
     @patch("backend.lambdas.tasks.generate_queries.get_table")
     @patch("backend.lambdas.tasks.generate_queries.get_partitions")
     def test_it_handles_multiple_partition_values(
-        self, get_partitions_mock, get_table_mock, bucket_mock
+        self, get_partitions_mock, get_table_mock, s3_mock
     ):
-        put_object_mock = MagicMock()
-        bucket_mock.return_value = put_object_mock
         columns = [{"Name": "customer_id"}]
         partition_keys = ["year", "month"]
         partitions = [["2018", "12"], ["2019", "01"], ["2019", "02"]]
@@ -1156,7 +1378,7 @@ class TestAthenaQueries:
                     ],
                     "DeleteOldVersions": True,
                     "IgnoreObjectNotFoundExceptions": False,
-                    "Manifest": "s3://S3F2-manifests-bucket/manifests/job_1234567890/a/manifest.json",
+                    "Manifest": "s3://S3F2-manifests-bucket/manifests/job_1234567890/a/manifest.json.gz",
                 },
                 {
                     "DataMapperId": "a",
@@ -1171,7 +1393,7 @@ class TestAthenaQueries:
                     ],
                     "DeleteOldVersions": True,
                     "IgnoreObjectNotFoundExceptions": False,
-                    "Manifest": "s3://S3F2-manifests-bucket/manifests/job_1234567890/a/manifest.json",
+                    "Manifest": "s3://S3F2-manifests-bucket/manifests/job_1234567890/a/manifest.json.gz",
                 },
                 {
                     "DataMapperId": "a",
@@ -1186,12 +1408,13 @@ class TestAthenaQueries:
                     ],
                     "DeleteOldVersions": True,
                     "IgnoreObjectNotFoundExceptions": False,
-                    "Manifest": "s3://S3F2-manifests-bucket/manifests/job_1234567890/a/manifest.json",
+                    "Manifest": "s3://S3F2-manifests-bucket/manifests/job_1234567890/a/manifest.json.gz",
                 },
             ],
         )
-        put_object_mock.put_object.assert_called_with(
-            Key="manifests/job_1234567890/a/manifest.json",
+        assert_manifest_written(
+            s3_mock,
+            Key="manifests/job_1234567890/a/manifest.json.gz",
             Body=(
                 json.dumps(
                     {
@@ -1207,14 +1430,12 @@ class TestAthenaQueries:
             ),
         )
 
-    @patch("backend.lambdas.tasks.generate_queries.s3.Bucket")
+    @patch("backend.lambdas.tasks.generate_queries.s3_client")
     @patch("backend.lambdas.tasks.generate_queries.get_table")
     @patch("backend.lambdas.tasks.generate_queries.get_partitions")
     def test_it_propagates_optional_properties(
-        self, get_partitions_mock, get_table_mock, bucket_mock
+        self, get_partitions_mock, get_table_mock, s3_mock
     ):
-        put_object_mock = MagicMock()
-        bucket_mock.return_value = put_object_mock
         columns = [{"Name": "customer_id"}]
         partition_keys = ["year", "month"]
         partitions = [["2018", "12"], ["2019", "01"]]
@@ -1237,6 +1458,10 @@ class TestAthenaQueries:
                 "RoleArn": "arn:aws:iam::accountid:role/rolename",
                 "DeleteOldVersions": True,
                 "IgnoreObjectNotFoundExceptions": True,
+                "ParquetWriterOptions": {
+                    "Compression": "zstd",
+                    "RowGroupSize": Decimal(1000),
+                },
             },
             [
                 {
@@ -1265,7 +1490,11 @@ class TestAthenaQueries:
                     "RoleArn": "arn:aws:iam::accountid:role/rolename",
                     "DeleteOldVersions": True,
                     "IgnoreObjectNotFoundExceptions": True,
-                    "Manifest": "s3://S3F2-manifests-bucket/manifests/job_1234567890/a/manifest.json",
+                    "ParquetWriterOptions": {
+                        "Compression": "zstd",
+                        "RowGroupSize": 1000,
+                    },
+                    "Manifest": "s3://S3F2-manifests-bucket/manifests/job_1234567890/a/manifest.json.gz",
                 },
                 {
                     "DataMapperId": "a",
@@ -1281,12 +1510,18 @@ class TestAthenaQueries:
                     "RoleArn": "arn:aws:iam::accountid:role/rolename",
                     "DeleteOldVersions": True,
                     "IgnoreObjectNotFoundExceptions": True,
-                    "Manifest": "s3://S3F2-manifests-bucket/manifests/job_1234567890/a/manifest.json",
+                    "ParquetWriterOptions": {
+                        "Compression": "zstd",
+                        "RowGroupSize": 1000,
+                    },
+                    "Manifest": "s3://S3F2-manifests-bucket/manifests/job_1234567890/a/manifest.json.gz",
                 },
             ],
         )
-        put_object_mock.put_object.assert_called_with(
-            Key="manifests/job_1234567890/a/manifest.json",
+        assert isinstance(resp[0]["ParquetWriterOptions"]["RowGroupSize"], int)
+        assert_manifest_written(
+            s3_mock,
+            Key="manifests/job_1234567890/a/manifest.json.gz",
             Body=(
                 json.dumps(
                     {
@@ -1302,14 +1537,12 @@ class TestAthenaQueries:
             ),
         )
 
-    @patch("backend.lambdas.tasks.generate_queries.s3.Bucket")
+    @patch("backend.lambdas.tasks.generate_queries.s3_client")
     @patch("backend.lambdas.tasks.generate_queries.get_table")
     @patch("backend.lambdas.tasks.generate_queries.get_partitions")
     def test_it_filters_users_from_non_applicable_tables(
-        self, get_partitions_mock, get_table_mock, bucket_mock
+        self, get_partitions_mock, get_table_mock, s3_mock
     ):
-        put_object_mock = MagicMock()
-        bucket_mock.return_value = put_object_mock
         columns = [{"Name": "customer_id"}]
         partition_keys = ["product_category"]
         partitions = [["Books"]]
@@ -1357,11 +1590,12 @@ class TestAthenaQueries:
                 "PartitionKeys": [{"Key": "product_category", "Value": "Books"}],
                 "DeleteOldVersions": True,
                 "IgnoreObjectNotFoundExceptions": False,
-                "Manifest": "s3://S3F2-manifests-bucket/manifests/job_1234567890/B/manifest.json",
+                "Manifest": "s3://S3F2-manifests-bucket/manifests/job_1234567890/B/manifest.json.gz",
             }
         ]
-        put_object_mock.put_object.assert_called_with(
-            Key="manifests/job_1234567890/B/manifest.json",
+        assert_manifest_written(
+            s3_mock,
+            Key="manifests/job_1234567890/B/manifest.json.gz",
             Body=(
                 json.dumps(
                     {
@@ -1377,14 +1611,12 @@ class TestAthenaQueries:
             ),
         )
 
-    @patch("backend.lambdas.tasks.generate_queries.s3.Bucket")
+    @patch("backend.lambdas.tasks.generate_queries.s3_client")
     @patch("backend.lambdas.tasks.generate_queries.get_table")
     @patch("backend.lambdas.tasks.generate_queries.get_partitions")
     def test_it_handles_unpartitioned_data(
-        self, get_partitions_mock, get_table_mock, bucket_mock
+        self, get_partitions_mock, get_table_mock, s3_mock
     ):
-        put_object_mock = MagicMock()
-        bucket_mock.return_value = put_object_mock
         columns = [{"Name": "customer_id"}]
         get_table_mock.return_value = table_stub(columns, [])
         get_partitions_mock.return_value = []
@@ -1420,11 +1652,12 @@ class TestAthenaQueries:
                 "PartitionKeys": [],
                 "DeleteOldVersions": True,
                 "IgnoreObjectNotFoundExceptions": False,
-                "Manifest": "s3://S3F2-manifests-bucket/manifests/job_1234567890/a/manifest.json",
+                "Manifest": "s3://S3F2-manifests-bucket/manifests/job_1234567890/a/manifest.json.gz",
             }
         ]
-        put_object_mock.put_object.assert_called_with(
-            Key="manifests/job_1234567890/a/manifest.json",
+        assert_manifest_written(
+            s3_mock,
+            Key="manifests/job_1234567890/a/manifest.json.gz",
             Body=(
                 json.dumps(
                     {
@@ -1440,14 +1673,12 @@ class TestAthenaQueries:
             ),
         )
 
-    @patch("backend.lambdas.tasks.generate_queries.s3.Bucket")
+    @patch("backend.lambdas.tasks.generate_queries.s3_client")
     @patch("backend.lambdas.tasks.generate_queries.get_table")
     @patch("backend.lambdas.tasks.generate_queries.get_partitions")
     def test_it_propagates_role_arn_for_unpartitioned_data(
-        self, get_partitions_mock, get_table_mock, bucket_mock
+        self, get_partitions_mock, get_table_mock, s3_mock
     ):
-        put_object_mock = MagicMock()
-        bucket_mock.return_value = put_object_mock
         columns = [{"Name": "customer_id"}]
         get_table_mock.return_value = table_stub(columns, [])
         get_partitions_mock.return_value = []
@@ -1485,11 +1716,12 @@ class TestAthenaQueries:
                 "RoleArn": "arn:aws:iam::accountid:role/rolename",
                 "DeleteOldVersions": True,
                 "IgnoreObjectNotFoundExceptions": False,
-                "Manifest": "s3://S3F2-manifests-bucket/manifests/job_1234567890/a/manifest.json",
+                "Manifest": "s3://S3F2-manifests-bucket/manifests/job_1234567890/a/manifest.json.gz",
             }
         ]
-        put_object_mock.put_object.assert_called_with(
-            Key="manifests/job_1234567890/a/manifest.json",
+        assert_manifest_written(
+            s3_mock,
+            Key="manifests/job_1234567890/a/manifest.json.gz",
             Body=(
                 json.dumps(
                     {
@@ -1505,14 +1737,12 @@ class TestAthenaQueries:
             ),
         )
 
-    @patch("backend.lambdas.tasks.generate_queries.s3.Bucket")
+    @patch("backend.lambdas.tasks.generate_queries.s3_client")
     @patch("backend.lambdas.tasks.generate_queries.get_table")
     @patch("backend.lambdas.tasks.generate_queries.get_partitions")
     def test_it_removes_queries_with_no_applicable_matches(
-        self, get_partitions_mock, get_table_mock, bucket_mock
+        self, get_partitions_mock, get_table_mock, s3_mock
     ):
-        put_object_mock = MagicMock()
-        bucket_mock.return_value = put_object_mock
         columns = [{"Name": "customer_id"}]
         get_table_mock.return_value = table_stub(columns, [])
         get_partitions_mock.return_value = []
@@ -1532,16 +1762,14 @@ class TestAthenaQueries:
             "job_1234567890",
         )
         assert resp == []
-        assert not put_object_mock.put_object.called
+        assert not s3_mock.put_object.called
 
-    @patch("backend.lambdas.tasks.generate_queries.s3.Bucket")
+    @patch("backend.lambdas.tasks.generate_queries.s3_client")
     @patch("backend.lambdas.tasks.generate_queries.get_table")
     @patch("backend.lambdas.tasks.generate_queries.get_partitions")
     def test_it_removes_queries_with_no_applicable_matches_for_partitioned_data(
-        self, get_partitions_mock, get_table_mock, bucket_mock
+        self, get_partitions_mock, get_table_mock, s3_mock
     ):
-        put_object_mock = MagicMock()
-        bucket_mock.return_value = put_object_mock
         columns = [{"Name": "customer_id"}]
         partition_keys = ["product_category"]
         partitions = [["Books"], ["Beauty"]]
@@ -1565,7 +1793,7 @@ class TestAthenaQueries:
             "job_1234567890",
         )
         assert resp == []
-        assert not put_object_mock.put_object.called
+        assert not s3_mock.put_object.called
 
     @patch("backend.lambdas.tasks.generate_queries.glue_client")
     def test_it_returns_table(self, client):
@@ -1628,6 +1856,45 @@ class TestAthenaQueries:
             res = cast_to_type(scenario["value"], scenario["id"], "TableName", tree)
             assert res == scenario["expected"]
 
+    def test_it_indexes_nested_columns(self):
+        column_type = "struct<type:int,info:struct<user_id:int,name:string>>"
+        tree = list(
+            map(
+                column_mapper,
+                [
+                    {"Name": "user", "Type": column_type},
+                    {"Name": "user", "Type": "string"},
+                ],
+            )
+        )
+
+        assert index_columns(tree) == {
+            "user": ("struct", False),
+            "user.type": ("int", True),
+            "user.info": ("struct", False),
+            "user.info.user_id": ("int", True),
+            "user.info.name": ("string", True),
+        }
+
+    @patch("backend.lambdas.tasks.generate_queries.cast_to_column_type")
+    def test_it_casts_distinct_values_once(self, cast_mock):
+        cast_mock.side_effect = lambda val, *args: int(val)
+        columns_index = {"customer_id": ("int", True)}
+        cast = get_caster("TableName", columns_index)
+
+        assert [cast(v, "customer_id") for v in ["1", "1", 1, "2"]] == [1, 1, 1, 2]
+        assert cast_mock.call_args_list == [
+            mock.call("1", "customer_id", "TableName", ("int", True)),
+            mock.call(1, "customer_id", "TableName", ("int", True)),
+            mock.call("2", "customer_id", "TableName", ("int", True)),
+        ]
+
+    def test_it_casts_unknown_columns_with_the_caster(self):
+        cast = get_caster("TableName", {})
+        with pytest.raises(ValueError) as e:
+            cast("mystr", "doesnt_exist")
+        assert e.value.args[0] == "Column doesnt_exist not found at table TableName"
+
     def test_it_throws_for_unknown_col(self):
         with pytest.raises(ValueError) as e:
             cast_to_type(
@@ -1690,14 +1957,12 @@ class TestAthenaQueries:
             )
         assert e.value.args[0] == "Column schema is not valid"
 
-    @patch("backend.lambdas.tasks.generate_queries.s3.Bucket")
+    @patch("backend.lambdas.tasks.generate_queries.s3_client")
     @patch("backend.lambdas.tasks.generate_queries.get_table")
     @patch("backend.lambdas.tasks.generate_queries.get_partitions")
     def test_it_handles_partition_filtering(
-        self, get_partitions_mock, get_table_mock, bucket_mock
+        self, get_partitions_mock, get_table_mock, s3_mock
     ):
-        put_object_mock = MagicMock()
-        bucket_mock.return_value = put_object_mock
         columns = [{"Name": "customer_id"}]
         partition_keys = ["year", "month"]
         partitions = [["2018", "12"], ["2019", "01"], ["2019", "02"]]
@@ -1742,7 +2007,7 @@ class TestAthenaQueries:
                     "PartitionKeys": [{"Key": "year", "Value": "2018"}],
                     "DeleteOldVersions": True,
                     "IgnoreObjectNotFoundExceptions": False,
-                    "Manifest": "s3://S3F2-manifests-bucket/manifests/job_1234567890/a/manifest.json",
+                    "Manifest": "s3://S3F2-manifests-bucket/manifests/job_1234567890/a/manifest.json.gz",
                 },
                 {
                     "DataMapperId": "a",
@@ -1754,12 +2019,13 @@ class TestAthenaQueries:
                     "PartitionKeys": [{"Key": "year", "Value": "2019"}],
                     "DeleteOldVersions": True,
                     "IgnoreObjectNotFoundExceptions": False,
-                    "Manifest": "s3://S3F2-manifests-bucket/manifests/job_1234567890/a/manifest.json",
+                    "Manifest": "s3://S3F2-manifests-bucket/manifests/job_1234567890/a/manifest.json.gz",
                 },
             ],
         )
-        put_object_mock.put_object.assert_called_with(
-            Key="manifests/job_1234567890/a/manifest.json",
+        assert_manifest_written(
+            s3_mock,
+            Key="manifests/job_1234567890/a/manifest.json.gz",
             Body=(
                 json.dumps(
                     {
@@ -1829,7 +2095,7 @@ def test_it_writes_glue_partitions(glue_client):
                     "Location": "s3://S3F2-manifests-bucket/manifests/job_1234/dm_0001/",
                     "InputFormat": "org.apache.hadoop.mapred.TextInputFormat",
                     "OutputFormat": "org.apache.hadoop.hive.ql.io.HiveIgnoreKeyTextOutputFormat",
-                    "Compressed": False,
+                    "Compressed": True,
                     "SerdeInfo": {
                         "SerializationLibrary": "org.openx.data.jsonserde.JsonSerDe",
                     },
@@ -1850,7 +2116,7 @@ def test_it_writes_glue_partitions(glue_client):
                     "Location": "s3://S3F2-manifests-bucket/manifests/job_1234/dm_0003/",
                     "InputFormat": "org.apache.hadoop.mapred.TextInputFormat",
                     "OutputFormat": "org.apache.hadoop.hive.ql.io.HiveIgnoreKeyTextOutputFormat",
-                    "Compressed": False,
+                    "Compressed": True,
                     "SerdeInfo": {
                         "SerializationLibrary": "org.openx.data.jsonserde.JsonSerDe",
                     },
@@ -1876,7 +2142,7 @@ def partition_stub(values, columns, table_name="test_table"):
             "Location": "s3://bucket/location",
             "InputFormat": "org.apache.hadoop.hive.ql.io.parquet.MapredParquetInputFormat",
             "OutputFormat": "org.apache.hadoop.hive.ql.io.parquet.MapredParquetOutputFormat",
-            "Compressed": False,
+            "Compressed": True,
             "NumberOfBuckets": -1,
             "SerdeInfo": {
                 "SerializationLibrary": "org.apache.hadoop.hive.ql.io.parquet.serde.ParquetHiveSerDe",
@@ -1914,7 +2180,7 @@ def table_stub(
             "Location": "s3://bucket/location",
             "InputFormat": "org.apache.hadoop.hive.ql.io.parquet.MapredParquetInputFormat",
             "OutputFormat": "org.apache.hadoop.hive.ql.io.parquet.MapredParquetOutputFormat",
-            "Compressed": False,
+            "Compressed": True,
             "NumberOfBuckets": -1,
             "SerdeInfo": {
                 "SerializationLibrary": "org.apache.hadoop.hive.ql.io.parquet.serde.ParquetHiveSerDe",
@@ -1937,3 +2203,67 @@ def table_stub(
         "TableType": "EXTERNAL_TABLE",
         "Parameters": {"EXTERNAL": "TRUE"},
     }
+
+
+def test_it_writes_small_manifests_with_a_single_request():
+    client = MagicMock()
+    writer = ManifestWriter(client, "bucket", "manifest.json.gz")
+    writer.write('{"a": 1}\n')
+    writer.close()
+
+    assert_manifest_written(client, Key="manifest.json.gz", Body='{"a": 1}\n')
+    client.put_object.assert_called_with(
+        Bucket="bucket", Key="manifest.json.gz", Body=ANY
+    )
+    client.create_multipart_upload.assert_not_called()
+
+
+def test_it_streams_large_manifests_as_multipart_uploads():
+    client = MagicMock()
+    client.create_multipart_upload.return_value = {"UploadId": "upload1"}
+    client.upload_part.side_effect = lambda **kwargs: {"ETag": kwargs["Body"]}
+    rows = ['{"id": "%s"}\n' % os.urandom(64).hex() for _ in range(2000)]
+    writer = ManifestWriter(client, "bucket", "manifest.json.gz", part_size=64 * 1024)
+    for row in rows:
+        writer.write(row)
+    writer.close()
+
+    client.put_object.assert_not_called()
+    client.create_multipart_upload.assert_called_once_with(
+        Bucket="bucket", Key="manifest.json.gz"
+    )
+    client.upload_part.assert_called_with(
+        Bucket="bucket",
+        Key="manifest.json.gz",
+        UploadId="upload1",
+        PartNumber=ANY,
+        Body=ANY,
+    )
+    client.complete_multipart_upload.assert_called_once_with(
+        Bucket="bucket", Key="manifest.json.gz", UploadId="upload1", MultipartUpload=ANY
+    )
+    parts = client.complete_multipart_upload.call_args[1]["MultipartUpload"]["Parts"]
+    assert len(parts) > 1
+    assert [p["PartNumber"] for p in parts] == list(range(1, len(parts) + 1))
+    body = b"".join(p["ETag"] for p in parts)
+    assert gzip.decompress(body).decode("utf-8") == "".join(rows)
+
+
+@patch("backend.lambdas.tasks.generate_queries.GzipFile")
+def test_it_compresses_manifests_at_a_lower_level(gzip_mock):
+    ManifestWriter(MagicMock(), "bucket", "manifest.json.gz")
+    gzip_mock.assert_called_with(fileobj=ANY, mode="wb", compresslevel=6)
+
+
+def test_it_aborts_manifest_uploads():
+    client = MagicMock()
+    client.create_multipart_upload.return_value = {"UploadId": "upload1"}
+    client.upload_part.return_value = {"ETag": "a"}
+    writer = ManifestWriter(client, "bucket", "manifest.json.gz", part_size=1)
+    writer.write('{"a": 1}\n')
+    writer.abort()
+
+    client.abort_multipart_upload.assert_called_once_with(
+        Bucket="bucket", Key="manifest.json.gz", UploadId="upload1"
+    )
+    client.complete_multipart_upload.assert_not_called()
@@ -1,14 +1,30 @@
 import os
+from io import BytesIO
 from types import SimpleNamespace
 
 import pytest
-from mock import call, patch, ANY
+from botocore.exceptions import ClientError
+from mock import call, patch, ANY, MagicMock
 
 with patch.dict(os.environ, {"QueueUrl": "test"}):
-    from backend.lambdas.tasks.submit_query_results import handler
+    from backend.lambdas.tasks.submit_query_results import (
+        handler,
+        get_paths_from_object,
+        get_results_object,
+    )
 
 pytestmark = [pytest.mark.unit, pytest.mark.task]
 
+
+@pytest.fixture(autouse=True)
+def results_object():
+    with patch(
+        "backend.lambdas.tasks.submit_query_results.get_results_object",
+        return_value=None,
+    ) as mock_get:
+        yield mock_get
+
+
 test_data = [
     {"Data": [{"VarCharValue": "$path"}]},
     {"Data": [{"VarCharValue": "s3://mybucket/mykey1"}]},
@@ -138,6 +154,7 @@ def test_it_propagates_optional_properties(paginate_mock, batch_sqs_msgs_mock):
             "QueryId": "123",
             "Columns": columns,
             "IgnoreObjectNotFoundExceptions": True,
+            "ParquetWriterOptions": {"Compression": "zstd"},
         },
         SimpleNamespace(),
     )
@@ -151,6 +168,7 @@ def test_it_propagates_optional_properties(paginate_mock, batch_sqs_msgs_mock):
                 "RoleArn": "arn:aws:iam:accountid:role/rolename",
                 "DeleteOldVersions": False,
                 "IgnoreObjectNotFoundExceptions": True,
+                "ParquetWriterOptions": {"Compression": "zstd"},
             },
             {
                 "JobId": "1234",
@@ -159,6 +177,139 @@ def test_it_propagates_optional_properties(paginate_mock, batch_sqs_msgs_mock):
                 "RoleArn": "arn:aws:iam:accountid:role/rolename",
                 "DeleteOldVersions": False,
                 "IgnoreObjectNotFoundExceptions": True,
+                "ParquetWriterOptions": {"Compression": "zstd"},
             },
         ],
     )
+
+
+def results_object_stub(athena_mock, s3_mock, body):
+    athena_mock.get_query_execution.return_value = {
+        "QueryExecution": {
+            "ResultConfiguration": {"OutputLocation": "s3://bucket/queries/123.csv"}
+        }
+    }
+    s3_mock.Object.return_value.get.return_value = {"Body": BytesIO(body)}
+
+
+@patch("backend.lambdas.tasks.submit_query_results.s3")
+@patch("backend.lambdas.tasks.submit_query_results.athena")
+@patch("backend.lambdas.tasks.submit_query_results.batch_sqs_msgs")
+@patch("backend.lambdas.tasks.submit_query_results.paginate")
+def test_it_reads_results_from_s3(
+    paginate_mock, batch_sqs_msgs_mock, athena_mock, s3_mock, results_object
+):
+    results_object.side_effect = get_results_object
+    results_object_stub(
+        athena_mock,
+        s3_mock,
+        b'"$path"\n"s3://mybucket/mykey1"\n"s3://mybucket/my,\nkey2"\n',
+    )
+    columns = [{"Column": "customer_id", "MatchIds": ["2732559"]}]
+
+    resp = handler(
+        {"JobId": "1234", "QueryId": "123", "Columns": columns}, SimpleNamespace()
+    )
+
+    assert 2 == resp
+    paginate_mock.assert_not_called()
+    batch_sqs_msgs_mock.assert_called_with(
+        ANY,
+        [
+            {
+                "JobId": "1234",
+                "Columns": columns,
+                "Object": "s3://mybucket/mykey1",
+                "DeleteOldVersions": True,
+                "IgnoreObjectNotFoundExceptions": False,
+            },
+            {
+                "JobId": "1234",
+                "Columns": columns,
+                "Object": "s3://mybucket/my,\nkey2",
+                "DeleteOldVersions": True,
+                "IgnoreObjectNotFoundExceptions": False,
+            },
+        ],
+    )
+
+
+@patch("backend.lambdas.tasks.submit_query_results.s3")
+@patch("backend.lambdas.tasks.submit_query_results.athena")
+def test_it_reads_paths_from_empty_results(athena_mock, s3_mock, results_object):
+    results_object_stub(athena_mock, s3_mock, b'"$path"\n')
+    assert [] == list(get_paths_from_object(*get_results_object("123")))
+
+
+@patch("backend.lambdas.tasks.submit_query_results.s3")
+@patch("backend.lambdas.tasks.submit_query_results.athena")
+def test_it_reads_the_path_column(athena_mock, s3_mock, results_object):
+    results_object_stub(
+        athena_mock, s3_mock, b'"id","$path"\n"1","s3://mybucket/mykey1"\n'
+    )
+    assert ["s3://mybucket/mykey1"] == list(
+        get_paths_from_object(*get_results_object("123"))
+    )
+
+
+@patch("backend.lambdas.tasks.submit_query_results.s3")
+@patch("backend.lambdas.tasks.submit_query_results.athena")
+def test_it_falls_back_to_the_api_for_results_without_path_header(
+    athena_mock, s3_mock, results_object
+):
+    for body in [b"", b'"id"\n"1"\n', b"\xff\xfe\n"]:
+        results_object_stub(athena_mock, s3_mock, body)
+        assert get_results_object("123") is None
+
+
+@patch("backend.lambdas.tasks.submit_query_results.s3")
+@patch("backend.lambdas.tasks.submit_query_results.athena")
+@patch("backend.lambdas.tasks.submit_query_results.batch_sqs_msgs")
+@patch("backend.lambdas.tasks.submit_query_results.paginate")
+def test_it_submits_api_results_for_malformed_results_object(
+    paginate_mock, batch_sqs_msgs_mock, athena_mock, s3_mock, results_object
+):
+    results_object.side_effect = get_results_object
+    results_object_stub(athena_mock, s3_mock, b'"id"\n"1"\n')
+    paginate_mock.return_value = iter(test_data)
+
+    resp = handler(
+        {"JobId": "1234", "QueryId": "123", "Columns": []}, SimpleNamespace()
+    )
+
+    assert 2 == resp
+    paginate_mock.assert_called_once()
+
+
+@patch("backend.lambdas.tasks.submit_query_results.s3")
+@patch("backend.lambdas.tasks.submit_query_results.athena")
+def test_it_gets_the_results_object(athena_mock, s3_mock, results_object):
+    athena_mock.get_query_execution.return_value = {
+        "QueryExecution": {
+            "ResultConfiguration": {"OutputLocation": "s3://bucket/queries/123.csv"}
+        }
+    }
+    s3_mock.Object.return_value.get.return_value = {
+        "Body": BytesIO(b'"id","$path"\n"1","s3://mybucket/mykey1"\n')
+    }
+
+    reader, path_field_index = get_results_object("123")
+    assert 1 == path_field_index
+    assert [["1", "s3://mybucket/mykey1"]] == list(reader)
+    athena_mock.get_query_execution.assert_called_with(QueryExecutionId="123")
+    s3_mock.Object.assert_called_with("bucket", "queries/123.csv")
+
+
+@patch("backend.lambdas.tasks.submit_query_results.s3")
+@patch("backend.lambdas.tasks.submit_query_results.athena")
+def test_it_falls_back_to_the_api_for_unreadable_results(
+    athena_mock, s3_mock, results_object
+):
+    athena_mock.get_query_execution.return_value = {
+        "QueryExecution": {
+            "ResultConfiguration": {"OutputLocation": "s3://other/queries/123.csv"}
+        }
+    }
+    s3_mock.Object.return_value.get.side_effect = ClientError({}, "GetObject")
+
+    assert get_results_object("123") is None
@@ -5,12 +5,12 @@ from types import SimpleNamespace
 import pytest
 from mock import patch, ANY, MagicMock
 
-
 with patch.dict(os.environ, {"QueueUrl": "someurl"}):
     from backend.lambdas.tasks.work_query_queue import (
         handler,
         load_execution,
         clear_completed,
+        get_running_execution_arns,
         abandon_execution,
     )
 
@@ -21,6 +21,15 @@ with patch.dict(os.environ, {"QueueUrl": "someurl"}):
 pytestmark = [pytest.mark.unit, pytest.mark.task]
 
 
+@pytest.fixture(autouse=True)
+def running_execution_arns():
+    with patch(
+        "backend.lambdas.tasks.work_query_queue.get_running_execution_arns",
+        return_value=set(),
+    ) as mock_running:
+        yield mock_running
+
+
 @patch("backend.lambdas.tasks.work_query_queue.read_queue")
 @patch("backend.lambdas.tasks.work_query_queue.sqs")
 @patch("backend.lambdas.tasks.work_query_queue.load_execution")
@@ -62,6 +71,7 @@ def test_it_starts_machine_as_expected(sqs_mock, read_queue_mock, sf_client_mock
             "AWS_STEP_FUNCTIONS_STARTED_BY_EXECUTION_ID": "1234",
             "JobId": "4231",
             "WaitDuration": 5,
+            "MaxWaitDuration": 5,
             "ExecutionRetriesLeft": 2,
         }
     )
@@ -104,6 +114,7 @@ def test_it_defaults_wait_duration(sqs_mock, read_queue_mock, sf_client_mock):
             "AWS_STEP_FUNCTIONS_STARTED_BY_EXECUTION_ID": "1234",
             "JobId": "4231",
             "WaitDuration": 15,
+            "MaxWaitDuration": 15,
             "ExecutionRetriesLeft": 2,
         }
     )
@@ -316,19 +327,67 @@ def test_it_loads_execution_from_state(sf_mock):
     assert {**execution_stub(), "ReceiptHandle": "handle"} == resp
 
 
-@patch("backend.lambdas.tasks.work_query_queue.sqs")
 @patch("backend.lambdas.tasks.work_query_queue.queue")
-def test_it_clears_completed_from_sqs(mock_queue, mock_sqs):
-    mock_message = MagicMock()
-    mock_queue.url = "someurl"
-    mock_sqs.Message.return_value = mock_message
-    clear_completed(
-        [
-            {"ReceiptHandle": "handle1"},
-            {"ReceiptHandle": "handle2"},
+def test_it_clears_completed_from_sqs(mock_queue):
+    mock_queue.delete_messages.return_value = {"Successful": [], "Failed": []}
+    clear_completed([{"ReceiptHandle": "handle{}".format(i)} for i in range(0, 12)])
+    assert 2 == mock_queue.delete_messages.call_count
+    mock_queue.delete_messages.assert_called_with(
+        Entries=[
+            {"Id": "0", "ReceiptHandle": "handle10"},
+            {"Id": "1", "ReceiptHandle": "handle11"},
         ]
     )
-    assert 2 == mock_message.delete.call_count
+
+
+@patch("backend.lambdas.tasks.work_query_queue.queue")
+def test_it_raises_for_completed_messages_not_cleared(mock_queue):
+    mock_queue.delete_messages.return_value = {
+        "Failed": [{"Id": "0", "Code": "ReceiptHandleIsInvalid"}]
+    }
+    with pytest.raises(ValueError):
+        clear_completed([{"ReceiptHandle": "handle1"}])
+
+
+@patch("backend.lambdas.tasks.work_query_queue.read_queue")
+@patch("backend.lambdas.tasks.work_query_queue.sqs")
+@patch("backend.lambdas.tasks.work_query_queue.load_execution")
+def test_it_only_describes_executions_not_listed_as_running(
+    mock_load, sqs_mock, read_queue_mock, running_execution_arns
+):
+    running_execution_arns.return_value = {"arn1"}
+    mock_load.return_value = execution_stub(status="RUNNING", ReceiptHandle="handle2")
+    read_queue_mock.return_value = []
+
+    resp = handler(
+        {
+            "ExecutionId": "1234",
+            "ExecutionName": "4231",
+            "RunningExecutions": {
+                "Data": [
+                    {"ExecutionArn": "arn1", "ReceiptHandle": "handle1"},
+                    {"ExecutionArn": "arn2", "ReceiptHandle": "handle2"},
+                ],
+                "Total": 2,
+            },
+        },
+        SimpleNamespace(),
+    )
+
+    mock_load.assert_called_once_with(
+        {"ExecutionArn": "arn2", "ReceiptHandle": "handle2"}
+    )
+    assert 2 == resp["Total"]
+    assert {"ExecutionArn": "arn1", "ReceiptHandle": "handle1"} in resp["Data"]
+
+
+@patch("backend.lambdas.tasks.work_query_queue.paginate")
+def test_it_lists_running_executions(paginate_mock):
+    paginate_mock.return_value = iter([{"executionArn": "arn1"}])
+    assert {"arn1"} == get_running_execution_arns()
+    paginate_mock.assert_called_with(
+        ANY, ANY, ["executions"], stateMachineArn=ANY, statusFilter="RUNNING"
+    )
 
 
 def execution_stub(**kwargs):